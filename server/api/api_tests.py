@@ -2,6 +2,8 @@ import unittest
 import logging
 import os
 from sticky_pi_api.client import RemoteClient, RemoteAPIException
+from sticky_pi_api.async_client import AsyncRemoteClient
+import asyncio
 from sticky_pi_api.tests.test_local_client import LocalAndRemoteTests
 import boto3
 import tempfile
@@ -65,6 +67,27 @@ class TestRemoteAPIEndToEnd(unittest.TestCase, LocalAndRemoteTests):
         #
 
 
+class TestAsyncRemoteClient(unittest.TestCase):
+    _credentials = TestRemoteAPIEndToEnd._credentials
+
+    def test_put_images(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        test_images = LocalAndRemoteTests()._test_images
+
+        async def put_and_get():
+            async with AsyncRemoteClient(temp_dir, max_in_flight=8, **self._credentials) as cli:
+                uploaded = await cli.put_images(test_images)
+                series = await cli.get_image_series([{'device': '%',
+                                                      'start_datetime': '2020-01-01_00-00-00',
+                                                      'end_datetime': '2020-12-31_00-00-00'}])
+                await cli.delete_images(series)
+                return uploaded, series
+        try:
+            uploaded, series = asyncio.run(put_and_get())
+            self.assertEqual(len([u for u in uploaded if 'error' not in u]), len(series))
+        finally:
+            shutil.rmtree(temp_dir)
+
 #
 # _credentials = {'username': 'admin',
 #                'password': os.getenv('API_ADMIN_PASSWORD'),
@@ -13,7 +13,8 @@ import io
 
 from sticky_pi_api.configuration import RemoteAPIConf
 from sticky_pi_api.specifications import RemoteAPI
-from sticky_pi_api.utils import datetime_to_string
+from sticky_pi_api.utils import datetime_to_string, tuboids_from_form
+from sticky_pi_api import columnar
 
 
 # just wait for database to be ready
@@ -105,10 +106,21 @@ def %s(**kwargs):
     data = request.get_json()
     client_info = {'username':auth.current_user()}
     out = api.%s(data, client_info=client_info, **kwargs)
-    return jsonify(out)
+    return respond('%s', out)
 """
 
 
+def respond(endpoint, out):
+    # series can be returned in a columnar format, if the client accepts it (`Accept` header). JSON otherwise
+    tables = columnar.SERIES_TABLES.get(endpoint)
+    if tables is not None:
+        mimetype = request.accept_mimetypes.best_match(['application/json'] + list(columnar.MIMETYPES.values()))
+        for fmt, fmt_mimetype in columnar.MIMETYPES.items():
+            if mimetype == fmt_mimetype:
+                return Response(columnar.encode(out, fmt, tables), mimetype=mimetype)
+    return jsonify(out)
+
+
 def make_endpoint(method, role = 'admin', what=False):
     if not role:
         role = ""
@@ -119,7 +131,7 @@ def make_endpoint(method, role = 'admin', what=False):
     sub_route = "/<what>" if what else ""
     role_str = "role=%s" % role if role else ""
     assert endpoint in dir(api), "all endpoint must point to api methods. got %s" % endpoint
-    exec(template_function % (endpoint, sub_route, role_str, endpoint, endpoint))
+    exec(template_function % (endpoint, sub_route, role_str, endpoint, endpoint, endpoint))
 
 
 @app.route('/get_token', methods=['POST'])
@@ -138,6 +150,9 @@ make_endpoint(api.put_users, role='admin')
 
 make_endpoint(api.get_images, role="", what=True)
 make_endpoint(api.get_image_series, role="", what=True)
+make_endpoint(api.get_image_series_summary, role="", what=True)
+make_endpoint(api.get_daily_rollups, role="")
+make_endpoint(api.diff_images, role="")
 make_endpoint(api.delete_images, role="admin")
 make_endpoint(api.delete_tiled_tuboids, role="admin")
 make_endpoint(api.put_uid_annotations, role=['admin', 'read_write_user'])
@@ -155,14 +170,62 @@ make_endpoint(api.put_itc_labels, role=['admin', 'read_write_user'])
 make_endpoint(api._get_itc_labels, role="")
 
 
+# series can be retrieved by pages, or streamed as newline-delimited json (one object per line),
+# so the memory used by a worker does not depend on the size of the series
+def series_page_endpoint(page_method):
+    def endpoint(what):
+        data = request.get_json()
+        client_info = {'username': auth.current_user()}
+        out = page_method(data['info'], what=what, cursor=data.get('cursor'), page_size=data.get('page_size'),
+                          client_info=client_info)
+        return jsonify(out)
+    return endpoint
+
+
+def series_stream_endpoint(page_method):
+    def endpoint(what):
+        data = request.get_json()
+        client_info = {'username': auth.current_user()}
+
+        def generate():
+            cursor = None
+            while True:
+                page = page_method(data, what=what, cursor=cursor, client_info=client_info)
+                yield ''.join(json.dumps(o, cls=CustomJSONEncoder) + '\n' for o in page['data'])
+                cursor = page['cursor']
+                if cursor is None:
+                    return
+        return Response(generate(), mimetype='application/x-ndjson')
+    return endpoint
+
+
+for page_method, name in [(api.get_image_series_page, 'get_image_series'),
+                          (api.get_uid_annotations_series_page, 'get_uid_annotations_series')]:
+    app.add_url_rule('/%s_page/<what>' % name, '%s_page' % name,
+                     auth.login_required()(series_page_endpoint(page_method)), methods=['POST'])
+    app.add_url_rule('/%s_stream/<what>' % name, '%s_stream' % name,
+                     auth.login_required()(series_stream_endpoint(page_method)), methods=['POST'])
+
+
+@app.route('/get_images_with_uid_annotations_series/<what_image>/<what_annotation>', methods=['POST'])
+@auth.login_required()
+def get_images_with_uid_annotations_series(what_image, what_annotation):
+    data = request.get_json()
+    client_info = {'username': auth.current_user()}
+    out = api.get_images_with_uid_annotations_series(data['info'], what_image=what_image,
+                                                     what_annotation=what_annotation,
+                                                     columnar=data.get('columnar', False), client_info=client_info)
+    return jsonify(out)
+
+
 @app.route('/_put_new_images', methods=['POST'])
 @auth.login_required(role=["admin", "read_write_user"])
 def _put_new_images():
-    files = request.files
+    # all the images are sent under the same field name, in order
+    files = request.files.getlist('images')
     assert len(files) > 0
-    out = []
-    for k, f in files.items():
-        out += api.put_images([f], client_info = {'username': auth.current_user()})
+    # all the images of the request are handled as one batch/transaction
+    out = api.put_images(files, client_info={'username': auth.current_user()})
     return jsonify(out)
 
 @app.route('/_put_tiled_tuboids', methods=['POST'])
@@ -170,11 +233,11 @@ def _put_new_images():
 def _put_tiled_tuboids():
     files = request.files
     assert len(files) > 0
-    data = {}
-    for k, f in files.items():
-        if k == 'tuboid_id' or k == 'series_info':
-            f = json.load(f)
-        data[k] = f
-    out = [api._put_tiled_tuboids([data], client_info={'username': auth.current_user()})]
+    # all the tuboids of the request are handled as one batch (see `tuboid_form_parts`)
+    tuboids = tuboids_from_form(files)
+    out = api._put_tiled_tuboids(tuboids, client_info={'username': auth.current_user()})
+    # former clients send one tuboid per request, with non-indexed parts, and expect a nested list
+    if all('.' not in k for k in files.keys()):
+        out = [out]
     return jsonify(out)
 
@@ -0,0 +1,16 @@
+"""
+Makes the daily rollups of all the images of the database again, e.g. to backfill the rollups of existing images.
+Run it in the api container: `python rebuild_daily_rollups.py`
+"""
+import logging
+from sticky_pi_api.configuration import RemoteAPIConf
+from sticky_pi_api.specifications import RemoteAPI
+
+
+log_lev = logging.INFO
+logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S', level=log_lev)
+
+api = RemoteAPI(RemoteAPIConf())
+n_rollups = api.rebuild_daily_rollups()
+logging.info("Rebuilt %i daily rollups" % n_rollups)
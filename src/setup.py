@@ -24,7 +24,9 @@ setup(
                       'itsdangerous',
                       'decorate_all_methods'],
     extras_require={
-        'remote_api': ['pymysql', 'boto3', 'PyMySQL', 'Flask-HTTPAuth', 'retry'],
+        'remote_api': ['pymysql', 'boto3', 'PyMySQL', 'Flask-HTTPAuth', 'retry', 'pyarrow'],
+        'async': ['aiohttp'],
+        'columnar': ['pyarrow'],
         'test': ['nose', 'pytest', 'pytest-cov', 'codecov', 'coverage'],
         'docs': ['mock', 'sphinx-autodoc-typehints', 'sphinx', 'sphinx_rtd_theme', 'recommonmark', 'mock']
     },
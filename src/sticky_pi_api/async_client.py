@@ -0,0 +1,426 @@
+"""
+An asyncio counterpart of ``RemoteClient``. Requests (uploads, queries and presigned downloads)
+are sent concurrently, up to a configurable number of requests in flight.
+This module requires the optional dependency ``aiohttp`` (i.e. ``pip install sticky_pi_api[async]``).
+
+Usage::
+
+    async with AsyncRemoteClient(local_dir, host, username, password, max_in_flight=64) as cli:
+        await cli.put_images(files)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import aiohttp
+import pandas as pd
+from decorate_all_methods import decorate_all_methods
+from sticky_pi_api.client import BaseClient, RemoteAPIConnector, RemoteAPIException, Cache, tuboid_dir_info, \
+    merge_tiled_tuboids_and_itc_labels, columns_to_data_frame, _split_invalid_images, _size_bounded_groups, \
+    _tuboid_size
+from sticky_pi_api.storage import BaseStorage
+from sticky_pi_api import columnar
+from sticky_pi_api.columnar import MIMETYPES
+from sticky_pi_api.types import List, Dict, Union, Any, InfoType, MetadataType, AnnotType
+from sticky_pi_api.utils import chunker, python_inputs_to_json, json_out_parser, md5, tuboid_form_parts
+
+
+async def _iter_pages(get_page, info, what, page_size):
+    cursor = None
+    while True:
+        page = await get_page(info, what=what, cursor=cursor, page_size=page_size)
+        for o in page['data']:
+            yield o
+        cursor = page['cursor']
+        if cursor is None:
+            return
+
+
+# all the client methods may take python argument, the argument are implicitly transformed
+# to json-compatible values using this decorator
+@decorate_all_methods(python_inputs_to_json, exclude=['__init__', '__aenter__', '__aexit__', 'close',
+                                                      '_default_client_to_api', '_form_data'])
+class AsyncRemoteAPIConnector(object):
+    _max_retry_attempts = RemoteAPIConnector._max_retry_attempts
+    _sleep_time_between_attempts = RemoteAPIConnector._sleep_time_between_attempts
+    _put_max_request_size = RemoteAPIConnector._put_max_request_size
+
+    def __init__(self, host: str, username: str, password: str, protocol: str = 'https', port: int = 443,
+                 max_in_flight: int = 32):
+        """
+        Connects to a remote API, using asyncio. Has the same methods as ``RemoteAPIConnector``, as coroutines.
+
+        :param host: the hostname of the API
+        :param username: the name of the API user
+        :param password: the password of the API user
+        :param protocol: either ``'https'`` or ``'http'``
+        :param port: the port of the API
+        :param max_in_flight: the maximal number of concurrent HTTP requests
+        """
+        self._host = host
+        self._username = username
+        self._password = password
+        self._protocol = protocol
+        self._port = int(port)
+        self._max_in_flight = max_in_flight
+        self._token = {'token': None, 'expiration': 0}
+        self._session = None
+        self._in_flight = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        # connections are pooled, and limited, by the connector. The semaphore also bounds the number of
+        # requests that are prepared (e.g. files being opened) at the same time
+        connector = aiohttp.TCPConnector(limit=self._max_in_flight)
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        self._token_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _form_data(parts):
+        # parts are tuples (field, filename, value, content_type),
+        # where value is either a path to a file (str) or the content itself (bytes)
+        form = aiohttp.FormData()
+        opened = []
+        for field, filename, value, content_type in parts:
+            if isinstance(value, str):
+                value = open(value, 'rb')
+                opened.append(value)
+            form.add_field(field, value, filename=filename, content_type=content_type)
+        return form, opened
+
+    async def _default_client_to_api(self, entry_point, info=None, what: str = None, files=None, fmt: str = None):
+        assert self._session is not None, 'The client must be used as an async context manager'
+
+        if entry_point != 'get_token':
+            async with self._token_lock:
+                if self._token['expiration'] < int(time.time()) + 60:  # we add 60s just to be sure
+                    self._token = await self.get_token()
+            auth = aiohttp.BasicAuth(self._token['token'], '')
+        else:
+            auth = aiohttp.BasicAuth(self._username, self._password)
+
+        url = "%s://%s:%i/%s" % (self._protocol, self._host, self._port, entry_point)
+        if what is not None:
+            url += "/" + what
+        # a columnar format (see `sticky_pi_api.columnar`) is negotiated with the `Accept` header
+        headers = {'Accept': MIMETYPES[fmt]} if fmt is not None else None
+
+        attempt = 0
+        while True:
+            logging.debug('Requesting %s' % url)
+            opened = []
+            try:
+                async with self._in_flight:
+                    if files is not None:
+                        # the form is rebuilt at each attempt, as its files are consumed
+                        form, opened = self._form_data(files)
+                        request = self._session.post(url, data=form, auth=auth, headers=headers)
+                    else:
+                        request = self._session.post(url, json=info, auth=auth, headers=headers)
+                    async with request as response:
+                        content = await response.read()
+                        if response.status == 200:
+                            if fmt is not None:
+                                return columnar.decode(content, fmt)
+                            return json.loads(content, object_hook=json_out_parser)
+            finally:
+                for o in opened:
+                    o.close()
+
+            if attempt >= self._max_retry_attempts:
+                logging.error("Failed to request url: %s" % url)
+                raise RemoteAPIException(content)
+            await asyncio.sleep(self._sleep_time_between_attempts * self._max_retry_attempts)
+            attempt += 1
+            logging.warning("Failed to request url: %s. Retrying... Attempt %i" % (url, attempt))
+
+    async def get_token(self, client_info: Dict[str, Any] = None) -> Dict[str, Union[str, int]]:
+        return await self._default_client_to_api('get_token', info=None)
+
+    async def get_image_series_frame(self, info: InfoType, what: str = 'metadata', fmt: str = 'arrow') -> pd.DataFrame:
+        return await self._default_client_to_api('get_image_series', info, what=what, fmt=fmt)
+
+    async def get_uid_annotations_series_frame(self, info: InfoType, what: str = 'metadata',
+                                               fmt: str = 'arrow') -> pd.DataFrame:
+        return await self._default_client_to_api('get_uid_annotations_series', info, what=what, fmt=fmt)
+
+    async def get_tiled_tuboid_series_frame(self, info: InfoType, what: str = 'metadata',
+                                            fmt: str = 'arrow') -> pd.DataFrame:
+        return await self._default_client_to_api('get_tiled_tuboid_series', info, what=what, fmt=fmt)
+
+    async def _put_new_images(self, files: List[str], client_info: Dict[str, Any] = None) -> MetadataType:
+        # as for the synchronous client, files are grouped in requests of at most `_put_max_request_size` bytes
+        requests_files = _size_bounded_groups(files, [os.path.getsize(f) for f in files], self._put_max_request_size)
+        out = []
+        for group in requests_files:
+            payload = [('images', os.path.basename(file), file, 'application/octet-stream') for file in group]
+            out += await self._default_client_to_api('_put_new_images', files=payload)
+        return out
+
+    async def get_users(self, info: List[Dict[str, str]] = None, client_info: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        return await self._default_client_to_api('get_users', info)
+
+    async def put_users(self, info: List[Dict[str, Any]], client_info: Dict[str, Any] = None) -> List[Dict[str, Any]]:
+        return await self._default_client_to_api('put_users', info)
+
+    async def get_images(self, info: InfoType, what: str = 'metadata', client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_images', info, what=what)
+
+    async def diff_images(self, info: MetadataType, client_info: Dict[str, Any] = None) -> List[str]:
+        return await self._default_client_to_api('diff_images', info)
+
+    async def get_image_series(self, info, what: str = 'metadata', client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_image_series', info, what=what)
+
+    async def get_image_series_page(self, info, what: str = 'metadata', cursor: str = None, page_size: int = None,
+                                    client_info: Dict[str, Any] = None) -> Dict[str, Any]:
+        return await self._default_client_to_api('get_image_series_page',
+                                                 {'info': info, 'cursor': cursor, 'page_size': page_size}, what=what)
+
+    async def delete_images(self, info: InfoType, client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('delete_images', info)
+
+    async def delete_tiled_tuboids(self, info: InfoType, client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('delete_tiled_tuboids', info)
+
+    async def put_uid_annotations(self, info: AnnotType, client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('put_uid_annotations', info)
+
+    async def get_uid_annotations(self, info: InfoType, what: str = 'metadata',
+                                  client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_uid_annotations', info, what=what)
+
+    async def get_image_series_summary(self, info: InfoType, what: str = 'day',
+                                       client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_image_series_summary', info, what=what)
+
+    async def get_daily_rollups(self, info: InfoType, client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_daily_rollups', info)
+
+    async def get_images_with_uid_annotations_series(self, info: InfoType, what_image: str = 'metadata',
+                                                     what_annotation: str = 'metadata', columnar: bool = False,
+                                                     client_info: Dict[str, Any] = None):
+        return await self._default_client_to_api('get_images_with_uid_annotations_series',
+                                                 {'info': info, 'columnar': columnar},
+                                                 what='%s/%s' % (what_image, what_annotation))
+
+    async def get_uid_annotations_series(self, info: InfoType, what: str = 'metadata',
+                                         client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_uid_annotations_series', info, what=what)
+
+    async def get_uid_annotations_series_page(self, info: InfoType, what: str = 'metadata', cursor: str = None,
+                                              page_size: int = None,
+                                              client_info: Dict[str, Any] = None) -> Dict[str, Any]:
+        return await self._default_client_to_api('get_uid_annotations_series_page',
+                                                 {'info': info, 'cursor': cursor, 'page_size': page_size}, what=what)
+
+    async def get_tiled_tuboid_series(self, info: InfoType, what: str = "metadata",
+                                      client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('get_tiled_tuboid_series', info=info, what=what)
+
+    async def _put_tiled_tuboids(self, files: List[Dict[str, str]], client_info: Dict[str, Any] = None) -> MetadataType:
+        # several tuboids per request, as for the synchronous client. Requests are sent concurrently
+        groups = _size_bounded_groups(files, [_tuboid_size(f) for f in files], self._put_max_request_size)
+        out = []
+        for o in await asyncio.gather(*[self._default_client_to_api('_put_tiled_tuboids', files=tuboid_form_parts(g))
+                                        for g in groups]):
+            out += o
+        return out
+
+    async def _get_itc_labels(self, info: List[Dict], client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('_get_itc_labels', info)
+
+    async def put_itc_labels(self, info: List[Dict[str, Union[str, int]]],
+                             client_info: Dict[str, Any] = None) -> MetadataType:
+        return await self._default_client_to_api('put_itc_labels', info)
+
+    async def _get_ml_bundle_file_list(self, info: str, what: str = "all",
+                                       client_info: Dict[str, Any] = None) -> List[Dict[str, Union[float, str]]]:
+        return await self._default_client_to_api('_get_ml_bundle_file_list', info, what=what)
+
+    async def _get_ml_bundle_upload_links(self, info: List[Dict[str, Union[float, str]]],
+                                          client_info: Dict[str, Any] = None) -> List[Dict[str, Union[float, str]]]:
+        return await self._default_client_to_api('_get_ml_bundle_upload_links', info)
+
+
+@decorate_all_methods(python_inputs_to_json, exclude=['__init__', '_local_images_info', '_images_to_upload', '_diff_query',
+                                                      '_get_ml_bundle_file', '_put_ml_bundle_file'])
+class AsyncRemoteClient(AsyncRemoteAPIConnector):
+    _put_chunk_size = BaseClient._put_chunk_size
+    _cache_dirname = BaseClient._cache_dirname
+    _cache_filename = BaseClient._cache_filename
+    # the local statistics of the images are computed exactly as in the synchronous client
+    _local_images_info = BaseClient._local_images_info
+    _images_to_upload = staticmethod(BaseClient._images_to_upload)
+    _diff_query = staticmethod(BaseClient._diff_query)
+
+    def __init__(self, local_dir: str, host, username, password, protocol: str = 'https', port: int = 443,
+                 n_threads: int = 8, max_in_flight: int = 32):
+        """
+        An asyncio client to a remote API. It has the same methods as ``RemoteClient``, as coroutines,
+        but uploads and downloads are run concurrently (up to ``max_in_flight`` requests at a time).
+        It must be used as an async context manager.
+
+        :param local_dir: The path to a client directory that acts as a client storage
+        :param n_threads: The number of parallel threads to use to compute statistics on the image (md5 and such)
+        :param max_in_flight: the maximal number of concurrent HTTP requests
+        """
+        AsyncRemoteAPIConnector.__init__(self, host, username, password, protocol, port, max_in_flight)
+        self._local_dir = local_dir
+        self._n_threads = n_threads
+        os.makedirs(self._local_dir, exist_ok=True)
+        cache_file = os.path.join(local_dir, self._cache_dirname, self._cache_filename)
+        self._cache = Cache(cache_file)
+
+    @property
+    def local_dir(self):
+        return self._local_dir
+
+    def delete_cache(self):
+        self._cache.delete()
+
+    def clean_cache(self) -> int:
+        return self._cache.evict_missing()
+
+    async def put_images(self, files: List[str], validate: bool = True) -> MetadataType:
+        """
+        Incrementally upload a list of client files. Chunks of files are uploaded concurrently.
+
+        :param files: the paths to the client files
+        :param validate: whether to check that the files are complete JPEGs, with valid headers, before uploading them
+        :return: the data of the uploaded files, as represented in by API.
+            Files that failed to upload are represented by a dictionary with the keys ``'filename'`` and ``'error'``
+        """
+        loop = asyncio.get_running_loop()
+        chunk_size = self._put_chunk_size * self._n_threads
+
+        async def diff(group):
+            # local statistics are CPU bound, so they are computed outside the event loop
+            info = await loop.run_in_executor(None, self._local_images_info, group, validate)
+            info, invalid = _split_invalid_images(info)
+            statuses = await self.diff_images(self._diff_query(info)) if info else []
+            return self._images_to_upload(info, statuses), invalid
+
+        to_upload = []
+        out = []
+        for group in chunker(files, chunk_size):
+            group_to_upload, group_invalid = await diff(group)
+            to_upload += group_to_upload
+            out += group_invalid
+        logging.info("Putting images... Uploading %i files" % len(to_upload))
+        if len(to_upload) == 0:
+            logging.warning('No image to upload!')
+
+        results = await asyncio.gather(*[self._put_new_images(group)
+                                         for group in chunker(to_upload, self._put_chunk_size)])
+        for r in results:
+            out += r
+        for o in out:
+            if 'error' in o:
+                logging.error("Failed to upload %s: %s" % (o['filename'], o['error']))
+        logging.info("Putting images... Complete!")
+        return out
+
+    async def put_tiled_tuboids(self, tuboid_directories: List[str], series_info: Dict[str, Any]):
+        to_upload = [tuboid_dir_info(d, series_info) for d in tuboid_directories]
+        return await self._put_tiled_tuboids(to_upload)
+
+    async def get_images_with_uid_annotations_frame(self, info: InfoType, what_image: str = 'metadata',
+                                                    what_annotation: str = 'metadata') -> pd.DataFrame:
+        columns = await self.get_images_with_uid_annotations_series(info, what_image=what_image,
+                                                                    what_annotation=what_annotation, columnar=True)
+        return columns_to_data_frame(columns)
+
+    async def iter_image_series(self, info: InfoType, what: str = 'metadata', page_size: int = None):
+        """
+        Lazily iterates over image series, one page at a time. Used as ``async for image in cli.iter_image_series(...)``
+        """
+        async for o in _iter_pages(self.get_image_series_page, info, what, page_size):
+            yield o
+
+    async def iter_uid_annotations_series(self, info: InfoType, what: str = 'metadata', page_size: int = None):
+        """
+        Lazily iterates over annotation series, one page at a time.
+        """
+        async for o in _iter_pages(self.get_uid_annotations_series_page, info, what, page_size):
+            yield o
+
+    async def get_tiled_tuboid_series_itc_labels(self, info: InfoType, what: str = "metadata") -> MetadataType:
+        tiled_tuboids = pd.DataFrame(await self.get_tiled_tuboid_series(info, what))
+        if len(tiled_tuboids) == 0:
+            logging.warning('No tuboids found for %s' % info)
+            return []
+        itc_labels = await self._get_itc_labels([{'tuboid_id': i} for i in tiled_tuboids.tuboid_id])
+        return merge_tiled_tuboids_and_itc_labels(tiled_tuboids, itc_labels)
+
+    async def get_ml_bundle_dir(self, bundle_name: str, bundle_dir: str, what: str) -> List[Dict[str, Union[float, str]]]:
+        assert os.path.basename(os.path.normpath(bundle_dir)) == bundle_name
+        local_files = BaseStorage.local_bundle_files_info(bundle_dir, what)
+        already_downloaded_dict = {au['key']: au for au in local_files}
+        remote_files = await self._get_ml_bundle_file_list(bundle_name, what)
+        files_to_download = []
+        for r in remote_files:
+            if r['key'] not in already_downloaded_dict:
+                files_to_download.append(r)
+                continue
+            local_info = already_downloaded_dict[r['key']]
+            if r['md5'] != local_info['md5'] and r['mtime'] > local_info['mtime']:
+                files_to_download.append(r)
+            else:
+                logging.info("Skipping %s (already on local)" % str(r['key']))
+
+        await asyncio.gather(*[self._get_ml_bundle_file(f, bundle_dir) for f in files_to_download])
+        return files_to_download
+
+    async def put_ml_bundle_dir(self, bundle_name: str, bundle_dir: str, what: str = 'all') -> List[Dict[str, Union[float, str]]]:
+        files_to_upload = BaseStorage.local_bundle_files_info(bundle_dir, what)
+        for f in files_to_upload:
+            f['bundle_name'] = bundle_name
+        n_local_files = len(files_to_upload)
+        logging.info(f'Found {n_local_files} local files to upload')
+        files_to_upload = await self._get_ml_bundle_upload_links(files_to_upload)
+        logging.info(f'{n_local_files - len(files_to_upload)} already uploaded)')
+        await asyncio.gather(*[self._put_ml_bundle_file(f['path'], f['url'])
+                               for f in files_to_upload if f['url'] is not None])
+        return files_to_upload
+
+    async def _put_ml_bundle_file(self, path: str, url: Dict):
+        object_name = os.path.basename(path)
+        logging.info("%s => %s" % (object_name, url['fields']['key']))
+        form = aiohttp.FormData(url['fields'])
+        async with self._in_flight:
+            with open(path, 'rb') as f:
+                form.add_field('file', f, filename=object_name)
+                async with self._session.post(url['url'], data=form) as response:
+                    assert response.status == 204, url
+
+    async def _get_ml_bundle_file(self, file_dict: Dict[str, Any], bundle_dir: str):
+        url = file_dict['url']
+        target = os.path.join(bundle_dir, file_dict['key'])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        target_tmp = target + ".tmp"
+        logging.info("%s => %s" % (url, target))
+        async with self._in_flight:
+            async with self._session.get(url) as response:
+                with open(target_tmp, 'wb') as data:
+                    async for chunk in response.content.iter_chunked(1 << 16):
+                        data.write(chunk)
+
+        loop = asyncio.get_running_loop()
+        assert await loop.run_in_executor(None, md5, target_tmp) == file_dict['md5'], \
+            f'{file_dict["key"]}: md5s differ !'
+        os.rename(target_tmp, target)
+        os.utime(target, (time.time(), file_dict['mtime']))
@@ -10,70 +10,241 @@ import pandas as pd
 import shutil
 from joblib import Parallel, delayed
 import inspect
-import shelve
+import pickle
+import sqlite3
+import hashlib
+import threading
 import requests
-from typing import Any
+from requests.adapters import HTTPAdapter
+from typing import Any, Tuple
 import json
+from contextlib import ExitStack
 from decorate_all_methods import decorate_all_methods
 from sticky_pi_api.image_parser import ImageParser
-from sticky_pi_api.utils import datetime_to_string, chunker, python_inputs_to_json, json_out_parser
+from sticky_pi_api.utils import datetime_to_string, chunker, python_inputs_to_json, json_out_parser, \
+    DATESTRING_REGEX, STRING_DATETIME_FORMAT, tuboid_form_parts
 from sticky_pi_api.storage import BaseStorage
 from sticky_pi_api.types import List, Dict, Union, InfoType, MetadataType, AnnotType
 from sticky_pi_api.specifications import LocalAPI, BaseAPISpec
 from sticky_pi_api.configuration import LocalAPIConf
+from sticky_pi_api import columnar
+from sticky_pi_api.columnar import MIMETYPES
 
 
-class Cache(dict):
-    _sync_each_n = 1024
+class Cache(object):
+    _max_variables = 499  # keeps statements within the sqlite bound parameter limit
+    _timeout = 10  # seconds to wait for another process to release the file
 
     def __init__(self, path: str):
-        super().__init__()
+        """
+        A persistent cache of the results of functions of files, in a local sqlite file.
+        Entries are keyed by the path, modification time and size of the file,
+        so they are invalidated when the file changes.
+        Results are namespaced by the source code of the function, so changing a function invalidates its results.
+        Nothing is loaded in memory: entries are looked up in batches, when needed.
+
+        :param path: the path to the cache file. It is created if needed
+        """
         self._path = path
-        self._n_writes = 0
-        if path:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-        if os.path.isfile(path):
-            with shelve.open(path, flag='r') as d:
-                for k, v in d.items():
-                    self[k] = v
-
-    def add(self, function, results):
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._function_keys = {}
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with self._lock, self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS results (function TEXT, path TEXT, mtime REAL, size INTEGER, '
+                         'value BLOB, PRIMARY KEY (function, path))')
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections cannot be shared with forked processes, so we open one per process
+        pid = os.getpid()
+        if pid not in self._connections:
+            conn = sqlite3.connect(self._path, timeout=self._timeout, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._connections = {pid: conn}
+        return self._connections[pid]
+
+    def _function_key(self, function, variant) -> str:
+        # the source of a function is only read once. Nested functions share their code object
+        code = function.__code__
+        if code not in self._function_keys:
+            self._function_keys[code] = hashlib.md5(inspect.getsource(function).encode()).hexdigest()
+        return '%s:%s' % (self._function_keys[code], variant)
+
+    def get_cached(self, function, keys: List[Tuple[str, float, int]], variant: Any = None) -> Dict[Tuple, Any]:
+        """
+        :param function: the function that computed the results
+        :param keys: a list of ``(path, mtime, size)`` tuples
+        :param variant: a value that distinguishes the results of the same function (e.g. one of its arguments)
+        :return: a dictionary ``{key: result}`` of the keys that are cached and up to date
+        """
+        function_key = self._function_key(function, variant)
+        keys = set(keys)
+        out = {}
+        paths = sorted({k[0] for k in keys})
+        with self._lock:
+            conn = self._connection()
+            for chunk in chunker(paths, self._max_variables - 1):
+                q = conn.execute('SELECT path, mtime, size, value FROM results WHERE function = ? AND path IN (%s)' %
+                                 ','.join('?' * len(chunk)), [function_key] + chunk)
+                for path, mtime, size, value in q:
+                    if (path, mtime, size) in keys:
+                        out[(path, mtime, size)] = pickle.loads(value)
+        return out
+
+    def add(self, function, results: Dict[Tuple[str, float, int], Any], variant: Any = None) -> None:
+        """
+        :param function: the function that computed the results
+        :param results: a dictionary ``{(path, mtime, size): result}``
+        :param variant: a value that distinguishes the results of the same function, as in ``get_cached``
+        """
         if len(results) == 0:
             return
-        key = inspect.getsource(function)
-        if key not in self.keys():
-            self[key] = {}
-        for r in results:
-            self[key].update(r)
-            if self._n_writes % self._sync_each_n == self._sync_each_n - 1:
-                self._sync()
-            self._n_writes += 1
-
-    def get_cached(self, function, hash):
-        key = inspect.getsource(function)
-        return self[key][hash]
-
-    def _sync(self):
-        with shelve.open(self._path, writeback=True) as d:
-            for k, v in self.items():
-                d[k] = v
+        function_key = self._function_key(function, variant)
+        rows = [(function_key, path, mtime, size, pickle.dumps(value))
+                for (path, mtime, size), value in results.items()]
+        with self._lock, self._connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', rows)
 
-    def delete(self):
-        try:
-            os.remove(self._path)
-        except FileExistsError:
-            logging.error('trying to detect cache, but file does not exist')
+    def evict_missing(self) -> int:
+        """
+        Removes the entries of the files that no longer exist.
 
+        :return: the number of removed entries
+        """
+        with self._lock:
+            conn = self._connection()
+            missing = [(p,) for p, in conn.execute('SELECT DISTINCT path FROM results') if not os.path.exists(p)]
+            with conn:
+                conn.executemany('DELETE FROM results WHERE path = ?', missing)
+        return len(missing)
+
+    def delete(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections = {}
+        # WAL mode also uses a `-wal` and a `-shm` file
+        for path in [self._path, self._path + '-wal', self._path + '-shm']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                if path == self._path:
+                    logging.error('trying to delete cache, but file does not exist')
+
+
+def tuboid_dir_info(directory: str, series_info: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Describes the files of a local tiled tuboid directory, as expected by ``_put_tiled_tuboids``.
+
+    :param directory: the tuboid directory, which contains ``metadata.txt``, ``tuboid.jpg`` and ``context.jpg``
+    :param series_info: the description of the series the tuboid belongs to
+    :return: a dict with the keys ``'tuboid_id'``, ``'series_info'``, ``'metadata'``, ``'tuboid'`` and ``'context'``
+    """
+    dirname = os.path.basename(os.path.normpath(directory))
+
+    metadata_file = os.path.join(directory, 'metadata.txt')
+    tuboid_file = os.path.join(directory, 'tuboid.jpg')
+    context_file = os.path.join(directory, 'context.jpg')
+    assert len(dirname.split('.')) == 5  # 5 fields in this dir
+    assert os.path.isfile(metadata_file)
+    assert os.path.isfile(context_file)
+    assert os.path.isfile(tuboid_file)
+    assert all([k in series_info.keys() for k in ('algo_name', 'algo_version', 'start_datetime', 'end_datetime', 'device', 'n_images', )])
+
+    return {'tuboid_id': dirname,
+            'series_info': series_info,
+            'metadata': metadata_file,
+            'tuboid': tuboid_file,
+            'context': context_file}
+
+
+def merge_tiled_tuboids_and_itc_labels(tiled_tuboids: pd.DataFrame, itc_labels: MetadataType) -> MetadataType:
+    """
+    Left-joins tiled tuboids and their labels, as returned by ``get_tiled_tuboid_series`` and ``_get_itc_labels``.
+    """
+    itc_labels = pd.DataFrame(itc_labels)
+    if len(itc_labels) == 0:
+        logging.warning('No ITC labels found')
+        out = tiled_tuboids
+    else:
+        # force suffixes for ITC
+        itc_labels.columns = itc_labels.columns.map(lambda x: str(x) + '_itc')
+        tiled_tuboids.set_index(['id'], inplace=True)
+        itc_labels.set_index(['parent_tuboid_id_itc'], inplace=True)
+
+        out = pd.merge(tiled_tuboids, itc_labels,
+                       how='left', left_index=True, right_index=True)
+
+    out = out.where(pd.notnull(out), None) #.sort_values(['device', 'datetime'])
+    out = out.to_dict(orient='records')
+    return out
+
+
+def columns_to_data_frame(columns: Dict[str, List[Any]]) -> pd.DataFrame:
+    """
+    Makes a data frame from columns, as returned by the API with ``columnar=True``.
+    Datetime strings are parsed.
+    """
+    out = pd.DataFrame(columns)
+    for c in out.columns:
+        values = out[c].dropna()
+        if out[c].dtype == object and len(values) > 0 and \
+                isinstance(values.iloc[0], str) and DATESTRING_REGEX.search(values.iloc[0]):
+            out[c] = pd.to_datetime(out[c], format=STRING_DATETIME_FORMAT)
+    return out
+
+
+def _split_invalid_images(info: MetadataType):
+    # separates the local stats of invalid images, as ``{'filename', 'error'}``, from the valid ones
+    valid, invalid = [], []
+    for i in info:
+        if 'error' in i:
+            invalid.append({'filename': os.path.basename(i['url']), 'error': i['error']})
+        else:
+            valid.append(i)
+    return valid, invalid
+
+
+def _size_bounded_groups(items: List[Any], sizes: List[int], max_size: int) -> List[List[Any]]:
+    # groups consecutive items, so that each group is at most `max_size` (unless a single item is larger)
+    groups = [[]]
+    group_size = 0
+    for item, size in zip(items, sizes):
+        if len(groups[-1]) > 0 and group_size + size > max_size:
+            groups.append([])
+            group_size = 0
+        groups[-1].append(item)
+        group_size += size
+    return groups
+
+
+def _tuboid_size(tuboid: Dict[str, Any]) -> int:
+    return sum(os.path.getsize(tuboid[k]) for k in ('metadata', 'tuboid', 'context'))
+
+
+def _iter_pages(get_page, info, what, page_size):
+    cursor = None
+    while True:
+        page = get_page(info, what=what, cursor=cursor, page_size=page_size)
+        for o in page['data']:
+            yield o
+        cursor = page['cursor']
+        if cursor is None:
+            return
 
 
 # all the client methods may take python argument, the argument are implicitly transformed
 # to json-compatible values using this decorator
 
 
-@decorate_all_methods(python_inputs_to_json, exclude=['__init__', '_diff_images_to_upload'])
+@decorate_all_methods(python_inputs_to_json, exclude=['__init__', '_diff_images_to_upload', '_local_images_info',
+                                                      '_images_to_upload', '_diff_query'])
 class BaseClient(BaseAPISpec, ABC):
     _put_chunk_size = 16  # number of images to handle at the same time during upload
     _cache_dirname = "cache"
+    _cache_filename = "stats.sqlite"
 
     def __init__(self, local_dir: str, n_threads: int = 8):
         """
@@ -87,52 +258,79 @@ class BaseClient(BaseAPISpec, ABC):
         self._n_threads = n_threads
         self._local_dir = local_dir
         os.makedirs(self._local_dir, exist_ok=True)
-        cache_file = os.path.join(local_dir, self._cache_dirname, 'cache.pkl')
+        cache_file = os.path.join(local_dir, self._cache_dirname, self._cache_filename)
         self._cache = Cache(cache_file)
 
     @property
     def local_dir(self):
         return self._local_dir
 
-    def get_images_with_uid_annotations_series(self, info: InfoType, what_image: str = 'metadata', what_annotation: str = 'metadata') -> MetadataType:
+    def get_images_with_uid_annotations_frame(self, info: InfoType, what_image: str = 'metadata',
+                                              what_annotation: str = 'metadata') -> pd.DataFrame:
         """
-        Retrieves images alongside their annotations (if available)  for images from a given device and
-        within a given datetime range.
+        Retrieves images alongside their latest annotation (if available), as a data frame, with one column per field.
+        The data are transferred as columns, so no intermediary row is built.
+        See ``get_images_with_uid_annotations_series`` for the arguments and the fields.
 
+        :return: a data frame with one row per image
+        """
+        columns = self.get_images_with_uid_annotations_series(info, what_image=what_image,
+                                                              what_annotation=what_annotation, columnar=True)
+        return columns_to_data_frame(columns)
 
-        :param info: A list of dicts. each dicts has, at least, the keys:
-            ``'device'``, ``'start_datetime'`` and ``'end_datetime'``
-        :param what_image: The nature of the image objects to retrieve.
-            One of {``'metadata'``, ``'image'``, ``'thumbnail'``, ``'thumbnail_mini'``}
-        :param what_annotation: The nature of the object to retrieve. One of {``'metadata'``, ``'data'``}.
-        :return: A list of dictionaries with one element for each queried value.
-            Each dictionary contains the fields present in the underlying database tables (see ``UIDAnnotations`` and ``Images``).
+    def _get_frame(self, entry_point: str, info: InfoType, what: str, fmt: str) -> pd.DataFrame:
+        # the local client converts the rows with the same types as a remote API would
+        rows = getattr(self, entry_point)(info, what=what)
+        return columnar.to_arrow_table(rows, columnar.SERIES_TABLES[entry_point]).to_pandas()
+
+    def get_image_series_frame(self, info: InfoType, what: str = 'metadata', fmt: str = 'arrow') -> pd.DataFrame:
         """
-        # we first fetch the parent images matching a series
+        Retrieves image series as a data frame, with typed columns, without building intermediary dictionaries.
+        Requires ``pyarrow``.
 
-        parent_images = self.get_image_series(info, what=what_image)
+        :param info: A list of dicts, as in ``get_image_series``
+        :param what: The nature of the objects to retrieve, as in ``get_image_series``
+        :param fmt: The columnar format used to transfer the data from a remote API. One of {``'arrow'``, ``'parquet'``}
+        :return: a data frame, with one row per image
+        """
+        return self._get_frame('get_image_series', info, what, fmt)
 
-        if len(parent_images) == 0:
-            logging.warning('No image found for provided info!')
-            return [{}]
+    def get_uid_annotations_series_frame(self, info: InfoType, what: str = 'metadata',
+                                         fmt: str = 'arrow') -> pd.DataFrame:
+        """
+        Retrieves annotation series as a data frame. See ``get_image_series_frame``.
+        """
+        return self._get_frame('get_uid_annotations_series', info, what, fmt)
 
-        # we filter the metadata as only these two fields are necessary
-        # info = [{k: v for k, v in p.items() if k in {"device", 'datetime'}} for p in parent_images]
+    def get_tiled_tuboid_series_frame(self, info: InfoType, what: str = 'metadata',
+                                      fmt: str = 'arrow') -> pd.DataFrame:
+        """
+        Retrieves tiled tuboid series as a data frame. See ``get_image_series_frame``.
+        """
+        return self._get_frame('get_tiled_tuboid_series', info, what, fmt)
 
-        parent_images = pd.DataFrame(parent_images)
+    def iter_image_series(self, info: InfoType, what: str = 'metadata', page_size: int = None):
+        """
+        Lazily iterates over image series, one page at a time (see ``get_image_series_page``).
+        Unlike ``get_image_series``, the whole series is never held in memory.
 
-        annots = self.get_uid_annotations_series(info, what=what_annotation)
+        :param info: A list of dicts, as in ``get_image_series``
+        :param what: The nature of the objects to retrieve, as in ``get_image_series``
+        :param page_size: the number of images requested at once
+        :return: a generator of images, formatted as in ``get_image_series``
+        """
+        return _iter_pages(self.get_image_series_page, info, what, page_size)
 
-        if len(annots) == 0:
-            annots = pd.DataFrame([], columns=['parent_image_id'])
-        else:
-            annots = pd.DataFrame(annots)
+    def iter_uid_annotations_series(self, info: InfoType, what: str = 'metadata', page_size: int = None):
+        """
+        Lazily iterates over annotation series, one page at a time (see ``get_uid_annotations_series_page``).
 
-        out = pd.merge(parent_images, annots, how='left', left_on=['id'], right_on=['parent_image_id'], suffixes=('', '_annot'))
-        # NaN -> None
-        out = out.where(pd.notnull(out), None).sort_values(['device', 'datetime'])
-        out = out.to_dict(orient='records')
-        return out
+        :param info: A list of dicts, as in ``get_uid_annotations_series``
+        :param what: The nature of the objects to retrieve, as in ``get_uid_annotations_series``
+        :param page_size: the number of annotations requested at once
+        :return: a generator of annotations, formatted as in ``get_uid_annotations_series``
+        """
+        return _iter_pages(self.get_uid_annotations_series_page, info, what, page_size)
 
     def get_tiled_tuboid_series_itc_labels(self, info: InfoType, what: str = "metadata") -> MetadataType:
 
@@ -140,34 +338,23 @@ class BaseClient(BaseAPISpec, ABC):
         if len(tiled_tuboids) == 0:
             logging.warning('No tuboids found for %s' % info)
             return []
-        itc_labels = pd.DataFrame(self._get_itc_labels([{'tuboid_id': i} for i in tiled_tuboids.tuboid_id]))
-
-        if len(itc_labels) == 0:
-            logging.warning('No ITC labels found for %s' % info)
-            out = tiled_tuboids
-        else:
-            # force suffixes for ITC
-            itc_labels.columns = itc_labels.columns.map(lambda x: str(x) + '_itc')
-            tiled_tuboids.set_index(['id'], inplace=True)
-            itc_labels.set_index(['parent_tuboid_id_itc'], inplace=True)
+        itc_labels = self._get_itc_labels([{'tuboid_id': i} for i in tiled_tuboids.tuboid_id])
+        return merge_tiled_tuboids_and_itc_labels(tiled_tuboids, itc_labels)
 
-            out = pd.merge(tiled_tuboids, itc_labels,
-                           how='left', left_index=True, right_index=True)
-
-        out = out.where(pd.notnull(out), None) #.sort_values(['device', 'datetime'])
-        out = out.to_dict(orient='records')
-        return out
-
-    def put_images(self, files: List[str]) -> MetadataType:
+    def put_images(self, files: List[str], validate: bool = True) -> MetadataType:
         """
         Incrementally upload a list of client files
 
         :param files: the paths to the client files
-        :return: the data of the uploaded files, as represented in by API
+        :param validate: whether to check that the files are complete JPEGs, with valid headers, before uploading them.
+            This is cheap, as the images are not decoded
+        :return: the data of the uploaded files, as represented in by API.
+            Files that failed to upload are represented by a dictionary with the keys ``'filename'`` and ``'error'``
         """
         # instead of dealing with images one by one, we send them by chunks
         # first find which files need to be uploaded
         to_upload = []
+        invalid = []
         chunk_size = self._put_chunk_size * self._n_threads
 
         for i, group in enumerate(chunker(files, chunk_size)):
@@ -175,11 +362,13 @@ class BaseClient(BaseAPISpec, ABC):
                                                                                          i * chunk_size + len(group),
                                                                                          len(files)))
 
-            to_upload += self._diff_images_to_upload(group)
+            group_to_upload, group_invalid = self._diff_images_to_upload(group, validate)
+            to_upload += group_to_upload
+            invalid += group_invalid
 
         if len(to_upload) == 0:
             logging.warning('No image to upload!')
-        out = []
+        out = invalid
         # upload by chunks now
         for i, group in enumerate(chunker(to_upload, self._put_chunk_size)):
             logging.info("Putting images - step 2/2 ... Uploading files %i-%i / %i" % (i*self._put_chunk_size,
@@ -187,31 +376,17 @@ class BaseClient(BaseAPISpec, ABC):
                                                                            len(to_upload)))
 
             out += self._put_new_images(group)
+        for o in out:
+            if 'error' in o:
+                logging.error("Failed to upload %s: %s" % (o['filename'], o['error']))
         logging.info("Putting images... Complete!")
         return out
 
     def put_tiled_tuboids(self, tuboid_directories: List[str], series_info: Dict[str, Any]):
 
-        def parse_tuboid_dir(directory):
-            dirname = os.path.basename(os.path.normpath(directory))
-
-            metadata_file = os.path.join(directory, 'metadata.txt')
-            tuboid_file = os.path.join(directory, 'tuboid.jpg')
-            context_file = os.path.join(directory, 'context.jpg')
-            assert len(dirname.split('.')) == 5  # 5 fields in this dir
-            assert os.path.isfile(metadata_file)
-            assert os.path.isfile(context_file)
-            assert os.path.isfile(tuboid_file)
-            assert all([k in series_info.keys() for k in ('algo_name', 'algo_version', 'start_datetime', 'end_datetime', 'device', 'n_images', )])
-
-            return {'tuboid_id': dirname,
-                    'series_info': series_info,
-                    'metadata': metadata_file,
-                    'tuboid': tuboid_file,
-                    'context': context_file}
         out = []
         for i, group in enumerate(chunker(tuboid_directories, self._put_chunk_size)):
-            to_upload = [parse_tuboid_dir(g) for g in group]
+            to_upload = [tuboid_dir_info(g, series_info) for g in group]
             logging.info("Putting tuboids... Uploading files %i-%i / %i" % (i*self._put_chunk_size,
                                                                             i * self._put_chunk_size + len(group),
                                                                             len(tuboid_directories)))
@@ -223,7 +398,15 @@ class BaseClient(BaseAPISpec, ABC):
     def delete_cache(self):
         self._cache.delete()
 
-    def _diff_images_to_upload(self, files):
+    def clean_cache(self) -> int:
+        """
+        Removes, from the cache, the statistics of the local files that no longer exist.
+
+        :return: the number of removed entries
+        """
+        return self._cache.evict_missing()
+
+    def _diff_images_to_upload(self, files, validate: bool = True):
         """
         Handles the negotiation process during upload. First trying to get the images to be uploaded,
         First gets the images to be sent. Those that already exists and have the same checksum can be skipped,
@@ -231,61 +414,71 @@ class BaseClient(BaseAPISpec, ABC):
 
         :param files: A list of file paths
         :type files: List()
-        :return: A list representing the subset of files to be uploaded
-        :rtype: List()
+        :param validate: whether to reject the files that are not valid JPEGs, see ``ImageParser.file_stats``
+        :return: A tuple: a list representing the subset of files to be uploaded,
+            and a list of ``{'filename', 'error'}`` for the invalid files
+        :rtype: (List(), List())
         """
+        info, invalid = _split_invalid_images(self._local_images_info(files, validate))
+        # the API tells which images it already has
+        statuses = self.diff_images(self._diff_query(info)) if info else []
+        return self._images_to_upload(info, statuses), invalid
 
+    def _local_images_info(self, files, validate: bool = True):
+        """
+        Computes (or retrieves from the cache) the statistics of local image files.
+        Images are not decoded: the device and datetime are parsed from the filename, and the md5 is streamed.
 
-        def local_img_stats(file: str, file_stats: float):
-            i = ImageParser(file)
-            out_ = {(file, file_stats):
-                            {'device': i['device'],
-                            'datetime': i['datetime'],
-                            'md5': i['md5'],
-                            'url': file}}
-            return out_
-
-        # we can compute the stats in parallel
-        cached_results = []
-        to_compute = []
+        :param files: A list of file paths
+        :param validate: whether to check that the files are valid JPEGs, see ``ImageParser.file_stats``
+        :return: A list of dict with the keys ``'device'``, ``'datetime'``, ``'md5'`` and ``'url'`` (the file path).
+            Invalid files have the keys ``'url'`` and ``'error'`` instead
+        """
 
-        for f in files:
-            key = f, os.path.getmtime(f)
+        def local_img_stats(file: str, validate: bool):
             try:
-                res = {key: self._cache.get_cached(local_img_stats, key)}
-                cached_results.append(res)
-            except KeyError as e:
-                to_compute.append(key)
+                i = ImageParser.file_stats(file, validate=validate)
+            except ValueError as e:
+                return {'url': file, 'error': str(e)}
+            return {'device': i['device'],
+                    'datetime': i['datetime'],
+                    'md5': i['md5'],
+                    'url': file}
+
+        keys = []
+        for f in files:
+            st = os.stat(f)
+            keys.append((f, st.st_mtime, st.st_size))
+        cached = self._cache.get_cached(local_img_stats, keys, variant=validate)
+        to_compute = [k for k in keys if k not in cached]
 
+        # we can compute the stats in parallel
         if self._n_threads > 1:
-            computed = Parallel(n_jobs=self._n_threads)(delayed(local_img_stats)(*tc) for tc in to_compute)
+            computed = Parallel(n_jobs=self._n_threads)(delayed(local_img_stats)(k[0], validate) for k in to_compute)
         else:
-            computed = [local_img_stats(*tc) for tc in to_compute]
-
-        logging.info('Caching %i image stats (%i already pre-computed)' % (len(computed), len(cached_results)))
-
-        self._cache.add(local_img_stats, computed)
-
-        computed += cached_results
-
-        # we request these images from the database
-        info = [list(imd.values())[0] for imd in computed]
-        matches = self.get_images(info, what='metadata')
-
-        # now we diff: we ignore images that exist on DB AND have the same md5
-        # we put images that do not exist on db
-        # we warn if md5s are different
-        info = pd.DataFrame(info)
-        matches = pd.DataFrame(matches, columns=info.columns)
-
-        joined = pd.merge(info, matches, how='left', on = ['device', 'datetime'], suffixes=('', '_match'))
-        joined['same_md5'] = joined.apply(lambda row: row.md5_match == row.md5, axis=1)
-        joined['already_on_db'] = joined.apply(lambda row: not pd.isna(row.md5_match), axis=1)
-        # images that re not yet on the db:
-        out = joined[joined.already_on_db == False].url.tolist()
-
-        # fixme. warn/prompt which has a different md5 (and match md5 is not NA)
-        return out
+            computed = [local_img_stats(k[0], validate) for k in to_compute]
+
+        logging.info('Caching %i image stats (%i already pre-computed)' % (len(computed), len(cached)))
+        computed = dict(zip(to_compute, computed))
+        self._cache.add(local_img_stats, computed, variant=validate)
+
+        cached.update(computed)
+        return [cached[k] for k in keys]
+
+    @staticmethod
+    def _diff_query(info):
+        # the API only needs the keys and checksums of the images
+        return [{'device': i['device'], 'datetime': i['datetime'], 'md5': i['md5']} for i in info]
+
+    @staticmethod
+    def _images_to_upload(info, statuses):
+        # we put images that do not exist on db, and ignore the ones that exist (with the same md5)
+        # fixme. prompt which have a different md5
+        urls = pd.Series([i['url'] for i in info], dtype=object)
+        statuses = pd.Series(statuses, dtype=object)
+        for url in urls[statuses == 'md5_mismatch']:
+            logging.warning("%s is already on the database, with a different md5. Not uploading it" % url)
+        return urls[statuses == 'absent'].tolist()
 
     def get_ml_bundle_dir(self, bundle_name: str, bundle_dir: str, what: str) -> List[Dict[str, Union[float, str]]]:
         assert os.path.basename(os.path.normpath(bundle_dir)) == bundle_name
@@ -314,9 +507,10 @@ class BaseClient(BaseAPISpec, ABC):
             os.utime(os.path.join(bundle_dir, f['key']), (time.time(), f['mtime']))
 
 
+        # downloads are IO bound, so threads are enough, and they can share the HTTP connections
         if self._n_threads > 1:
-            Parallel(n_jobs=self._n_threads)(delayed(download_single_file)(self.__class__, f, bundle_dir)
-                                                        for f in files_to_download)
+            Parallel(n_jobs=self._n_threads, prefer='threads')(
+                delayed(download_single_file)(self.__class__, f, bundle_dir) for f in files_to_download)
         else:
             for f in files_to_download:
                 download_single_file(self.__class__, f, bundle_dir)
@@ -353,6 +547,9 @@ class BaseClient(BaseAPISpec, ABC):
 
 @decorate_all_methods(python_inputs_to_json, exclude=['__init__'])
 class LocalClient(LocalAPI, BaseClient):
+    # the API methods convert their inputs, so the client does not need to make them json-compatible first
+    _python_native_inputs = True
+
     def __init__(self, local_dir: str, n_threads: int = 8, *args, **kwargs):
         # ad hoc API config for the local API. define the local_dir variable
         api_conf = LocalAPIConf(LOCAL_DIR=local_dir)
@@ -381,14 +578,50 @@ class RemoteAPIException(Exception):
     pass
 
 
+# one pool of HTTP sessions per process, as sessions cannot be shared between forked processes
+_http_sessions = {}
+
+
+def pooled_http_session(pool_size: int) -> requests.Session:
+    """
+    A persistent HTTP session, with keep-alive and connection pooling, shared by all the threads of a process.
+
+    :param pool_size: the maximal number of connections to keep open, per host
+    :return: a session, created on first use in the current process
+    """
+    key = (os.getpid(), pool_size)
+    if key not in _http_sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_sessions[key] = session
+    return _http_sessions[key]
+
+
 # all the client methods may take python argument, the argument are implicitly transformed
 # to json-compatible values using this decorator
-@decorate_all_methods(python_inputs_to_json, exclude=['__init__', '_default_client_to_api'])
+@decorate_all_methods(python_inputs_to_json, exclude=['__init__', '_default_client_to_api', '_http_session'])
 class RemoteAPIConnector(BaseAPISpec):
     _max_retry_attempts = 5
     _sleep_time_between_attempts = 1
+    # the maximal size of the images sent in one upload request.
+    # It must stay below the `client_max_body_size` of the server (nginx)
+    _put_max_request_size = 64 * 1024 * 1024
 
-    def __init__(self, host: str, username: str, password: str, protocol: str = 'https', port: int = 443):
+    def __init__(self, host: str, username: str, password: str, protocol: str = 'https', port: int = 443,
+                 pool_size: int = 16):
+        """
+        Connects to a remote API.
+
+        :param host: the hostname of the API
+        :param username: the name of the API user
+        :param password: the password of the API user
+        :param protocol: either ``'https'`` or ``'http'``
+        :param port: the port of the API
+        :param pool_size: the number of HTTP connections kept alive, and shared between threads
+        """
+        self._pool_size = pool_size
         self._host = host
         self._username = username
         self._password = password
@@ -396,7 +629,8 @@ class RemoteAPIConnector(BaseAPISpec):
         self._port = int(port)
         self._token = {'token': None, 'expiration': 0}
 
-    def _default_client_to_api(self, entry_point, info=None, what: str = None, files=None, attempt=0):
+    def _default_client_to_api(self, entry_point, info=None, what: str = None, files=None, attempt=0,
+                               fmt: str = None):
 
         if entry_point != 'get_token':
             if self._token['expiration'] < int(time.time()) + 60:  # we add 60s just to be sure
@@ -409,8 +643,12 @@ class RemoteAPIConnector(BaseAPISpec):
         if what is not None:
             url += "/" + what
         logging.debug('Requesting %s' % url)
-        response = requests.post(url, json=info, files=files, auth=auth)
+        # a columnar format (see `sticky_pi_api.columnar`) is negotiated with the `Accept` header
+        headers = {'Accept': MIMETYPES[fmt]} if fmt is not None else None
+        response = self._http_session().post(url, json=info, files=files, auth=auth, headers=headers)
         if response.status_code == 200:
+            if fmt is not None:
+                return columnar.decode(response.content, fmt)
             return response.json(object_hook=json_out_parser)
         else:
 
@@ -421,25 +659,37 @@ class RemoteAPIConnector(BaseAPISpec):
                 time.sleep(self._sleep_time_between_attempts * self._max_retry_attempts)
                 attempt += 1
                 if files is not None:
-                    for k in files.keys():
+                    values = files.values() if isinstance(files, dict) else [v for _, v in files]
+                    for v in values:
                         try:
-                            files[k].seek(0)
+                            v.seek(0)
                         except AttributeError:
                             try:
-                                files[k][1].seek(0)
+                                v[1].seek(0)
                             except AttributeError:
                                 pass
                 logging.warning("Failed to request url: %s. Retrying... Attempt %i" % (url, attempt))
-                return self._default_client_to_api(entry_point, info, what, files, attempt)
+                return self._default_client_to_api(entry_point, info, what, files, attempt, fmt)
+
+    def _http_session(self) -> requests.Session:
+        return pooled_http_session(self._pool_size)
 
     def get_token(self, client_info: Dict[str, Any] = None) -> str:
         return self._default_client_to_api('get_token', info=None)
 
+    def _get_frame(self, entry_point: str, info: InfoType, what: str, fmt: str) -> pd.DataFrame:
+        return self._default_client_to_api(entry_point, info, what=what, fmt=fmt)
+
     def _put_new_images(self, files: List[str], client_info: Dict[str, Any] = None) -> MetadataType:
+        # files are sent in as few multipart requests as possible,
+        # each request being at most `_put_max_request_size` bytes (unless a single file is larger)
+        requests_files = _size_bounded_groups(files, [os.path.getsize(f) for f in files], self._put_max_request_size)
         out = []
-        for file in files:
-            with open(file, 'rb') as f:
-                payload = {os.path.basename(file): f}
+        for group in requests_files:
+            with ExitStack() as stack:
+                # all the files share the same field name, so files with the same basename are kept distinct
+                payload = [('images', (os.path.basename(file), stack.enter_context(open(file, 'rb'))))
+                           for file in group]
                 out += self._default_client_to_api('_put_new_images', files=payload)
         return out
 
@@ -453,9 +703,17 @@ class RemoteAPIConnector(BaseAPISpec):
     def get_images(self, info: InfoType, what: str = 'metadata', client_info: Dict[str, Any] = None) -> MetadataType:
         return self._default_client_to_api('get_images', info, what=what)
 
+    def diff_images(self, info: MetadataType, client_info: Dict[str, Any] = None) -> List[str]:
+        return self._default_client_to_api('diff_images', info)
+
     def get_image_series(self, info, what: str = 'metadata', client_info: Dict[str, Any] = None) -> MetadataType:
         return self._default_client_to_api('get_image_series', info, what=what)
 
+    def get_image_series_page(self, info, what: str = 'metadata', cursor: str = None, page_size: int = None,
+                              client_info: Dict[str, Any] = None) -> Dict[str, Any]:
+        return self._default_client_to_api('get_image_series_page',
+                                           {'info': info, 'cursor': cursor, 'page_size': page_size}, what=what)
+
     def delete_images(self, info: InfoType, client_info: Dict[str, Any] = None) -> MetadataType:
         return self._default_client_to_api('delete_images', info)
 
@@ -468,23 +726,40 @@ class RemoteAPIConnector(BaseAPISpec):
     def get_uid_annotations(self, info: InfoType, what: str = 'metadata', client_info: Dict[str, Any] = None) -> MetadataType:
         return self._default_client_to_api('get_uid_annotations', info, what=what)
 
+    def get_image_series_summary(self, info: InfoType, what: str = 'day',
+                                 client_info: Dict[str, Any] = None) -> MetadataType:
+        return self._default_client_to_api('get_image_series_summary', info, what=what)
+
+    def get_daily_rollups(self, info: InfoType, client_info: Dict[str, Any] = None) -> MetadataType:
+        return self._default_client_to_api('get_daily_rollups', info)
+
+    def get_images_with_uid_annotations_series(self, info: InfoType, what_image: str = 'metadata',
+                                               what_annotation: str = 'metadata', columnar: bool = False,
+                                               client_info: Dict[str, Any] = None):
+        return self._default_client_to_api('get_images_with_uid_annotations_series',
+                                           {'info': info, 'columnar': columnar},
+                                           what='%s/%s' % (what_image, what_annotation))
+
     def get_uid_annotations_series(self, info: InfoType, what: str = 'metadata', client_info: Dict[str, Any] = None) -> MetadataType:
         return self._default_client_to_api('get_uid_annotations_series', info, what=what)
 
+    def get_uid_annotations_series_page(self, info: InfoType, what: str = 'metadata', cursor: str = None,
+                                        page_size: int = None, client_info: Dict[str, Any] = None) -> Dict[str, Any]:
+        return self._default_client_to_api('get_uid_annotations_series_page',
+                                           {'info': info, 'cursor': cursor, 'page_size': page_size}, what=what)
+
     def get_tiled_tuboid_series(self, info: InfoType, what: str = "metadata", client_info: Dict[str, Any] = None) \
             -> MetadataType:
         return self._default_client_to_api('get_tiled_tuboid_series', info=info, what=what)
 
     def _put_tiled_tuboids(self, files: List[Dict[str, str]], client_info: Dict[str, Any] = None) -> MetadataType:
+        # as for images, tuboids are sent in as few requests as possible (see `tuboid_form_parts`)
         out = []
-        for dic in files:
-            with open(dic['metadata'], 'r') as m, open(dic['tuboid'], 'rb') as t, open(dic['context'], 'rb') as c:
-                payload = {'metadata': ('metadata.txt', m,  'application/text'),
-                           'tuboid': ('tuboid.jpg', t,  'application/octet-stream'),
-                           'context': ('context.jpg', c,  'application/octet-stream'),
-                           'tuboid_id': ('tuboid_id', json.dumps(dic['tuboid_id']), 'application/json'),
-                           'series_info': ('series_info', json.dumps(dic['series_info']), 'application/json'),
-                           }
+        for group in _size_bounded_groups(files, [_tuboid_size(f) for f in files], self._put_max_request_size):
+            with ExitStack() as stack:
+                payload = [(name, (filename, stack.enter_context(open(content, 'rb'))
+                                   if isinstance(content, str) else content, content_type))
+                           for name, filename, content, content_type in tuboid_form_parts(group)]
                 out += self._default_client_to_api('_put_tiled_tuboids', files=payload, info=None)
         return out
 
@@ -504,9 +779,11 @@ class RemoteAPIConnector(BaseAPISpec):
 
 @decorate_all_methods(python_inputs_to_json, exclude=['__init__'])
 class RemoteClient(RemoteAPIConnector, BaseClient):
-    def __init__(self, local_dir: str, host, username, password, protocol: str = 'https', port: int = 443,  n_threads: int = 8):
+    _download_pool_size = 16  # the download threads share this many connections
+    def __init__(self, local_dir: str, host, username, password, protocol: str = 'https', port: int = 443,
+                 n_threads: int = 8, pool_size: int = 16):
         BaseClient.__init__(self, local_dir=local_dir, n_threads=n_threads)
-        RemoteAPIConnector.__init__(self, host, username, password, protocol, port)
+        RemoteAPIConnector.__init__(self, host, username, password, protocol, port, pool_size)
 
     def _put_ml_bundle_file(self, path: str, url: Union[str, Dict]):
         #fixme,  name this is actually not a url here, but a json str => dict
@@ -515,7 +792,7 @@ class RemoteClient(RemoteAPIConnector, BaseClient):
         logging.info("%s => %s" % (os.path.basename(path), response['fields']['key']))
         with open(path, 'rb') as f:
             files = {'file': (object_name, f)}
-            http_response = requests.post(response['url'], data=response['fields'], files=files)
+            http_response = self._http_session().post(response['url'], data=response['fields'], files=files)
         assert http_response.status_code == 204, response
 
     @classmethod
@@ -530,7 +807,7 @@ class RemoteClient(RemoteAPIConnector, BaseClient):
         target_tmp = target + ".tmp"
         with open(target_tmp, 'wb') as data:
             logging.info("%s => %s" % (url, target))
-            r = requests.get(url)
+            r = pooled_http_session(cls._download_pool_size).get(url)
             data.write(r.content)
         from sticky_pi_api.utils import md5
 
@@ -0,0 +1,136 @@
+"""
+Columnar (Apache Arrow) encoding of the metadata returned by the API.
+Unlike JSON, columns are typed (e.g. datetimes are timestamps and decimals are decimals),
+and column names are not repeated for each row, so responses can be read as data frames directly.
+Two formats are available: the Arrow IPC stream format, and Parquet. Both require ``pyarrow``.
+"""
+
+import io
+import datetime
+import decimal
+import pandas as pd
+from sqlalchemy import DateTime, Numeric, Float, Integer, Boolean, String
+from sticky_pi_api.types import List, Dict, Any
+from sticky_pi_api.database.images_table import Images
+from sticky_pi_api.database.uid_annotations_table import UIDAnnotations
+from sticky_pi_api.database.tiled_tuboids_table import TiledTuboids
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MIMETYPE = 'application/vnd.apache.parquet'
+MIMETYPES = {'arrow': ARROW_MIMETYPE, 'parquet': PARQUET_MIMETYPE}
+
+# the API methods that can return columnar data, and the tables that define their columns
+SERIES_TABLES = {'get_image_series': [Images],
+                 'get_uid_annotations_series': [UIDAnnotations],
+                 'get_tiled_tuboid_series': [TiledTuboids]}
+
+
+def _check_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Columnar formats require `pyarrow'. Install it with `pip install pyarrow'")
+
+
+def _arrow_type(column_type):
+    # the arrow type of a sqlalchemy column type. None if unknown
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, Float):
+        return pyarrow.float64()
+    if isinstance(column_type, Numeric):
+        return pyarrow.decimal128(column_type.precision, column_type.scale)
+    if isinstance(column_type, Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    if isinstance(column_type, String):
+        return pyarrow.string()
+    return None
+
+
+def _infer_type(values):
+    # the type of a column that is not in a table, from its first non-null value
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, datetime.datetime):
+            return pyarrow.timestamp('us')
+        if isinstance(v, decimal.Decimal):
+            return None
+        if isinstance(v, str):
+            return pyarrow.string()
+        return None
+    return pyarrow.string()
+
+
+def to_arrow_table(rows: List[Dict[str, Any]], tables: List = ()) -> 'pyarrow.Table':
+    """
+    Makes an arrow table from rows, as returned by the API.
+
+    :param rows: a list of dictionaries, that all have the same keys
+    :param tables: the database classes (e.g. ``Images``) whose columns are in the rows. They define the types of
+        their columns. The types of the other columns are inferred
+    :return: an arrow table, with one column per key
+    """
+    _check_pyarrow()
+    known_types = {}
+    for t in tables:
+        for c in t.__table__.columns:
+            known_types.setdefault(c.name, _arrow_type(c.type))
+    names = list(rows[0].keys()) if rows else [n for n, t in known_types.items() if t is not None]
+    columns = []
+    for n in names:
+        values = [r.get(n) for r in rows]
+        type_ = known_types[n] if n in known_types else _infer_type(values)
+        if type_ is not None and pyarrow.types.is_decimal(type_):
+            # e.g. sqlite stores decimals as floats, so they can have more digits than the column
+            exponent = decimal.Decimal(1).scaleb(-type_.scale)
+            values = [None if v is None else decimal.Decimal(v).quantize(exponent) for v in values]
+        columns.append(pyarrow.array(values, type=type_))
+    return pyarrow.Table.from_arrays(columns, names=names)
+
+
+def encode(rows: List[Dict[str, Any]], fmt: str, tables: List = ()) -> bytes:
+    """
+    Encodes rows in a columnar format.
+
+    :param rows: a list of dictionaries, as returned by the API
+    :param fmt: either ``'arrow'`` (Arrow IPC stream) or ``'parquet'``
+    :param tables: the database classes that define the types of the columns, as in ``to_arrow_table``
+    :return: the encoded table
+    """
+    table = to_arrow_table(rows, tables)
+    sink = io.BytesIO()
+    if fmt == 'arrow':
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif fmt == 'parquet':
+        pyarrow.parquet.write_table(table, sink)
+    else:
+        raise ValueError("Unknown columnar format `%s'. Should be one of %s" % (fmt, list(MIMETYPES)))
+    return sink.getvalue()
+
+
+def decode(content: bytes, fmt: str) -> pd.DataFrame:
+    """
+    Decodes a columnar response to a data frame.
+
+    :param content: the encoded table
+    :param fmt: either ``'arrow'`` (Arrow IPC stream) or ``'parquet'``
+    :return: a data frame, with one row per object
+    """
+    _check_pyarrow()
+    if fmt == 'arrow':
+        table = pyarrow.ipc.open_stream(content).read_all()
+    elif fmt == 'parquet':
+        table = pyarrow.parquet.read_table(io.BytesIO(content))
+    else:
+        raise ValueError("Unknown columnar format `%s'. Should be one of %s" % (fmt, list(MIMETYPES)))
+    return table.to_pandas()
@@ -57,9 +57,24 @@ class RemoteAPIConf(BaseAPIConf):
         'S3_ACCESS_KEY': RequiredConfVar(),
         'S3_PRIVATE_KEY': RequiredConfVar(),
         'S3_BUCKET_NAME': RequiredConfVar(),
+        'S3_REGION': None,  # `us-east-1` by default
+        'S3_THREADS': None,  # the number of threads putting and deleting S3 objects. 0 (default) does it serially
 
         'MYSQL_HOST': RequiredConfVar(),
         'MYSQL_USER': RequiredConfVar(),
         'MYSQL_PASSWORD': RequiredConfVar(),
-        'MYSQL_DATABASE': RequiredConfVar()
+        'MYSQL_DATABASE': RequiredConfVar(),
+
+        # see `sticky_pi_api.url_cache.make_url_cache`
+        'URL_CACHE': None,
+        'URL_CACHE_SIZE': None,
+        'URL_CACHE_PATH': None,
+
+        # the number of threads making thumbnails after uploads. 0 (default) makes them during the upload
+        'THUMBNAIL_WORKERS': None,
+        # whether to parse uploaded images with a single, downscaled, decode. See `sticky_pi_api.image_parser.ImageParser`
+        'FAST_IMAGE_PARSING': None,
+        # the number of processes parsing uploaded images, and of threads storing them. 0 (default) does it serially
+        'INGESTION_PROCESSES': None,
+        'STORAGE_THREADS': None
     }
@@ -0,0 +1,43 @@
+from sqlalchemy import Integer, DateTime, String, Float, Text, UniqueConstraint
+from sticky_pi_api.database.utils import BaseCustomisations, DescribedColumn
+
+
+class DailyRollups(BaseCustomisations):
+    __tablename__ = 'daily_rollups'
+    __table_args__ = (UniqueConstraint('device', 'datetime', name='rollup_id'),)
+
+    id = DescribedColumn(Integer, primary_key=True)
+    device = DescribedColumn(String(8), nullable=False,
+                             description="The device that took the images")
+    datetime = DescribedColumn(DateTime, nullable=False,
+                               description="The start of the day")
+    n_images = DescribedColumn(Integer, nullable=False,
+                               description="The number of images")
+    n_annotated = DescribedColumn(Integer, nullable=False,
+                                  description="The number of images with, at least, one annotation")
+    n_objects = DescribedColumn(Integer, nullable=True,
+                                description="The sum of the number of objects of the latest annotation of each image")
+    temp_mean = DescribedColumn(Float, nullable=True, description="The mean of valid temperature readings")
+    temp_min = DescribedColumn(Float, nullable=True, description="The minimum of valid temperature readings")
+    temp_max = DescribedColumn(Float, nullable=True, description="The maximum of valid temperature readings")
+    hum_mean = DescribedColumn(Float, nullable=True, description="The mean of valid humidity readings")
+    hum_min = DescribedColumn(Float, nullable=True, description="The minimum of valid humidity readings")
+    hum_max = DescribedColumn(Float, nullable=True, description="The maximum of valid humidity readings")
+    annotations = DescribedColumn(Text, nullable=False,
+                                  description="A json list of the annotations of the day, per algorithm version. "
+                                              "Each element has the keys `algo_name`, `algo_version`, "
+                                              "`n_annotations` and `n_objects`")
+
+    def __init__(self, info, api_user=None):
+        """
+        A summary of the images of a device during a day. Rollups are recomputed when images, or their annotations,
+        are added or deleted, so overviews do not need to aggregate over all the images.
+
+        :param info: a dictionary with the columns of the rollup
+        :param api_user: the user whose action updated the rollup
+        """
+        column_names = DailyRollups.column_names()
+        super().__init__(api_user=api_user, **{k: v for k, v in info.items() if k in column_names})
+
+    def __repr__(self):
+        return "<DailyRollup(device='%s', datetime='%s', n_images=%i)>" % (self.device, self.datetime, self.n_images)
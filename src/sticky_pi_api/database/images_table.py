@@ -52,11 +52,22 @@ class Images(BaseCustomisations):
     no_flash_bv = DescribedColumn(Float, nullable=False)
     no_flash_iso = DescribedColumn(Float, nullable=False)
 
-    def __init__(self, file, api_user=None):
-        parser = ImageParser(file)
+    # Nullable, for images uploaded before thumbnails could be deferred (which all have thumbnails)
+    thumbnail_status = DescribedColumn(String(8), nullable=True,
+                                       description="Whether the thumbnails of the image are "
+                                                   "`'ready'`, `'pending'` or `'failed'`")
+
+    def __init__(self, file, api_user=None, thumbnails: bool = True, fast: bool = False):
+        # images can be parsed beforehand (e.g. in another process)
+        if isinstance(file, ImageParser):
+            parser = file
+        else:
+            parser = ImageParser(file, thumbnails=thumbnails, fast=fast)
         self._file_blob = parser.file_blob
         self._thumbnail = parser.thumbnail
         self._thumbnail_mini = parser.thumbnail_mini
+        self._thumbnail_jpeg = parser.thumbnail_jpeg
+        self._thumbnail_mini_jpeg = parser.thumbnail_mini_jpeg
 
         column_names = Images.column_names()
 
@@ -68,8 +79,22 @@ class Images(BaseCustomisations):
             else:
                 i_dict[k] = None
         i_dict['api_user'] = api_user
+        i_dict['thumbnail_status'] = 'ready' if thumbnails else 'pending'
         super().__init__(**i_dict)
 
+    def make_thumbnails(self, file_blob: bytes):
+        """
+        Generates the thumbnails of an image whose thumbnails were deferred
+
+        :param file_blob: the content of the JPEG file of the image
+        """
+        self._thumbnail, self._thumbnail_mini = ImageParser.make_thumbnails(file_blob)
+        self._thumbnail_jpeg, self._thumbnail_mini_jpeg = None, None
+
+    @property
+    def thumbnails_ready(self) -> bool:
+        return self.thumbnail_status in (None, 'ready')
+
 
     @property
     def filename(self):
@@ -87,6 +112,19 @@ class Images(BaseCustomisations):
     def thumbnail_mini(self):
         return self._thumbnail_mini
 
+    @property
+    def thumbnail_jpeg(self):
+        # thumbnails are encoded once, when they are first stored (unless they were encoded by the parser)
+        if getattr(self, '_thumbnail_jpeg', None) is None and getattr(self, '_thumbnail', None) is not None:
+            self._thumbnail_jpeg = ImageParser.to_jpeg(self._thumbnail)
+        return getattr(self, '_thumbnail_jpeg', None)
+
+    @property
+    def thumbnail_mini_jpeg(self):
+        if getattr(self, '_thumbnail_mini_jpeg', None) is None and getattr(self, '_thumbnail_mini', None) is not None:
+            self._thumbnail_mini_jpeg = ImageParser.to_jpeg(self._thumbnail_mini)
+        return getattr(self, '_thumbnail_mini_jpeg', None)
+
     def __repr__(self):
         return "<Image(device='%s', datetime='%s', md5='%s')>" % (
             self.device, self.datetime, self.md5)
@@ -0,0 +1,46 @@
+from sqlalchemy import Integer, DateTime, SmallInteger, String, Text
+from sticky_pi_api.database.utils import BaseCustomisations, DescribedColumn
+from sticky_pi_api.database.images_table import Images
+
+
+class StorageTombstones(BaseCustomisations):
+    __tablename__ = 'storage_tombstones'
+
+    id = DescribedColumn(Integer, primary_key=True)
+    device = DescribedColumn(String(8), nullable=False,
+                             description="The device of the deleted image")
+    datetime = DescribedColumn(DateTime, nullable=False,
+                               description="The datetime of the deleted image")
+    thumbnail_status = DescribedColumn(String(8), nullable=True,
+                                       description="The thumbnail status of the deleted image. "
+                                                   "Thumbnails that were not made have no file")
+    n_attempts = DescribedColumn(SmallInteger, nullable=False, default=0,
+                                 description="The number of failed attempts to delete the files of the image")
+    error = DescribedColumn(Text, nullable=True,
+                            description="The error of the last failed attempt")
+
+    def __init__(self, image: Images, api_user=None):
+        """
+        A record of an image that is deleted from the database, but whose files may still be in the storage.
+        Tombstones are written in the same transaction as the deletion of the images, and removed once the files are
+        deleted, so the files of images can always be cleaned up, even if the storage fails.
+
+        :param image: the deleted image
+        :param api_user: the user who deleted the image
+        """
+        super().__init__(api_user=api_user, device=image.device, datetime=image.datetime,
+                         thumbnail_status=image.thumbnail_status, n_attempts=0)
+
+    def image(self) -> Images:
+        """
+        :return: a transient image, with the key of the deleted image. Enough to find its files in the storage
+        """
+        image = Images.__mapper__.class_manager.new_instance()
+        image.device = self.device
+        image.datetime = self.datetime
+        image.thumbnail_status = self.thumbnail_status
+        return image
+
+    def __repr__(self):
+        return "<StorageTombstone(device='%s', datetime='%s', n_attempts=%s)>" % (
+            self.device, self.datetime, self.n_attempts)
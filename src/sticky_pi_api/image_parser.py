@@ -5,7 +5,9 @@ import PIL.ExifTags
 from imread import imread_from_blob
 from ast import literal_eval
 import datetime
-from sticky_pi_api.utils import md5, URLOrFileOpen
+import hashlib
+from io import BytesIO
+from sticky_pi_api.utils import md5, URLOrFileOpen, upload_name
 
 
 class ImageParser(dict):
@@ -13,15 +15,24 @@ class ImageParser(dict):
     _thumbnail_mini_size = (128, 96)
     # _timezone = pytz.timezone("UTC")
     _time_origin = datetime.datetime(2019, 11, 1)
+    _jpeg_soi = b'\xff\xd8'  # start of image marker
+    _jpeg_eoi = b'\xff\xd9'  # end of image marker
 
-    def __init__(self, file):
+    def __init__(self, file, thumbnails: bool = True, fast: bool = False):
         """
         A class derived from dict that contains image metadata in its fields.
         It parses data from an input JPEG image file taken by a Sticky Pi and retrieves its metadata
         from filename an exif fields. In addition, it computes md5 sum and generate thumbnails for the input image.
         :param file: path to file  or file like object
+        :param thumbnails: whether to generate the thumbnails. If ``False``, they can be made later,
+            with ``make_thumbnails``
+        :param fast: whether to decode the image only once, at reduced resolution. The file is read once,
+            and the thumbnails are decoded straight from the downscaled JPEG (draft mode). The full resolution image
+            is never decoded, so only the lower resolution is validated
         """
         super().__init__()
+        self._make_thumbnails = thumbnails
+        self._fast = fast
         if type(file) == str:
             with URLOrFileOpen(file, 'rb') as f:
                 self._parse(f)
@@ -31,7 +42,8 @@ class ImageParser(dict):
             raise TypeError('Unexpected type for file. Should be either a path or a file-like. file is %s' % type(file))
 
 
-    def _device_datetime_info(self, filename):
+    @classmethod
+    def _device_datetime_info(cls, filename):
         """
         Parse device id and datetime from the image filename.
 
@@ -62,7 +74,7 @@ class ImageParser(dict):
         except ValueError:
             raise Exception("Could not retrieve datetime from filename")
 
-        if date_time < self._time_origin:
+        if date_time < cls._time_origin:
             raise Exception("Image taken before the platform even existed")
 
 
@@ -70,48 +82,149 @@ class ImageParser(dict):
                 'datetime': date_time,
                 'filename': filename}
 
+    @classmethod
+    def file_stats(cls, file: str, validate: bool = True, chunk_size: int = 32768):
+        """
+        Computes the statistics of an image file that identify it, without decoding any pixel:
+        the device and datetime (from the filename) and the md5 sum (streamed).
+
+        :param file: the path to an image file
+        :param validate: whether to check that the file is a complete JPEG, with valid headers.
+            This does not decode the image, so it does not detect corrupted image data
+        :param chunk_size: the size of the chunks read to compute the md5 sum
+        :return: a dictionary with the keys ``'device'``, ``'datetime'``, ``'filename'`` and ``'md5'``
+        """
+        out = cls._device_datetime_info(os.path.basename(file))
+        hash_md5 = hashlib.md5()
+        with open(file, 'rb') as f:
+            head = f.read(chunk_size)
+            hash_md5.update(head)
+            tail = head
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hash_md5.update(chunk)
+                tail = tail[-chunk_size:] + chunk
+            if validate:
+                if not head.startswith(cls._jpeg_soi) or not tail.rstrip(b'\x00').endswith(cls._jpeg_eoi):
+                    raise ValueError("Not a valid/complete JPEG file: %s" % out['filename'])
+                f.seek(0)
+                # only parses the headers, up to the start of the image data
+                try:
+                    with PIL.Image.open(f):
+                        pass
+                except PIL.UnidentifiedImageError as e:
+                    raise ValueError("Not a valid JPEG file: %s. %s" % (out['filename'], e))
+        out['md5'] = hash_md5.hexdigest()
+        return out
+
     def _parse(self, file):
 
-        self._filename = os.path.basename(file.name)
+        self._filename = upload_name(file)
         self.update(self._device_datetime_info(self._filename))
+        if self._fast:
+            return self._parse_fast(file)
         self['md5'] = md5(file)
         # ensure the image is a jpeg
         try:
             self._file_blob = file.read()
-
+            # a truncated JPEG can make the decoder hang, so we check the start/end markers first
+            if not self._file_blob.startswith(self._jpeg_soi) or \
+                    not self._file_blob.rstrip(b'\x00').endswith(self._jpeg_eoi):
+                raise ValueError("Not a valid/complete JPEG file: %s" % self._filename)
             imread_from_blob(self._file_blob, 'jpg')
 
             with PIL.Image.open(file) as img:
-                exif_fields = {
-                    PIL.ExifTags.TAGS[k]: v
-                    for k, v in img._getexif().items()
-                    if k in PIL.ExifTags.TAGS
-                }
+                self._parse_exif(img)
+                if self._make_thumbnails:
+                    self._thumbnail, self._thumbnail_mini = self._thumbnails(img)
+                else:
+                    self._thumbnail, self._thumbnail_mini = None, None
+
+        finally:
+            file.seek(0)
 
-                self['width'] = img.width
-                self['height'] = img.height
+    def _parse_fast(self, file):
+        # one read, and one (downscaled) decode
+        try:
+            self._file_blob = file.read()
+        finally:
+            file.seek(0)
+        self['md5'] = hashlib.md5(self._file_blob).hexdigest()
+        if not self._file_blob.startswith(self._jpeg_soi) or \
+                not self._file_blob.rstrip(b'\x00').endswith(self._jpeg_eoi):
+            raise ValueError("Not a valid/complete JPEG file: %s" % self._filename)
 
-                img.thumbnail(self._thumbnail_size)
-                self._thumbnail = img.copy()
-                img.thumbnail(self._thumbnail_mini_size)
-                self._thumbnail_mini = img.copy()
-                custom_img_metadata = literal_eval(exif_fields['Make'])
+        # opening only reads the headers, so the metadata does not need any pixel
+        with PIL.Image.open(BytesIO(self._file_blob)) as img:
+            self._parse_exif(img)
+            if self._make_thumbnails:
+                self._thumbnail, self._thumbnail_mini = self._thumbnails(img, draft=True)
+            else:
+                # we still decode the smallest version of the image, to validate it
+                self._thumbnail, self._thumbnail_mini = None, None
+                img.draft('RGB', (img.width // 8, img.height // 8))
+                img.load()
 
-                # gps data not available -> None
-                if custom_img_metadata['lat'] == 0 and custom_img_metadata['lng'] == 0 and custom_img_metadata['alt'] == 0:
-                    custom_img_metadata['lat'] = custom_img_metadata['lng'] = custom_img_metadata['alt'] = None
+    def _parse_exif(self, img):
+        exif_fields = {
+            PIL.ExifTags.TAGS[k]: v
+            for k, v in img._getexif().items()
+            if k in PIL.ExifTags.TAGS
+        }
 
-                # these variables are expressed as a fractional tuple. We cast them to floats
-                for var in ["no_flash_" + v for v in ("shutter_speed", "exposure_time", "bv")]:
-                    custom_img_metadata[var] = custom_img_metadata[var][0] / \
-                                                        custom_img_metadata[var][1]
+        self['width'] = img.width
+        self['height'] = img.height
 
-                del custom_img_metadata['datetime']
+        custom_img_metadata = literal_eval(exif_fields['Make'])
 
-                self.update(custom_img_metadata)
+        # gps data not available -> None
+        if custom_img_metadata['lat'] == 0 and custom_img_metadata['lng'] == 0 and custom_img_metadata['alt'] == 0:
+            custom_img_metadata['lat'] = custom_img_metadata['lng'] = custom_img_metadata['alt'] = None
 
-        finally:
-            file.seek(0)
+        # these variables are expressed as a fractional tuple. We cast them to floats
+        for var in ["no_flash_" + v for v in ("shutter_speed", "exposure_time", "bv")]:
+            custom_img_metadata[var] = custom_img_metadata[var][0] / \
+                                                custom_img_metadata[var][1]
+
+        del custom_img_metadata['datetime']
+
+        self.update(custom_img_metadata)
+
+    @classmethod
+    def _thumbnails(cls, img, draft: bool = False):
+        if draft:
+            # the JPEG decoder downscales by up to 8, in the DCT domain, to the smallest size above the thumbnail's
+            img.draft('RGB', cls._thumbnail_size)
+        img.thumbnail(cls._thumbnail_size)
+        thumbnail = img.copy()
+        img.thumbnail(cls._thumbnail_mini_size)
+        return thumbnail, img.copy()
+
+    @classmethod
+    def make_thumbnails(cls, file_blob: bytes):
+        """
+        Generates the thumbnails of an image
+
+        :param file_blob: the content of a JPEG file
+        :return: a tuple of PIL images: the thumbnail and the mini thumbnail
+        """
+        with PIL.Image.open(BytesIO(file_blob)) as img:
+            return cls._thumbnails(img)
+
+    def encode_thumbnails(self):
+        """
+        Encodes the thumbnails to JPEG, and drops the decoded images.
+        This makes the parser much smaller to send to another process.
+        """
+        if self._thumbnail is not None:
+            self._thumbnail_jpeg = self.to_jpeg(self._thumbnail)
+            self._thumbnail_mini_jpeg = self.to_jpeg(self._thumbnail_mini)
+            self._thumbnail, self._thumbnail_mini = None, None
+
+    @staticmethod
+    def to_jpeg(img) -> bytes:
+        buffer = BytesIO()
+        img.save(buffer, format='jpeg')
+        return buffer.getvalue()
 
     @property
     def file_blob(self):
@@ -128,3 +241,30 @@ class ImageParser(dict):
     @property
     def thumbnail_mini(self):
         return self._thumbnail_mini
+
+    @property
+    def thumbnail_jpeg(self):
+        return getattr(self, '_thumbnail_jpeg', None)
+
+    @property
+    def thumbnail_mini_jpeg(self):
+        return getattr(self, '_thumbnail_mini_jpeg', None)
+
+
+def parse_image_file(file, name: str = None, thumbnails: bool = True, fast: bool = False) -> ImageParser:
+    """
+    Parses an image, and encodes its thumbnails. Meant to run in worker processes, so both the input
+    and the output can be pickled.
+
+    :param file: a path to an image, or the content of the image file
+    :param name: the name of the file, when ``file`` is its content
+    :param thumbnails: see ``ImageParser``
+    :param fast: see ``ImageParser``
+    :return: the parsed image, with JPEG encoded thumbnails
+    """
+    if isinstance(file, bytes):
+        file = BytesIO(file)
+        file.name = name
+    parser = ImageParser(file, thumbnails=thumbnails, fast=fast)
+    parser.encode_thumbnails()
+    return parser
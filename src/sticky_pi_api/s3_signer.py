@@ -0,0 +1,110 @@
+"""
+Computes presigned S3 ``GET`` urls locally, with AWS signature version 4 (query string authentication).
+All the urls of a batch share the same timestamp, so the signing key (derived once a day) and
+the canonical query string are only computed once. Each key then costs two SHA256 digests.
+See https://docs.aws.amazon.com/AmazonS3/latest/API/sigv4-query-string-auth.html
+"""
+
+import hmac
+import hashlib
+import datetime
+from urllib.parse import quote, urlparse
+from typing import Tuple
+from sticky_pi_api.types import List
+
+
+class S3URLSigner(object):
+    _algorithm = 'AWS4-HMAC-SHA256'
+    _date_format = '%Y%m%dT%H%M%SZ'
+    _max_expiration = 3600 * 24 * 7  # S3 does not accept longer validity
+
+    def __init__(self, access_key: str, secret_key: str, endpoint: str, bucket: str, region: str = 'us-east-1',
+                 expiration: int = 3600):
+        """
+        Signs path-style urls (i.e. ``<endpoint>/<bucket>/<key>``) to get objects from a bucket.
+
+        :param access_key: the S3 access key id
+        :param secret_key: the S3 secret key
+        :param endpoint: the url of the S3 server, e.g. ``'https://s3.example.com'``
+        :param bucket: the name of the bucket
+        :param region: the region of the bucket
+        :param expiration: the validity of the urls, in seconds
+        """
+        assert expiration <= self._max_expiration, "S3 urls cannot be valid for more than a week"
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._endpoint = endpoint.rstrip('/')
+        self._bucket = bucket
+        self._region = region
+        self._expiration = int(expiration)
+        self._host = urlparse(self._endpoint).netloc
+        self._signing_keys = {}
+
+    def _signing_key(self, date: str) -> bytes:
+        # only depends on the day, so we keep the last one
+        if date not in self._signing_keys:
+            key = ('AWS4' + self._secret_key).encode()
+            for msg in (date, self._region, 's3', 'aws4_request'):
+                key = hmac.new(key, msg.encode(), hashlib.sha256).digest()
+            self._signing_keys = {date: key}
+        return self._signing_keys[date]
+
+    def _query_string(self, amz_date: str) -> str:
+        # the canonical query string, without the signature. Parameters are sorted
+        credential = '%s/%s/%s/s3/aws4_request' % (self._access_key, amz_date[:8], self._region)
+        return '&'.join(['X-Amz-Algorithm=%s' % self._algorithm,
+                         'X-Amz-Credential=%s' % quote(credential, safe='-_.~'),
+                         'X-Amz-Date=%s' % amz_date,
+                         'X-Amz-Expires=%i' % self._expiration,
+                         'X-Amz-SignedHeaders=host'])
+
+    def url_prefix(self, key: str) -> str:
+        """
+        :param key: the key of an object in the bucket
+        :return: the url of the object, without query string
+        """
+        return '%s%s' % (self._endpoint, self._path(key))
+
+    def _path(self, key: str) -> str:
+        return quote('/%s/%s' % (self._bucket, key), safe='/-_.~')
+
+    def signatures(self, keys: List[str], now: datetime.datetime = None) -> Tuple[str, List[str]]:
+        """
+        Signs a list of keys, in one pass.
+
+        :param keys: the keys of objects in the bucket
+        :param now: the UTC time of the signature. Defaults to the current time
+        :return: a tuple: the timestamp of the signatures (``X-Amz-Date``) and the signature of each key
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        amz_date = now.strftime(self._date_format)
+        signing_key = self._signing_key(amz_date[:8])
+        scope = '%s/%s/s3/aws4_request' % (amz_date[:8], self._region)
+        string_to_sign_prefix = '%s\n%s\n%s\n' % (self._algorithm, amz_date, scope)
+        canonical_suffix = '\n%s\nhost:%s\n\nhost\nUNSIGNED-PAYLOAD' % (self._query_string(amz_date), self._host)
+
+        out = []
+        for key in keys:
+            canonical_request = 'GET\n' + self._path(key) + canonical_suffix
+            string_to_sign = string_to_sign_prefix + hashlib.sha256(canonical_request.encode()).hexdigest()
+            out.append(hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest())
+        return amz_date, out
+
+    def url(self, key: str, amz_date: str, signature: str) -> str:
+        """
+        :param key: the key of an object in the bucket
+        :param amz_date: the timestamp of the signature
+        :param signature: the signature of the key, as computed by ``signatures``
+        :return: the presigned url
+        """
+        return '%s?%s&X-Amz-Signature=%s' % (self.url_prefix(key), self._query_string(amz_date), signature)
+
+    def presigned_urls(self, keys: List[str], now: datetime.datetime = None) -> List[str]:
+        """
+        :param keys: the keys of objects in the bucket
+        :param now: the UTC time of the signature. Defaults to the current time
+        :return: a presigned url for each key
+        """
+        amz_date, signatures = self.signatures(keys, now)
+        return [self.url(k, amz_date, s) for k, s in zip(keys, signatures)]
@@ -3,9 +3,10 @@ import copy
 import logging
 import os
 import json
+import base64
 import sqlalchemy
-from sqlalchemy import or_, and_
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import or_, and_, func, case
+from sqlalchemy.orm import sessionmaker, aliased
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, BadSignature, SignatureExpired)
 # from multiprocessing.pool import Pool
@@ -13,24 +14,103 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import event
 import sqlite3
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from sticky_pi_api.utils import json_io_converter
-from sticky_pi_api.database.utils import Base
+from sticky_pi_api.database.utils import Base, BaseCustomisations
 from sticky_pi_api.storage import DiskStorage, BaseStorage, S3Storage
 from sticky_pi_api.configuration import BaseAPIConf
 from sticky_pi_api.database.images_table import Images
+from sticky_pi_api.image_parser import parse_image_file
 from sticky_pi_api.database.uid_annotations_table import UIDAnnotations
 from sticky_pi_api.types import InfoType, MetadataType, AnnotType, List, Union, Dict, Any
 from sticky_pi_api.database.users_tables import Users
 from sticky_pi_api.database.tuboid_series_table import TuboidSeries
 from sticky_pi_api.database.tiled_tuboids_table import TiledTuboids
 from sticky_pi_api.database.itc_labels_table import ITCLabels
+from sticky_pi_api.database.storage_tombstones_table import StorageTombstones
+from sticky_pi_api.database.daily_rollups_table import DailyRollups
 
-from sticky_pi_api.utils import chunker, json_inputs_to_python
+from sticky_pi_api.utils import chunker, json_inputs_to_python, json_out_parser, upload_name
 from decorate_all_methods import decorate_all_methods
 from abc import ABC, abstractmethod
 
 
+
+def _image_key_in(keys):
+    # Matches images against a list of (device, datetime) keys with one `datetime IN (...)` per device.
+    # Unlike an `OR` of one `AND` per image (slow to compile and plan) or a row-value `IN`
+    # (a full table scan on sqlite), this is an index lookup on `image_uid` for both sqlite and MySQL
+    datetimes_by_device = {}
+    for device, dt in keys:
+        datetimes_by_device.setdefault(device, []).append(dt)
+    return or_(*[and_(Images.device == device, Images.datetime.in_(dts))
+                 for device, dts in datetimes_by_device.items()])
+
+
+def _latest_annotation_outerjoin(q, annot, newer):
+    # left-joins images to their latest annotation: the one without a newer annotation
+    # (higher `algo_version`, or, for equal versions, higher id). Queries must filter on `newer.id.is_(None)`
+    return q.outerjoin(annot, annot.parent_image_id == Images.id).outerjoin(
+        newer, and_(newer.parent_image_id == annot.parent_image_id,
+                    or_(newer.algo_version > annot.algo_version,
+                        and_(newer.algo_version == annot.algo_version, newer.id > annot.id))))
+
+
+# as in the webapp, sensors report failures as out of range values
+_valid_temp = case([(Images.temp > -300, Images.temp)])
+_valid_hum = case([(Images.hum > 0, Images.hum)])
+
+# the formats of the start of time buckets
+_time_bucket_formats = {'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d 00:00:00'}
+
+
+def _time_bucket(column, bucket: str, dialect: str):
+    # the start of the time bucket of a datetime column, as a string
+    if bucket not in _time_bucket_formats:
+        raise ValueError("Unexpected time bucket: %s. Should be in %s" % (bucket, list(_time_bucket_formats)))
+    if dialect == 'sqlite':
+        return func.strftime(_time_bucket_formats[bucket], column)
+    if dialect == 'mysql':
+        return func.date_format(column, _time_bucket_formats[bucket])
+    raise NotImplementedError("Time buckets are not implemented for %s" % dialect)
+
+
+def _parse_time_bucket(string: str) -> datetime.datetime:
+    return datetime.datetime.strptime(string, '%Y-%m-%d %H:%M:%S')
+
+
+def _image_keys(info: MetadataType):
+    return [(inf['device'], inf['datetime']) for inf in info]
+
+
+def _keyset_after(columns, values):
+    # rows strictly after `values` in the lexicographic order of `columns`.
+    # Expanded from a row-value comparison, so MySQL can use the (device, datetime) index
+    if len(columns) == 1:
+        return columns[0] > values[0]
+    return or_(columns[0] > values[0], and_(columns[0] == values[0], _keyset_after(columns[1:], values[1:])))
+
+
+def _encode_cursor(series_index: int, key) -> str:
+    device, dt, row_id = key if key is not None else (None, None, None)
+    cursor = {'series': series_index, 'device': device, 'datetime': dt, 'id': row_id}
+    return base64.urlsafe_b64encode(json.dumps(cursor, default=json_io_converter).encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    # returns the index of the series and the key of the last row already returned
+    if cursor is None:
+        return 0, None
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode(), object_hook=json_out_parser)
+        key = cursor['device'], cursor['datetime'], cursor['id']
+        return int(cursor['series']), None if key[0] is None else key
+    except Exception as e:
+        raise ValueError("Invalid cursor: %s" % cursor) from e
+
+
 # this decorator ensures json inputs are formated as python objects
 @decorate_all_methods(json_inputs_to_python, exclude=['__init__', '_put_new_images', '_put_tiled_tuboids'])
 class BaseAPISpec(ABC):
@@ -50,6 +130,19 @@ class BaseAPISpec(ABC):
         """
         pass
 
+    @abstractmethod
+    def diff_images(self, info: MetadataType, client_info: Dict[str, Any] = None) -> List[str]:
+        """
+        Compares a set of images, defined by their parent device, the datetime of the picture and their md5 sum,
+        to the images in the database. This is used to decide which images to upload.
+
+        :param client_info: optional information about the client/user contains key ``'username'``
+        :param info: A list of dicts. each dicts has, at least, keys: ``'device'``, ``'datetime'`` and ``'md5'``
+        :return: A list with the status of each queried image, in the same order. One of
+            {``'absent'``, ``'present'``, ``'md5_mismatch'``} (i.e. the image exists, but with a different md5)
+        """
+        pass
+
     @abstractmethod
     def delete_images(self, info: MetadataType, client_info: Dict[str, Any] = None):
         """
@@ -80,14 +173,18 @@ class BaseAPISpec(ABC):
     @abstractmethod
     def _put_new_images(self, files: List[str], client_info: Dict[str, Any] = None) -> MetadataType:
         """
-        Uploads a set of client image files to the API.
+        Uploads a set of client image files to the API, in a single transaction.
         The user would use ``BaseClient.put_images(files)``,
         which first discovers which files are to be uploaded for incremental upload.
+        Files that cannot be parsed, stored, or that are already on the API are reported individually,
+        and do not prevent the other files of the batch from being uploaded.
 
         :param client_info: optional information about the client/user contains key ``'username'``
         :param files: A list of path to client files
 
-        :return: The metadata of the files that were actually uploaded
+        :return: One dictionary per file, in the same order as ``files``. For uploaded files,
+            the metadata of the image, as represented in ``Images``. For failed files,
+            a dictionary with the keys ``'filename'`` and ``'error'``
         """
         pass
 
@@ -110,6 +207,24 @@ class BaseAPISpec(ABC):
 
         pass
 
+    @abstractmethod
+    def get_image_series_page(self, info, what: str = 'metadata', cursor: str = None, page_size: int = None,
+                              client_info: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Retrieves one page of image series. This is the paginated version of ``get_image_series``.
+        Images are sorted by series, then by device, datetime and id.
+
+        :param client_info: optional information about the client/user contains key ``'username'``
+        :param info: A list of dicts, as in ``get_image_series``
+        :param what: The nature of the objects to retrieve.
+            One of {``'metadata'``, ``'image'``, ``'thumbnail'``, ``'thumbnail-mini'``}
+        :param cursor: ``None`` for the first page, otherwise, the ``'cursor'`` returned with the previous page
+        :param page_size: the maximal number of images in the page. The API may use fewer
+        :return: A dictionary with the keys ``'data'``, the images, formatted as in ``get_image_series``,
+            and ``'cursor'``, the cursor to the next page (``None`` after the last page).
+        """
+        pass
+
     @abstractmethod
     def put_uid_annotations(self, info: AnnotType, client_info: Dict[str, Any] = None) -> MetadataType:
         """
@@ -129,7 +244,10 @@ class BaseAPISpec(ABC):
                 * ``'value'``: an optional integer further describing the contour (e.g. ``1``)
         :param client_info: optional information about the client/user contains key ``'username'``
         :return: The metadata of the uploaded annotations (i.e. a list od dicts. each field of the dict naming a column in the database).
-            This corresponds to the annotation data as represented in ``UIDAnnotations``
+            This corresponds to the annotation data as represented in ``UIDAnnotations``.
+            There is one dictionary per annotation, in the same order as ``info``. Annotations that cannot be added
+            (no parent image, different md5, or already existing) are represented by a dictionary with the keys
+            ``'device'``, ``'datetime'`` and ``'error'``, and do not prevent the others from being added
         """
         pass
 
@@ -149,6 +267,69 @@ class BaseAPISpec(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_image_series_summary(self, info: InfoType, what: str = 'day',
+                                 client_info: Dict[str, Any] = None) -> MetadataType:
+        """
+        Summarises series of images per device and per time bucket, in a single query for each series.
+        This is much smaller than the series themselves, e.g. to plot insect counts over time.
+
+        :param info: A list of dicts. each dicts has, at least, the keys:
+            ``'device'``, ``'start_datetime'`` and ``'end_datetime'``. ``device`` is interpreted to the MySQL like operator.
+        :param what: The duration of the time buckets. One of {``'hour'``, ``'day'``}
+        :param client_info: optional information about the client/user contains key ``'username'``
+        :return: A list of dictionaries with one element for each device and bucket that has images,
+            sorted by device and datetime. Each dictionary has the keys ``'device'``, ``'datetime'`` (the start of
+            the bucket), ``'n_images'``, ``'n_annotated'`` (the number of images with an annotation),
+            ``'n_objects'`` (the sum of ``n_objects`` over the latest annotation of each image, ``None`` if no image
+            is annotated), and ``'temp'`` and ``'hum'`` (means over valid sensor readings)
+        """
+        pass
+
+    @abstractmethod
+    def get_daily_rollups(self, info: InfoType, client_info: Dict[str, Any] = None) -> MetadataType:
+        """
+        Retrieves the daily summaries of the images of devices. Unlike ``get_image_series_summary``, this does not
+        aggregate images, but reads summaries that are maintained as images and annotations are added or deleted.
+        Summaries of images that were uploaded before their introduction are made by ``BaseAPI.rebuild_daily_rollups``.
+
+        :param info: A list of dicts. each dicts has, at least, the keys:
+            ``'device'``, ``'start_datetime'`` and ``'end_datetime'``. ``device`` is interpreted to the MySQL like operator.
+            The days that start between ``start_datetime`` and ``end_datetime`` are retrieved
+        :param client_info: optional information about the client/user contains key ``'username'``
+        :return: A list of dictionaries with one element for each device and day that has images,
+            sorted by device and datetime. Each dictionary has the fields of the underlying database, where
+            ``'annotations'`` is a list of the annotations of the day, per algorithm, with the keys
+            ``'algo_name'``, ``'algo_version'``, ``'n_annotations'`` and ``'n_objects'``
+        """
+        pass
+
+    @abstractmethod
+    def get_images_with_uid_annotations_series(self, info: InfoType, what_image: str = 'metadata',
+                                               what_annotation: str = 'metadata', columnar: bool = False,
+                                               client_info: Dict[str, Any] = None) -> Union[MetadataType,
+                                                                                            Dict[str, List[Any]]]:
+        """
+        Retrieves images alongside their latest annotation (if available), for images from a given device and
+        within a given datetime range. The latest annotation of an image is the one with the highest
+        ``algo_version`` (which starts with the timestamp of the model), or, for equal versions, the last uploaded.
+
+        :param info: A list of dicts. each dicts has, at least, the keys:
+            ``'device'``, ``'start_datetime'`` and ``'end_datetime'``. ``device`` is interpreted to the MySQL like operator.
+        :param what_image: The nature of the image objects to retrieve.
+            One of {``'metadata'``, ``'image'``, ``'thumbnail'``, ``'thumbnail-mini'``}
+        :param what_annotation: The nature of the annotation to retrieve. One of {``'metadata'``, ``'json'``}.
+            In the case of ``what='metadata'``, there is no ``json`` field.
+        :param columnar: whether to return a dictionary of columns (``{field: [values]}``) rather than a list of rows
+        :param client_info: optional information about the client/user contains key ``'username'``
+        :return: A list of dictionaries with one element for each image, sorted by device and datetime.
+            Each dictionary contains the fields present in the underlying database tables
+            (see ``Images`` and ``UIDAnnotations``), and the ``'url'`` of the image.
+            The annotation fields that have the same name as image fields are suffixed with ``'_annot'``,
+            and are ``None`` for images without annotation.
+        """
+        pass
+
     @abstractmethod
     def get_uid_annotations_series(self, info: InfoType, what: str = 'metadata',
                                    client_info: Dict[str, Any] = None) -> MetadataType:
@@ -166,6 +347,23 @@ class BaseAPISpec(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_uid_annotations_series_page(self, info: InfoType, what: str = 'metadata', cursor: str = None,
+                                        page_size: int = None, client_info: Dict[str, Any] = None) -> Dict[str, Any]:
+        """
+        Retrieves one page of annotation series. This is the paginated version of ``get_uid_annotations_series``.
+        Annotations are sorted by series, then by device and datetime of their parent image, and by id.
+
+        :param info: A list of dicts, as in ``get_uid_annotations_series``
+        :param what: The nature of the object to retrieve. One of {``'metadata'``, ``'json'``}.
+        :param cursor: ``None`` for the first page, otherwise, the ``'cursor'`` returned with the previous page
+        :param page_size: the maximal number of annotations in the page. The API may use fewer
+        :param client_info: optional information about the client/user contains key ``'username'``
+        :return: A dictionary with the keys ``'data'``, the annotations, formatted as in
+            ``get_uid_annotations_series``, and ``'cursor'``, the cursor to the next page (``None`` after the last page).
+        """
+        pass
+
     @abstractmethod
     def _put_tiled_tuboids(self, files: List[Dict[str, Union[Dict, str]]],
                            client_info: Dict[str, Any] = None) -> MetadataType:
@@ -304,10 +502,21 @@ class BaseAPISpec(ABC):
         pass
 
 
-@decorate_all_methods(json_inputs_to_python, exclude=['__init__', '_put_new_images', '_put_tiled_tuboids'])
+@decorate_all_methods(json_inputs_to_python, exclude=['__init__', '_put_new_images', '_commit_new_images',
+                                                      '_put_tiled_tuboids', '_series_page', '_insert_uid_annotations',
+                                                      '_make_thumbnails', '_urls_for_images', '_parse_new_images',
+                                                      '_ingestion_pool', '_run_storage', '_delete_tombstoned_files',
+                                                      '_tuboid_series', '_put_tiled_tuboid_group',
+                                                      '_aggregate_daily_rollups', '_update_daily_rollups',
+                                                      '_insert_daily_rollups'])
 class BaseAPI(BaseAPISpec, ABC):
     _storage_class = BaseStorage
-    _get_image_chunk_size = 64  # the maximal number of images to request from the database in one go
+    # the maximal number of images to request from the database in one go.
+    # Each image key binds at most two parameters, so backends should keep this within their bound parameter limit
+    _get_image_chunk_size = 64
+    _max_series_page_size = 1000  # the maximal number of rows in a page of series
+    # the maximal number of tuboids to request from the database in one go. Each binds one parameter
+    _get_tuboid_chunk_size = 512
 
     def __init__(self, api_conf: BaseAPIConf, *args, **kwargs):
         # super().__init__()
@@ -317,94 +526,295 @@ class BaseAPI(BaseAPISpec, ABC):
 
         Base.metadata.create_all(self._db_engine, Base.metadata.tables.values(), checkfirst=True)
         self._serializer = Serializer(self._configuration.SECRET_API_KEY)
+        # when workers are available, thumbnails are made after the upload returns
+        n_workers = int(api_conf.get('THUMBNAIL_WORKERS') or 0)
+        self._thumbnail_executor = ThreadPoolExecutor(n_workers) if n_workers > 0 else None
+        # see `ImageParser`
+        self._fast_image_parsing = bool(api_conf.get('FAST_IMAGE_PARSING'))
+        # when set, uploaded images are parsed in a pool of processes, and stored from a pool of threads
+        self._n_ingestion_processes = int(api_conf.get('INGESTION_PROCESSES') or 0)
+        self._ingestion_pool_and_pid = None
+        n_threads = int(api_conf.get('STORAGE_THREADS') or 0)
+        self._storage_executor = ThreadPoolExecutor(n_threads) if n_threads > 0 else None
 
     @abstractmethod
     def _create_db_engine(self, *args, **kwargs) -> sqlalchemy.engine.Engine:
         pass
 
     def _put_new_images(self, files: List[str], client_info: Dict[str, Any] = None):
+        api_user = client_info['username'] if client_info is not None else None
         session = sessionmaker(bind=self._db_engine)()
         try:
-            # store the uploaded images
-            out = []
-            # for each image
-            for f in files:
-                # We parse the image file to make to its own DB object
+            # one result per file, in the same order as the input
+            out = [None] * len(files)
+            to_store = self._parse_new_images(files, api_user, out)
+
+            # images that are already in the database, or twice in the batch, are rejected individually
+            keys = [(im.device, im.datetime) for _, im in to_store]
+            existing = set()
+            for keys_chunk in chunker(keys, self._get_image_chunk_size):
+                q = session.query(Images.device, Images.datetime).filter(_image_key_in(keys_chunk))
+                existing |= {(d, dt) for d, dt in q}
+
+            new_images = []
+            for i, im in to_store:
+                if (im.device, im.datetime) in existing:
+                    logging.error("Image %s already exists" % im)
+                    out[i] = {'filename': im.filename, 'error': 'Image %s already exists' % im.filename}
+                    continue
+                existing.add((im.device, im.datetime))
+                new_images.append((i, im))
 
-                api_user = client_info['username'] if client_info is not None else None
-                im = Images(f, api_user=api_user)
-                out.append(im.to_dict())
-                session.add(im)
+            try:
+                self._commit_new_images(session, new_images, out)
+            except IntegrityError as e:
+                # some images were uploaded concurrently by another client.
+                # we fall back to one transaction per image, so only the conflicting ones fail
+                session.rollback()
+                logging.warning("Conflict while committing a batch of images. Committing images one by one")
+                for i, im in new_images:
+                    im.id = None
+                    try:
+                        self._commit_new_images(session, [(i, im)], out)
+                    except IntegrityError as e:
+                        session.rollback()
+                        logging.error("Database Error. Failed to add image %s" % im)
+                        logging.error(e)
+                        out[i] = {'filename': im.filename, 'error': str(e)}
+
+            self._update_daily_rollups(session, [(o['device'], o['datetime']) for o in out if 'error' not in o],
+                                       api_user)
+            if self._thumbnail_executor is not None:
+                ids = [o['id'] for o in out if 'error' not in o]
+                if ids:
+                    self._thumbnail_executor.submit(self._make_thumbnails, ids)
+            return out
+        finally:
+            session.close()
 
-                # try to store images, only commit if storage worked.
-                # rollback otherwise
+    def _ingestion_pool(self):
+        # processes are started on first use, and again in forked processes (e.g. uwsgi workers),
+        # as a pool cannot be shared between processes
+        if self._n_ingestion_processes < 1:
+            return None
+        if self._ingestion_pool_and_pid is None or self._ingestion_pool_and_pid[1] != os.getpid():
+            # spawned processes do not inherit the threads and connections of the server
+            pool = ProcessPoolExecutor(self._n_ingestion_processes, mp_context=multiprocessing.get_context('spawn'))
+            self._ingestion_pool_and_pid = (pool, os.getpid())
+        return self._ingestion_pool_and_pid[0]
+
+    def _parse_new_images(self, files, api_user, out):
+        # We parse each image file to make to its own DB object.
+        # A file that cannot be parsed is reported in `out`, but does not abort the batch
+        thumbnails = self._thumbnail_executor is None
+        pool = self._ingestion_pool()
+        parsed = []
+        for i, f in enumerate(files):
+            try:
+                if pool is None:
+                    parsed.append((i, f, Images(f, api_user=api_user, thumbnails=thumbnails,
+                                                fast=self._fast_image_parsing)))
+                    continue
+                # uploads cannot be sent to other processes, but their content can
+                if not isinstance(f, str):
+                    content = f.read()
+                    f.seek(0)
+                    future = pool.submit(parse_image_file, content, upload_name(f), thumbnails,
+                                         self._fast_image_parsing)
+                else:
+                    future = pool.submit(parse_image_file, f, None, thumbnails, self._fast_image_parsing)
+                parsed.append((i, f, future))
+            except Exception as e:
+                parsed.append((i, f, e))
+
+        to_store = []
+        for i, f, im in parsed:
+            try:
+                if isinstance(im, Exception):
+                    raise im
+                if not isinstance(im, Images):
+                    im = Images(im.result(), api_user=api_user, thumbnails=thumbnails)
+                to_store.append((i, im))
+            except Exception as e:
+                logging.error("Failed to parse image %s" % upload_name(f))
+                logging.error(e)
+                out[i] = {'filename': upload_name(f), 'error': str(e)}
+        return to_store
+
+    def _run_storage(self, function, items):
+        # runs a storage `function` (e.g. storing files) on each item, concurrently when possible.
+        # Returns, for each item, the exception raised by the function, or None
+        def run(item):
+            try:
+                function(item)
+                return None
+            except Exception as e:
+                return e
+
+        if self._storage_executor is None:
+            return [run(item) for item in items]
+        return list(self._storage_executor.map(run, items))
+
+    def _make_thumbnails(self, ids: List[int] = None):
+        # makes and stores the thumbnails of pending images (all of them if ``ids`` is ``None``)
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            q = session.query(Images).filter(Images.thumbnail_status == 'pending')
+            if ids is not None:
+                q = q.filter(Images.id.in_(ids))
+            images = q.all()
+            for im in images:
                 try:
-                    self._storage.store_image_files(im)
-                    session.commit()
+                    im.make_thumbnails(self._storage.get_image_file(im))
+                    self._storage.store_image_thumbnails(im)
+                    im.thumbnail_status = 'ready'
                 except Exception as e:
-                    session.rollback()
-                    logging.error("Storage Error. Failed to store image %s" % im)
+                    logging.error("Failed to make thumbnails for image %s" % im)
                     logging.error(e)
-                    raise e
-            return out
+                    im.thumbnail_status = 'failed'
+                session.commit()
+            return len(images)
         finally:
             session.close()
 
+    def process_pending_thumbnails(self, client_info: Dict[str, Any] = None) -> int:
+        """
+        Makes the thumbnails of all the images that are still pending (e.g. after a restart of the server).
+
+        :return: the number of processed images
+        """
+        return self._make_thumbnails()
+
+    def _urls_for_images(self, images: List[Images], what: str) -> List[str]:
+        # thumbnails that are not made yet have no url
+        urls = self._storage.get_urls_for_images(images, what)
+        if what in ('thumbnail', 'thumbnail-mini'):
+            urls = [u if img.thumbnails_ready else "" for img, u in zip(images, urls)]
+        return urls
+
+    def _commit_new_images(self, session, images, out):
+        # rows are inserted before the files are stored, so unique key conflicts raise before anything is written
+        for _, im in images:
+            session.add(im)
+        session.flush()
+
+        stored = []
+        errors = self._run_storage(self._storage.store_image_files, [im for _, im in images])
+        for (i, im), e in zip(images, errors):
+            if e is None:
+                stored.append((i, im))
+                continue
+            logging.error("Storage Error. Failed to store image %s" % im)
+            logging.error(e)
+            out[i] = {'filename': im.filename, 'error': str(e)}
+            session.delete(im)
+
+        for i, im in stored:
+            out[i] = im.to_dict()
+        try:
+            session.commit()
+        except Exception as e:
+            # the stored files would otherwise be orphaned
+            session.rollback()
+            logging.error("Database Error. Failed to commit images %s" % [im for _, im in stored])
+            logging.error(e)
+            for i, im in stored:
+                try:
+                    self._storage.delete_image_files(im)
+                except Exception as storage_e:
+                    logging.error("Storage Error. Failed to clean up image %s" % im)
+                    logging.error(storage_e)
+                out[i] = {'filename': im.filename, 'error': str(e)}
+
     def _put_tiled_tuboids(self, files: List[Dict[str, Union[str, Dict]]],
                            client_info: Dict[str, Any] = None):  # fixme return type
+        api_user = client_info['username'] if client_info is not None else None
         session = sessionmaker(bind=self._db_engine)()
         try:
-            # store the uploaded images
-            out = []
-            # for each tuboid
-            while len(files) > 0:
-                data = files.pop()
-                # We parse the tuboid data as an entry
-                api_user = client_info['username'] if client_info is not None else None
-                ts = TuboidSeries(data['series_info'])
-                q = session.query(TuboidSeries).filter(TuboidSeries.start_datetime == ts.start_datetime,
-                                                       TuboidSeries.end_datetime == ts.end_datetime,
-                                                       TuboidSeries.device == ts.device,
-                                                       TuboidSeries.algo_name == ts.algo_name,
-                                                       TuboidSeries.algo_version == ts.algo_version
-                                                       )
-                # we add this series if it does not exist
-                if q.count() == 0:
-                    logging.info('Adding new tuboid series %s' % ts)
-                    session.add(ts)
-                    session.commit()
-                    files += [data]
-                    return self._put_tiled_tuboids(files, client_info)
-                else:
-                    ts = q.first()
-                    logging.info('Using tuboid series %s' % ts)
-
-                tub = TiledTuboids(data, parent_tuboid_series=ts, api_user=api_user)
-                q = session.query(TiledTuboids).filter(TiledTuboids.parent_series_id == ts.id)
-                if not (q.count() < ts.n_tuboids):
-                    raise IntegrityError(
-                        'Cannot add more tuboids to parent series %s. Already all of them are there' % ts, None, None)
-
-                assert tub.start_datetime >= ts.start_datetime, 'tuboid starts before its parent series'
-                assert tub.end_datetime <= ts.end_datetime, 'tuboid ends after its parent series'
+            # tuboids are grouped by series, in order of first appearance
+            groups = {}
+            for data in files:
+                ts = TuboidSeries(data['series_info'], api_user=api_user)
+                key = (ts.device, ts.start_datetime, ts.end_datetime, ts.algo_name, ts.algo_version)
+                groups.setdefault(key, (ts, []))[1].append(data)
 
-                session.add(tub)
-
-                # try to store images, only commit if storage worked.
-                # rollback otherwise
-                try:
-                    self._storage.store_tiled_tuboid(data)
-                    session.commit()
-                    out.append(tub.to_dict())
-                except Exception as e:
-                    session.rollback()
-                    logging.error("Storage Error. Failed to store tuboid %s" % tub)
-                    logging.error(e)
-                    raise e
+            out = []
+            for ts, group in groups.values():
+                out += self._put_tiled_tuboid_group(session, self._tuboid_series(session, ts), group, api_user)
             return out
         finally:
             session.close()
 
+    def _tuboid_series(self, session, ts):
+        # the series in the database, which is added if it does not exist
+        def existing():
+            return session.query(TuboidSeries).filter(TuboidSeries.start_datetime == ts.start_datetime,
+                                                      TuboidSeries.end_datetime == ts.end_datetime,
+                                                      TuboidSeries.device == ts.device,
+                                                      TuboidSeries.algo_name == ts.algo_name,
+                                                      TuboidSeries.algo_version == ts.algo_version).first()
+        existing_ts = existing()
+        if existing_ts is not None:
+            logging.info('Using tuboid series %s' % existing_ts)
+            return existing_ts
+        logging.info('Adding new tuboid series %s' % ts)
+        try:
+            session.add(ts)
+            session.commit()
+            return ts
+        except IntegrityError:
+            # the series was added concurrently
+            session.rollback()
+            return existing()
+
+    def _put_tiled_tuboid_group(self, session, ts, group, api_user):
+        # all the tuboids of a series are inserted in one go, and stored concurrently.
+        # If any of them fails, none is added
+        n_existing = session.query(sqlalchemy.func.count(TiledTuboids.id)). \
+            filter(TiledTuboids.parent_series_id == ts.id).scalar()
+        if n_existing + len(group) > ts.n_tuboids:
+            raise IntegrityError(
+                'Cannot add %i tuboids to parent series %s. It already has %i of its %i tuboids' %
+                (len(group), ts, n_existing, ts.n_tuboids), None, None)
+
+        rows = []
+        for data in group:
+            tub = TiledTuboids(data, parent_tuboid_series=ts, api_user=api_user)
+            assert tub.start_datetime >= ts.start_datetime, 'tuboid starts before its parent series'
+            assert tub.end_datetime <= ts.end_datetime, 'tuboid ends after its parent series'
+            row = BaseCustomisations.to_dict(tub)
+            del row['id']
+            rows.append(row)
+
+        # rows are inserted before the files are stored, so unique key conflicts raise before anything is written
+        session.execute(TiledTuboids.__table__.insert(), rows)
+        errors = self._run_storage(self._storage.store_tiled_tuboid, group)
+        failed = [(data, e) for data, e in zip(group, errors) if e is not None]
+        if failed:
+            session.rollback()
+            for data, e in failed:
+                logging.error("Storage Error. Failed to store tuboid %s" % data['tuboid_id'])
+                logging.error(e)
+            stored = [data for data, e in zip(group, errors) if e is None]
+            # so the files of the other tuboids are not orphaned
+            tuboids = [TiledTuboids.__mapper__.class_manager.new_instance() for _ in stored]
+            for tub, data in zip(tuboids, stored):
+                tub.tuboid_id = data['tuboid_id']
+            try:
+                self._storage.delete_tiled_tuboid_list_files(tuboids)
+            except Exception as storage_e:
+                logging.error("Storage Error. Failed to clean up tuboids %s" % [t.tuboid_id for t in tuboids])
+                logging.error(storage_e)
+            raise failed[0][1]
+        session.commit()
+
+        out = {}
+        tuboid_ids = [row['tuboid_id'] for row in rows]
+        for ids_chunk in chunker(tuboid_ids, self._get_tuboid_chunk_size):
+            for tub in session.query(TiledTuboids).filter(TiledTuboids.tuboid_id.in_(ids_chunk)):
+                out[tub.tuboid_id] = tub.to_dict()
+        return [out[t] for t in tuboid_ids]
+
     def _get_ml_bundle_file_list(self, info: str, what: str = "all", client_info: Dict[str, Any] = None) -> \
             List[Dict[str, Union[float, str]]]:
         return self._storage.get_ml_bundle_file_list(info, what)
@@ -435,117 +845,257 @@ class BaseAPI(BaseAPISpec, ABC):
                               i * self._get_image_chunk_size + len(info_chunk),
                               len(info)))
 
-                conditions = [and_(Images.datetime == inf['datetime'], Images.device == inf['device'])
-                              for inf in info_chunk]
-                q = session.query(Images).filter(or_(*conditions))
-
-                for img in q:
+                images = session.query(Images).filter(_image_key_in(_image_keys(info_chunk))).all()
+                for img, url in zip(images, self._urls_for_images(images, what)):
                     img_dict = img.to_dict()
-                    img_dict['url'] = self._storage.get_url_for_image(img, what)
+                    img_dict['url'] = url
                     out.append(img_dict)
             return out
         finally:
             session.close()
 
-    def get_image_series(self, info: MetadataType, what: str = 'metadata', client_info: Dict[str, Any] = None):
+    def diff_images(self, info: MetadataType, client_info: Dict[str, Any] = None):
         session = sessionmaker(bind=self._db_engine)()
         try:
+            md5s = {}
+            keys = _image_keys(info)
+            for keys_chunk in chunker(keys, self._get_image_chunk_size):
+                q = session.query(Images.device, Images.datetime, Images.md5).filter(_image_key_in(keys_chunk))
+                md5s.update({(d, dt): md5 for d, dt, md5 in q})
             out = []
+            for k, i in zip(keys, info):
+                if k not in md5s:
+                    out.append('absent')
+                else:
+                    out.append('present' if md5s[k] == i['md5'] else 'md5_mismatch')
+            return out
+        finally:
+            session.close()
+
+    def get_image_series(self, info: MetadataType, what: str = 'metadata', client_info: Dict[str, Any] = None):
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            images = []
             for i in info:
                 q = session.query(Images).filter(Images.datetime >= i['start_datetime'],
                                                  Images.datetime < i['end_datetime'],
                                                  Images.device.like(i['device']))
-                if q.count() == 0:
+                n_images = len(images)
+                images += q.all()
+                if len(images) == n_images:
                     logging.warning('No data for series %s' % str(i))
 
-                for img in q:
-                    img_dict = img.to_dict()
-                    img_dict['url'] = self._storage.get_url_for_image(img, what)
-                    out.append(img_dict)
+            # all the urls of the response are signed in one go
+            out = []
+            for img, url in zip(images, self._urls_for_images(images, what)):
+                img_dict = img.to_dict()
+                img_dict['url'] = url
+                out.append(img_dict)
+            return out
+        finally:
+            session.close()
+
+    def get_image_series_page(self, info: MetadataType, what: str = 'metadata', cursor: str = None,
+                              page_size: int = None, client_info: Dict[str, Any] = None):
+        def series_query(session, i):
+            return session.query(Images, Images.device, Images.datetime, Images.id).filter(
+                Images.datetime >= i['start_datetime'],
+                Images.datetime < i['end_datetime'],
+                Images.device.like(i['device']))
+
+        def to_dicts(images):
+            out = []
+            for img, url in zip(images, self._urls_for_images(images, what)):
+                img_dict = img.to_dict()
+                img_dict['url'] = url
+                out.append(img_dict)
             return out
+
+        return self._series_page(info, cursor, page_size, series_query,
+                                 (Images.device, Images.datetime, Images.id), to_dicts)
+
+    def _series_page(self, info, cursor, page_size, series_query, key_columns, to_dicts):
+        # keyset pagination: each query resumes strictly after the last row of the previous page,
+        # so neither the database nor the API ever holds more than a page
+        if page_size is None or page_size > self._max_series_page_size:
+            page_size = self._max_series_page_size
+        series_index, last_key = _decode_cursor(cursor)
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            out = []
+            while series_index < len(info) and len(out) < page_size:
+                q = series_query(session, info[series_index])
+                if last_key is not None:
+                    q = q.filter(_keyset_after(key_columns, last_key))
+                n_to_get = page_size - len(out)
+                rows = q.order_by(*key_columns).limit(n_to_get).all()
+                for row in rows:
+                    out.append(row[0])
+                    last_key = tuple(row[1:])
+                if len(rows) < n_to_get:
+                    series_index += 1
+                    last_key = None
+            next_cursor = None if series_index >= len(info) else _encode_cursor(series_index, last_key)
+            return {'data': to_dicts(out), 'cursor': next_cursor}
         finally:
             session.close()
 
     def delete_images(self, info: MetadataType, client_info: Dict[str, Any] = None) -> MetadataType:
+        api_user = client_info['username'] if client_info is not None else None
         out = []
         session = sessionmaker(bind=self._db_engine)()
         try:
-            # We fetch images by chunks:
+            # We delete images by chunks, in one transaction per chunk:
             for i, info_chunk in enumerate(chunker(info, self._get_image_chunk_size)):
                 logging.info("Deleting images... %i-%i / %i" %
                              (i * self._get_image_chunk_size,
                               i * self._get_image_chunk_size + len(info_chunk),
                               len(info)))
 
-                conditions = [and_(Images.datetime == inf['datetime'], Images.device == inf['device'])
-                              for inf in info_chunk]
-
-                q = session.query(Images).filter(or_(*conditions))
-
-                for img in q:
-                    img_dict = img.to_dict()
-                    session.delete(img)
-                    try:
-                        self._storage.delete_image_files(img)
-                        session.commit()
-                    except Exception as e:
-                        session.rollback()
-                        logging.error("Storage Error. Failed to delete image %s" % img)
-                        logging.error(e)
-                        raise e
-                    out.append(img_dict)
+                images = session.query(Images).filter(_image_key_in(_image_keys(info_chunk))).all()
+                if not images:
+                    continue
+                out += [img.to_dict() for img in images]
+                # the files are deleted after the rows, so we record them as tombstones in the same transaction
+                tombstones = [StorageTombstones(img, api_user=api_user) for img in images]
+                session.add_all(tombstones)
+                # annotations are deleted by the database (`ON DELETE CASCADE`)
+                session.query(Images).filter(Images.id.in_([img.id for img in images])). \
+                    delete(synchronize_session=False)
+                session.flush()
+                tombstones = [(t.id, t.image()) for t in tombstones]
+                session.commit()
+                session.expunge_all()
+                self._update_daily_rollups(session, [(img.device, img.datetime) for _, img in tombstones], api_user)
+                self._delete_tombstoned_files(session, tombstones)
             return out
         finally:
             session.close()
 
-    def put_uid_annotations(self, info: AnnotType, client_info: Dict[str, Any] = None):
-        info = copy.deepcopy(info)
-        session = sessionmaker(bind=self._db_engine)()
+    def _delete_tombstoned_files(self, session, tombstones):
+        # deletes the files of `(tombstone_id, image)` tuples, in one batch. Tombstones are removed on success,
+        # and kept (with their error) otherwise, so the deletion can be retried
+        ids = [i for i, _ in tombstones]
         try:
-            all_annots = []
-            # for each image
-            for data in info:
-
-                json_str = json.dumps(data, default=json_io_converter)
-                dic = data['metadata']
-                annotations = data['annotations']
-
-                n_objects = len(annotations)
-                dic['json'] = json_str
-
-                # fixme. here we should get multiple images in one go, prior to parsing annotations ?
+            self._storage.delete_image_list_files([img for _, img in tombstones])
+        except Exception as e:
+            logging.error("Storage Error. Failed to delete the files of images %s. "
+                          "They will be deleted by `process_storage_tombstones`" % [img for _, img in tombstones])
+            logging.error(e)
+            session.query(StorageTombstones).filter(StorageTombstones.id.in_(ids)). \
+                update({StorageTombstones.n_attempts: StorageTombstones.n_attempts + 1,
+                        StorageTombstones.error: str(e)}, synchronize_session=False)
+            session.commit()
+            return 0
+        session.query(StorageTombstones).filter(StorageTombstones.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        return len(ids)
 
-                q = session.query(Images).filter(Images.datetime == dic['datetime'], Images.device == dic['device'])
+    def process_storage_tombstones(self, client_info: Dict[str, Any] = None) -> int:
+        """
+        Deletes the files of deleted images that could not be deleted from the storage (e.g. after a storage error).
 
-                if q.count() == 0:
-                    raise ValueError("could not find parent image for %s" % str(dic))
-                if q.count() > 1:
-                    raise ValueError("<More than one parent image for  %s" % str(dic))
-                parent_img = q.first()
-                # dic['parent_image_id'] = parent_img["id"]
-                dic['n_objects'] = n_objects
-                if dic['md5'] != parent_img.md5:
-                    raise ValueError("Trying to add an annotation for %s, but md5 differ" % str(data))
-                dic['parent_image_id'] = parent_img.id
-                annot = UIDAnnotations(dic)
-                parent_img.uid_annotations.append(annot)
+        :return: the number of images whose files were deleted
+        """
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            n_deleted = 0
+            q = session.query(StorageTombstones).order_by(StorageTombstones.id)
+            # tombstones are read before any commit, which would expire them
+            tombstones = [(t.id, t.image()) for t in q]
+            for tombstones_chunk in chunker(tombstones, self._get_image_chunk_size):
+                n_deleted += self._delete_tombstoned_files(session, tombstones_chunk)
+            return n_deleted
+        finally:
+            session.close()
 
-                all_annots.append(annot)
-                session.add(annot)
+    def put_uid_annotations(self, info: AnnotType, client_info: Dict[str, Any] = None):
+        api_user = client_info['username'] if client_info is not None else None
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            # one result per annotation, in the same order as the input
+            out = [None] * len(info)
+
+            # all the parent images are fetched in one go
+            keys = list({(data['metadata']['device'], data['metadata']['datetime']) for data in info})
+            parents = {}
+            for keys_chunk in chunker(keys, self._get_image_chunk_size):
+                q = session.query(Images.device, Images.datetime, Images.id, Images.md5).filter(
+                    _image_key_in(keys_chunk))
+                parents.update({(device, dt): (im_id, md5) for device, dt, im_id, md5 in q})
+
+            # as well as the annotations that already exist for these images
+            existing = set()
+            for ids_chunk in chunker([im_id for im_id, _ in parents.values()], self._get_image_chunk_size):
+                q = session.query(UIDAnnotations.parent_image_id, UIDAnnotations.algo_name,
+                                  UIDAnnotations.algo_version).filter(UIDAnnotations.parent_image_id.in_(ids_chunk))
+                existing |= set(q)
+
+            to_insert = []
+            for i, data in enumerate(info):
+                dic = dict(data['metadata'])
+                parent = parents.get((dic['device'], dic['datetime']))
+                if parent is None:
+                    error = "could not find parent image for %s" % str(dic)
+                elif dic['md5'] != parent[1]:
+                    error = "Trying to add an annotation for %s, but md5 differ" % str(dic)
+                elif (parent[0], dic['algo_name'], dic['algo_version']) in existing:
+                    error = "Annotation already exists for %s" % str(dic)
+                else:
+                    error = None
 
-                # https://stackoverflow.com/questions/3659142/bulk-insert-with-sqlalchemy-orm
+                if error is not None:
+                    logging.error(error)
+                    out[i] = {'device': dic['device'], 'datetime': dic['datetime'], 'error': error}
+                    continue
 
-            session.commit()
-            out = []
-            for annot in all_annots:
-                o = annot.to_dict()
-                o["json"] = ""
-                out.append(o)
+                existing.add((parent[0], dic['algo_name'], dic['algo_version']))
+                dic['json'] = json.dumps(data, default=json_io_converter)
+                dic['n_objects'] = len(data['annotations'])
+                dic['parent_image_id'] = parent[0]
+                row = UIDAnnotations(dic, api_user=api_user).to_dict()
+                del row['id']
+                to_insert.append((i, row))
 
+            try:
+                self._insert_uid_annotations(session, to_insert, out)
+            except IntegrityError as e:
+                # annotations were added concurrently by another client.
+                # we fall back to one insert per annotation, so only the conflicting ones fail
+                session.rollback()
+                logging.warning("Conflict while inserting a batch of annotations. Inserting them one by one")
+                for i, row in to_insert:
+                    try:
+                        self._insert_uid_annotations(session, [(i, row)], out)
+                    except IntegrityError as e:
+                        session.rollback()
+                        logging.error("Database Error. Failed to add annotation %s" % str(row))
+                        logging.error(e)
+                        out[i] = {'device': info[i]['metadata']['device'],
+                                  'datetime': info[i]['metadata']['datetime'], 'error': str(e)}
+            self._update_daily_rollups(session, [(info[i]['metadata']['device'], info[i]['metadata']['datetime'])
+                                                 for i, o in enumerate(out) if 'error' not in o], api_user)
             return out
         finally:
             session.close()
 
+    def _insert_uid_annotations(self, session, rows, out):
+        # a single (executemany) insert. The ids are then fetched back using the unique key of the annotations
+        if len(rows) == 0:
+            return
+        session.execute(UIDAnnotations.__table__.insert(), [row for _, row in rows])
+        session.commit()
+        ids = {}
+        for rows_chunk in chunker(rows, self._get_image_chunk_size):
+            q = session.query(UIDAnnotations.id, UIDAnnotations.parent_image_id, UIDAnnotations.algo_name,
+                              UIDAnnotations.algo_version).filter(
+                UIDAnnotations.parent_image_id.in_([row['parent_image_id'] for _, row in rows_chunk]))
+            ids.update({(parent_id, name, version): annot_id for annot_id, parent_id, name, version in q})
+        for i, row in rows:
+            o = dict(row, json="")
+            o['id'] = ids[(row['parent_image_id'], row['algo_name'], row['algo_version'])]
+            out[i] = o
+
     def get_uid_annotations(self, info: MetadataType, what: str = 'metadata', client_info: Dict[str, Any] = None):
         out = []
         session = sessionmaker(bind=self._db_engine)()
@@ -557,11 +1107,8 @@ class BaseAPI(BaseAPISpec, ABC):
                               i * self._get_image_chunk_size + len(info_chunk),
                               len(info)))
 
-                conditions = [UIDAnnotations.parent_image.has(and_(Images.datetime == inf['datetime'],
-                                                                   Images.device == inf['device']))
-                              for inf in info_chunk]
-
-                q = session.query(UIDAnnotations).filter(or_(*conditions))
+                q = session.query(UIDAnnotations).join(UIDAnnotations.parent_image).filter(
+                    _image_key_in(_image_keys(info_chunk)))
                 for annots in q:
                     annot_dict = annots.to_dict()
                     if what == 'metadata':
@@ -572,6 +1119,185 @@ class BaseAPI(BaseAPISpec, ABC):
         finally:
             session.close()
 
+    def get_images_with_uid_annotations_series(self, info: MetadataType, what_image: str = 'metadata',
+                                               what_annotation: str = 'metadata', columnar: bool = False,
+                                               client_info: Dict[str, Any] = None):
+        image_columns = Images.column_names()
+        annot_columns = [c for c in UIDAnnotations.column_names() if c != 'json' or what_annotation != 'metadata']
+        # the same names as a left join of `get_image_series` and `get_uid_annotations_series`
+        columns = image_columns + ['url'] + [c + '_annot' if c in image_columns else c for c in annot_columns]
+
+        annot = aliased(UIDAnnotations)
+        newer = aliased(UIDAnnotations)
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            images, annot_rows = [], []
+            for i in info:
+                q = _latest_annotation_outerjoin(
+                    session.query(Images, *[getattr(annot, c) for c in annot_columns]), annot, newer).filter(
+                    newer.id.is_(None),
+                    Images.datetime >= i['start_datetime'],
+                    Images.datetime < i['end_datetime'],
+                    Images.device.like(i['device'])).order_by(Images.device, Images.datetime)
+                n_images = len(images)
+                for row in q:
+                    images.append(row[0])
+                    annot_rows.append(row[1:])
+                if len(images) == n_images:
+                    logging.warning('No data for series %s' % str(i))
+
+            urls = self._urls_for_images(images, what_image)
+            rows = [tuple(getattr(img, c) for c in image_columns) + (url,) + a
+                    for img, url, a in zip(images, urls, annot_rows)]
+            if len(info) > 1:
+                device, dt = image_columns.index('device'), image_columns.index('datetime')
+                rows.sort(key=lambda r: (r[device], r[dt]))
+
+            if columnar:
+                return {c: list(values) for c, values in zip(columns, zip(*rows))} if rows else {c: [] for c in columns}
+            return [dict(zip(columns, r)) for r in rows]
+        finally:
+            session.close()
+
+    def get_image_series_summary(self, info: MetadataType, what: str = 'day', client_info: Dict[str, Any] = None):
+        annot = aliased(UIDAnnotations)
+        newer = aliased(UIDAnnotations)
+        bucket = _time_bucket(Images.datetime, what, self._db_engine.dialect.name).label('bucket')
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            out = []
+            for i in info:
+                q = _latest_annotation_outerjoin(
+                    session.query(Images.device, bucket, func.count(Images.id), func.count(annot.id),
+                                  func.sum(annot.n_objects), func.avg(_valid_temp), func.avg(_valid_hum)), annot, newer).filter(
+                    newer.id.is_(None),
+                    Images.datetime >= i['start_datetime'],
+                    Images.datetime < i['end_datetime'],
+                    Images.device.like(i['device'])).group_by(Images.device, bucket)
+                n_rows = len(out)
+                for device, start, n_images, n_annotated, n_objects, mean_temp, mean_hum in q:
+                    out.append({'device': device,
+                                'datetime': _parse_time_bucket(start),
+                                'n_images': n_images,
+                                'n_annotated': n_annotated,
+                                'n_objects': None if n_objects is None else int(n_objects),
+                                'temp': None if mean_temp is None else float(mean_temp),
+                                'hum': None if mean_hum is None else float(mean_hum)})
+                if len(out) == n_rows:
+                    logging.warning('No data for series %s' % str(i))
+            out.sort(key=lambda o: (o['device'], o['datetime']))
+            return out
+        finally:
+            session.close()
+
+    def _aggregate_daily_rollups(self, session, condition):
+        # aggregates the images that match a `condition` into rollups, by device and day
+        annot = aliased(UIDAnnotations)
+        newer = aliased(UIDAnnotations)
+        day = _time_bucket(Images.datetime, 'day', self._db_engine.dialect.name).label('day')
+        q = _latest_annotation_outerjoin(
+            session.query(Images.device, day, func.count(Images.id), func.count(annot.id), func.sum(annot.n_objects),
+                          func.avg(_valid_temp), func.min(_valid_temp), func.max(_valid_temp),
+                          func.avg(_valid_hum), func.min(_valid_hum), func.max(_valid_hum)), annot, newer).filter(
+            newer.id.is_(None), condition).group_by(Images.device, day)
+        out = {}
+        for device, start, n_images, n_annotated, n_objects, *sensors in q:
+            row = {'device': device, 'datetime': _parse_time_bucket(start), 'n_images': n_images,
+                   'n_annotated': n_annotated, 'n_objects': None if n_objects is None else int(n_objects),
+                   'annotations': []}
+            for k, v in zip(['temp_mean', 'temp_min', 'temp_max', 'hum_mean', 'hum_min', 'hum_max'], sensors):
+                row[k] = None if v is None else float(v)
+            out[(device, row['datetime'])] = row
+
+        # all the annotations, not only the latest ones, are counted per algorithm version
+        q = session.query(Images.device, day, UIDAnnotations.algo_name, UIDAnnotations.algo_version,
+                          func.count(UIDAnnotations.id), func.sum(UIDAnnotations.n_objects)).join(
+            UIDAnnotations, UIDAnnotations.parent_image_id == Images.id).filter(condition).group_by(
+            Images.device, day, UIDAnnotations.algo_name, UIDAnnotations.algo_version).order_by(
+            UIDAnnotations.algo_name, UIDAnnotations.algo_version)
+        for device, start, algo_name, algo_version, n_annotations, n_objects in q:
+            out[(device, _parse_time_bucket(start))]['annotations'].append(
+                {'algo_name': algo_name, 'algo_version': algo_version,
+                 'n_annotations': n_annotations, 'n_objects': int(n_objects)})
+        return out
+
+    def _update_daily_rollups(self, session, keys, api_user=None):
+        # recomputes the rollups of the days of `(device, datetime)` keys from their images, so rollups are exact
+        # whatever changed. This is called after the changes are committed: a failure is logged rather than raised
+        one_day = datetime.timedelta(days=1)
+        days = sorted({(device, dt.replace(hour=0, minute=0, second=0, microsecond=0)) for device, dt in keys})
+        try:
+            # each day binds three parameters
+            for days_chunk in chunker(days, self._get_image_chunk_size // 2):
+                rollups = self._aggregate_daily_rollups(session, or_(
+                    *[and_(Images.device == d, Images.datetime >= dt, Images.datetime < dt + one_day)
+                      for d, dt in days_chunk]))
+                session.query(DailyRollups).filter(or_(
+                    *[and_(DailyRollups.device == d, DailyRollups.datetime == dt) for d, dt in days_chunk])). \
+                    delete(synchronize_session=False)
+                self._insert_daily_rollups(session, rollups.values(), api_user)
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.error("Database Error. Failed to update the daily rollups of %s. "
+                          "They can be made again by `rebuild_daily_rollups`" % days)
+            logging.error(e)
+
+    def _insert_daily_rollups(self, session, rollups, api_user):
+        # a single (executemany) insert
+        rows = []
+        for r in rollups:
+            row = DailyRollups(dict(r, annotations=json.dumps(r['annotations'])), api_user=api_user).to_dict()
+            del row['id']
+            rows.append(row)
+        if rows:
+            session.execute(DailyRollups.__table__.insert(), rows)
+
+    def rebuild_daily_rollups(self, client_info: Dict[str, Any] = None) -> int:
+        """
+        Makes the daily rollups of all the images again (e.g. to backfill the rollups of existing images),
+        in one transaction per device.
+
+        :return: the number of rollups
+        """
+        api_user = client_info['username'] if client_info is not None else None
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            devices = sorted(d for d, in session.query(Images.device).distinct())
+            session.query(DailyRollups).filter(DailyRollups.device.notin_(devices)).delete(synchronize_session=False)
+            session.commit()
+            n_rollups = 0
+            for device in devices:
+                rollups = self._aggregate_daily_rollups(session, Images.device == device)
+                session.query(DailyRollups).filter(DailyRollups.device == device).delete(synchronize_session=False)
+                self._insert_daily_rollups(session, rollups.values(), api_user)
+                session.commit()
+                n_rollups += len(rollups)
+                logging.info("Rebuilt %i daily rollups for device %s" % (len(rollups), device))
+            return n_rollups
+        finally:
+            session.close()
+
+    def get_daily_rollups(self, info: MetadataType, client_info: Dict[str, Any] = None):
+        session = sessionmaker(bind=self._db_engine)()
+        try:
+            out = []
+            for i in info:
+                q = session.query(DailyRollups).filter(DailyRollups.datetime >= i['start_datetime'],
+                                                       DailyRollups.datetime < i['end_datetime'],
+                                                       DailyRollups.device.like(i['device']))
+                n_rows = len(out)
+                for r in q:
+                    o = r.to_dict()
+                    o['annotations'] = json.loads(o['annotations'])
+                    out.append(o)
+                if len(out) == n_rows:
+                    logging.warning('No data for series %s' % str(i))
+            out.sort(key=lambda o: (o['device'], o['datetime']))
+            return out
+        finally:
+            session.close()
+
     def get_uid_annotations_series(self, info: MetadataType, what: str = 'metadata',
                                    client_info: Dict[str, Any] = None):
         session = sessionmaker(bind=self._db_engine)()
@@ -584,18 +1310,40 @@ class BaseAPI(BaseAPISpec, ABC):
                     Images.datetime < i['end_datetime'],
                     Images.device.like(i['device']))))
 
-                if q.count() == 0:
-                    logging.warning('No data for series %s' % str(i))
-
+                n_annots = 0
                 for annots in q:
                     annot_dict = annots.to_dict()
                     if what == 'metadata':
                         del annot_dict['json']
                     out.append(annot_dict)
+                    n_annots += 1
+                if n_annots == 0:
+                    logging.warning('No data for series %s' % str(i))
             return out
         finally:
             session.close()
 
+    def get_uid_annotations_series_page(self, info: MetadataType, what: str = 'metadata', cursor: str = None,
+                                        page_size: int = None, client_info: Dict[str, Any] = None):
+        def series_query(session, i):
+            return session.query(UIDAnnotations, Images.device, Images.datetime, UIDAnnotations.id).join(
+                UIDAnnotations.parent_image).filter(
+                Images.datetime >= i['start_datetime'],
+                Images.datetime < i['end_datetime'],
+                Images.device.like(i['device']))
+
+        def to_dicts(annotations):
+            out = []
+            for annots in annotations:
+                annot_dict = annots.to_dict()
+                if what == 'metadata':
+                    del annot_dict['json']
+                out.append(annot_dict)
+            return out
+
+        return self._series_page(info, cursor, page_size, series_query,
+                                 (Images.device, Images.datetime, UIDAnnotations.id), to_dicts)
+
     def get_tiled_tuboid_series(self, info: InfoType, what: str = 'metadata',
                                 client_info: Dict[str, Any] = None) -> MetadataType:
         session = sessionmaker(bind=self._db_engine)()
@@ -611,14 +1359,15 @@ class BaseAPI(BaseAPISpec, ABC):
                          TuboidSeries.end_datetime <= i['end_datetime'],
                          TuboidSeries.device.like(i['device']))))
 
-                if q.count() == 0:
+                n_tuboids = len(out)
+                out += [tub.to_dict() for tub in q]
+                if len(out) == n_tuboids:
                     logging.warning('No data for series %s' % str(i))
 
-                for tub in q.all():
-                    tub_dict = tub.to_dict()
-                    if what == 'data':
-                        tub_dict.update(self._storage.get_urls_for_tiled_tuboids(tub_dict))
-                    out.append(tub_dict)
+            if what == 'data':
+                # all the urls of the response are signed in one go
+                for tub_dict, urls in zip(out, self._storage.get_urls_for_tiled_tuboid_list(out)):
+                    tub_dict.update(urls)
             return out
         finally:
             session.close()
@@ -628,70 +1377,85 @@ class BaseAPI(BaseAPISpec, ABC):
         info = copy.deepcopy(info)
         session = sessionmaker(bind=self._db_engine)()
         try:
-            # We fetch images by chunks:
-
+            all_tuboids = []
             for inf in info:
                 q = session.query(TuboidSeries).filter(TuboidSeries.start_datetime >= inf['start_datetime'],
                                                        TuboidSeries.end_datetime <= inf['end_datetime'],
                                                        TuboidSeries.device.like(inf['device']))
 
                 for ts in q:
-                    img_dict = ts.to_dict()
-                    all_tuboids = [t for t in
-                                   session.query(TiledTuboids).filter(TiledTuboids.parent_series_id == ts.id)]
+                    out.append(ts.to_dict())
+                    all_tuboids += session.query(TiledTuboids).filter(TiledTuboids.parent_series_id == ts.id).all()
                     session.delete(ts)
-                    try:
-                        for tub in all_tuboids:
-                            self._storage.delete_tiled_tuboid_files(tub)
-                        session.commit()
-                    except Exception as e:
-                        session.rollback()
-                        logging.error("Storage Error. Failed to delete series %s" % tub)
-                        logging.error(e)
-                        raise e
-                    out.append(img_dict)
+
+            # all the rows are deleted in one transaction, and all the files in one batch
+            try:
+                session.flush()
+                self._storage.delete_tiled_tuboid_list_files(all_tuboids)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logging.error("Storage Error. Failed to delete series %s" % out)
+                logging.error(e)
+                raise e
             return out
         finally:
             session.close()
 
     def put_itc_labels(self, info: List[Dict[str, Union[str, int]]],
                        client_info: Dict[str, Any] = None) -> MetadataType:
-        info = copy.deepcopy(info)
+        api_user = client_info['username'] if client_info is not None else None
         session = sessionmaker(bind=self._db_engine)()
         try:
-            out = []
-
-            # for each image
+            # the ids of all the parent tuboids, one query per chunk
+            tuboid_ids = list({data['tuboid_id'] for data in info})
+            parents = {}
+            for ids_chunk in chunker(tuboid_ids, self._get_tuboid_chunk_size):
+                q = session.query(TiledTuboids.tuboid_id, TiledTuboids.id).filter(TiledTuboids.tuboid_id.in_(ids_chunk))
+                parents.update({tuboid_id: parent_id for tuboid_id, parent_id in q})
+
+            rows = []
             for data in info:
-                q = session.query(TiledTuboids).filter(TiledTuboids.tuboid_id == data['tuboid_id'])
-                assert q.count() == 1, "No match for %s" % data
-                data['parent_tuboid_id'] = q.first().id
-                api_user = client_info['username'] if client_info is not None else None
-                label = ITCLabels(data, api_user=api_user)
-                out.append(label.to_dict())
-                session.add(label)
+                assert data['tuboid_id'] in parents, "No match for %s" % data
+                row = ITCLabels(dict(data, parent_tuboid_id=parents[data['tuboid_id']]), api_user=api_user).to_dict()
+                del row['id']
+                rows.append(row)
+            if len(rows) == 0:
+                return []
+
+            # all the labels are inserted in one transaction, so a conflicting label (see `ITCLabels`) rejects the batch
+            try:
+                session.execute(ITCLabels.__table__.insert(), rows)
                 session.commit()
-            return out
+            except IntegrityError as e:
+                session.rollback()
+                logging.error("Database Error. Failed to add labels")
+                logging.error(e)
+                raise e
+
+            # the ids are fetched back using the unique key of the labels
+            ids = {}
+            for parents_chunk in chunker(list({row['parent_tuboid_id'] for row in rows}), self._get_tuboid_chunk_size):
+                q = session.query(ITCLabels.id, ITCLabels.parent_tuboid_id, ITCLabels.algo_name,
+                                  ITCLabels.algo_version).filter(ITCLabels.parent_tuboid_id.in_(parents_chunk))
+                ids.update({(parent_id, name, version): label_id for label_id, parent_id, name, version in q})
+            return [dict(row, id=ids[(row['parent_tuboid_id'], row['algo_name'], row['algo_version'])])
+                    for row in rows]
         finally:
             session.close()
 
     def _get_itc_labels(self, info: List[Dict], client_info: Dict[str, Any] = None) -> MetadataType:
-        info = copy.deepcopy(info)
         out = []
         session = sessionmaker(bind=self._db_engine)()
         try:
-            for i, info_chunk in enumerate(chunker(info, self._get_image_chunk_size)):
+            for i, info_chunk in enumerate(chunker(info, self._get_tuboid_chunk_size)):
                 logging.info("Getting tuboid label... %i-%i / %i" %
-                             (i * self._get_image_chunk_size,
-                              i * self._get_image_chunk_size + len(info_chunk),
+                             (i * self._get_tuboid_chunk_size,
+                              i * self._get_tuboid_chunk_size + len(info_chunk),
                               len(info)))
-                # can be a single row
-                tuboid_ids = [TiledTuboids.tuboid_id == j['tuboid_id'] for j in info_chunk]
-                conditions = or_(*tuboid_ids)
-                q = session.query(TiledTuboids).filter(conditions)
-                parent_tuboid_ids = [ITCLabels.parent_tuboid_id == r.id for r in q.all()]
-                conditions = or_(*parent_tuboid_ids)
-                q = session.query(ITCLabels).filter(conditions)
+                # the labels are joined to their tuboids, in a single query
+                q = session.query(ITCLabels).join(TiledTuboids, ITCLabels.parent_tuboid_id == TiledTuboids.id). \
+                    filter(TiledTuboids.tuboid_id.in_([j['tuboid_id'] for j in info_chunk]))
 
                 for annots in q:
                     out.append(annots.to_dict())
@@ -781,6 +1545,7 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
 class LocalAPI(BaseAPI):
     _storage_class = DiskStorage
     _database_filename = 'database.db'
+    _get_image_chunk_size = 499  # sqlite binds at most 999 parameters per statement on older builds
 
     def _create_db_engine(self):
         local_dir = self._configuration.LOCAL_DIR
@@ -796,7 +1561,7 @@ class LocalAPI(BaseAPI):
 
 class RemoteAPI(BaseAPI):
     _storage_class = S3Storage
-    _get_image_chunk_size = 1024  # the maximal number of images to request from the database in one go
+    _get_image_chunk_size = 8192  # keeps a statement well below the default MySQL `max_allowed_packet`
 
     def get_token(self, client_info: Dict[str, Any] = None) -> Dict[str, Union[str, int]]:
         session = sessionmaker(bind=self._db_engine)()
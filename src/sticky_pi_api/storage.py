@@ -4,13 +4,16 @@ import shutil
 import os
 import logging
 import boto3
-from io import BytesIO
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
 from sticky_pi_api.types import List, Dict, Union, Any
 from sticky_pi_api.database.images_table import Images
 from sticky_pi_api.database.tiled_tuboids_table import TiledTuboids
 from sticky_pi_api.configuration import LocalAPIConf, BaseAPIConf, RemoteAPIConf
-from sticky_pi_api.utils import multipart_etag
+from sticky_pi_api.utils import multipart_etag, chunker
+from sticky_pi_api.url_cache import make_url_cache
+from sticky_pi_api.s3_signer import S3URLSigner
 
 
 class BaseStorage(ABC):
@@ -110,6 +113,25 @@ class BaseStorage(ABC):
         """
         pass
 
+    @abstractmethod
+    def store_image_thumbnails(self, image: Images) -> None:
+        """
+        Saves the thumbnail and thumbnail-mini of an image.
+
+        :param image: an image object, with thumbnails
+        """
+        pass
+
+    @abstractmethod
+    def get_image_file(self, image: Images) -> bytes:
+        """
+        Reads the original JPEG file of an image.
+
+        :param image: an image object
+        :return: the content of the file
+        """
+        pass
+
     @abstractmethod
     def delete_image_files(self, image: Images) -> None:
         """
@@ -126,6 +148,24 @@ class BaseStorage(ABC):
         """
         pass
 
+    def delete_image_list_files(self, images: List[Images]) -> None:
+        """
+        Delete the files corresponding to several images, in one go.
+
+        :param images: a list of image objects
+        """
+        for image in images:
+            self.delete_image_files(image)
+
+    def delete_tiled_tuboid_list_files(self, tuboids: List[TiledTuboids]) -> None:
+        """
+        Delete the files corresponding to several tiled tuboids, in one go.
+
+        :param tuboids: a list of tiled tuboid objects
+        """
+        for tuboid in tuboids:
+            self.delete_tiled_tuboid_files(tuboid)
+
     @abstractmethod
     def get_url_for_image(self, image: Images, what: str = 'metadata') -> str:
         """
@@ -137,6 +177,16 @@ class BaseStorage(ABC):
         """
         pass
 
+    def get_urls_for_images(self, images: List[Images], what: str = 'metadata') -> List[str]:
+        """
+        Retrieves the URLs to the files corresponding to several images, in one go.
+
+        :param images: a list of image objects
+        :param what:  One of {``'metadata'``, ``'image'``, ``'thumbnail'``, ``'thumbnail-mini'``}
+        :return: a url/path for each image, as in ``get_url_for_image``
+        """
+        return [self.get_url_for_image(image, what) for image in images]
+
     @abstractmethod
     def store_tiled_tuboid(self, data: Dict[str, str]) -> None:
         pass
@@ -145,6 +195,15 @@ class BaseStorage(ABC):
     def get_urls_for_tiled_tuboids(self, data: Dict[str, str]) -> Dict[str, str]:
         pass
 
+    def get_urls_for_tiled_tuboid_list(self, data: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Retrieves the URLs to the files of several tiled tuboids, in one go.
+
+        :param data: a list of tiled tuboids, each with, at least, the key ``'tuboid_id'``
+        :return: the urls of the files of each tuboid, as in ``get_urls_for_tiled_tuboids``
+        """
+        return [self.get_urls_for_tiled_tuboids(d) for d in data]
+
     @abstractmethod
     def _upload_url(self, path: str) -> str:
         """
@@ -181,7 +240,13 @@ class DiskStorage(BaseStorage):
         for k, v in self._tiled_tuboid_filenames.items():
             assert k in data, (k, data)
             logging.debug("%s => %s" % (data[k], os.path.join(target_dirname, v)))
-            shutil.copy(data[k], os.path.join(target_dirname, v))
+            # files can be paths, or uploaded file-like objects
+            if hasattr(data[k], 'read'):
+                data[k].seek(0)
+                with open(os.path.join(target_dirname, v), 'wb') as f:
+                    shutil.copyfileobj(data[k], f)
+            else:
+                shutil.copy(data[k], os.path.join(target_dirname, v))
 
     def get_urls_for_tiled_tuboids(self, data: Dict[str, str]) -> Dict[str, str]:
         tuboid_id = data['tuboid_id']
@@ -190,19 +255,35 @@ class DiskStorage(BaseStorage):
         files_urls = {k: os.path.join(target_dirname, v) for k, v in self._tiled_tuboid_filenames.items()}
         return files_urls
 
+    def _image_path(self, image: Images) -> str:
+        return os.path.join(self._local_dir, self._raw_images_dirname, image.device, image.filename)
+
     def store_image_files(self, image: Images) -> None:
-        target = os.path.join(self._local_dir, self._raw_images_dirname, image.device, image.filename)
+        target = self._image_path(image)
         os.makedirs(os.path.dirname(target), exist_ok=True)
-        target, thumbnail, thumb_mini = [target + self._suffix_map[s] for s in ['image', 'thumbnail', 'thumbnail-mini']]
         with open(target, 'wb') as f:
             f.write(image.file_blob)
-        image.thumbnail.save(thumbnail, format='jpeg')
-        image.thumbnail_mini.save(thumb_mini, format='jpeg')
+        # thumbnails may be deferred
+        if image.thumbnail_jpeg is not None:
+            self.store_image_thumbnails(image)
+
+    def store_image_thumbnails(self, image: Images) -> None:
+        target = self._image_path(image)
+        for what, body in [('thumbnail', image.thumbnail_jpeg), ('thumbnail-mini', image.thumbnail_mini_jpeg)]:
+            with open(target + self._suffix_map[what], 'wb') as f:
+                f.write(body)
+
+    def get_image_file(self, image: Images) -> bytes:
+        with open(self._image_path(image), 'rb') as f:
+            return f.read()
 
     def delete_image_files(self, image: Images) -> None:
-        target = os.path.join(self._local_dir, self._raw_images_dirname, image.device, image.filename)
+        target = self._image_path(image)
         for s in ['image', 'thumbnail', 'thumbnail-mini']:
             to_del = target + self._suffix_map[s]
+            # deferred thumbnails may not be made yet, and a deletion may be retried (see `StorageTombstones`)
+            if not os.path.exists(to_del):
+                continue
             logging.info('Removing %s' % to_del)
             os.remove(to_del)
 
@@ -245,35 +326,9 @@ class DiskStorage(BaseStorage):
         return out
 
 
-try:
-    import uwsgi
-
-
-    class URLCache(object):
-        _cache_block_size = 128 # bytes. matche uwsgi config
-        def __init__(self, expiration, name='s3_url_cache'):
-            self._name = name
-            self._expiration = expiration
-
-        def __getitem__(self, item):
-            out = uwsgi.cache_get(item, self._name)
-            if out is not None:
-                return out.decode('ascii')
-
-        def __setitem__(self, item, value):
-
-            assert len(value) < self._cache_block_size, f"object too large to cache: {value}"
-            expire = int(self._expiration * 0.95)  # a margin to make cache expire before the link
-            uwsgi.cache_update(item, value.encode('ascii'), expire, self._name)
-
-
-except ImportError:
-    # TODO alternative, dict base class
-    pass
-
-
 class S3Storage(BaseStorage):
     _expiration = 3600 * 24 * 7  # urls are valid for a week
+    _max_keys_per_delete = 1000  # the maximal number of keys in a `delete_objects` request
 
     def __init__(self, api_conf: RemoteAPIConf, *args, **kwargs):
         super().__init__(api_conf, *args, **kwargs)
@@ -283,44 +338,83 @@ class S3Storage(BaseStorage):
                        "use_ssl": True
                        }
 
-        self._cached_urls = URLCache(expiration=self._expiration)
+        self._cached_urls = make_url_cache(api_conf, self._expiration)
         self._bucket_name = api_conf.S3_BUCKET_NAME
         self._endpoint = credentials["endpoint_url"]
-        self._s3_ressource = boto3.resource('s3', **credentials)
+        # objects are put and deleted from a pool of threads, which all share the (thread safe) client
+        n_threads = int(api_conf.get('S3_THREADS') or 0)
+        self._executor = ThreadPoolExecutor(n_threads) if n_threads > 0 else None
+        self._s3_ressource = boto3.resource('s3', config=Config(max_pool_connections=max(10, n_threads)),
+                                            **credentials)
+        self._s3_client = self._s3_ressource.meta.client
+        self._signer = S3URLSigner(api_conf.S3_ACCESS_KEY, api_conf.S3_PRIVATE_KEY, self._endpoint,
+                                   self._bucket_name, api_conf.S3_REGION or 'us-east-1', self._expiration)
 
         # fixme ensure versioning is enabled. now, hangs
         # versioning = client.BucketVersioning(self._bucket_conf['bucket'])
         # print(versioning.status())
         # versioning.enable()
 
-    def _s3_url_prefix(self, key):
-        return f"{self._endpoint}/{self._bucket_name}/{key}"
+    def _map(self, function, iterable) -> List[Any]:
+        # runs `function` on each item, concurrently when threads are available
+        if self._executor is None:
+            return [function(i) for i in iterable]
+        return list(self._executor.map(function, iterable))
+
+    def _put_objects(self, objects: Dict[str, Any]) -> None:
+        # `objects` maps keys to bodies
+        self._map(lambda kv: self._s3_client.put_object(Bucket=self._bucket_name, Key=kv[0], Body=kv[1]),
+                  objects.items())
+
+    def _delete_objects(self, keys: List[str]) -> None:
+        # keys are deleted by batches, rather than one by one
+        def delete(keys_chunk):
+            logging.info('Removing %i objects, from %s' % (len(keys_chunk), keys_chunk[0]))
+            response = self._s3_client.delete_objects(Bucket=self._bucket_name,
+                                                      Delete={'Objects': [{'Key': k} for k in keys_chunk],
+                                                              'Quiet': True})
+            return response.get('Errors', [])
+
+        errors = [e for chunk_errors in self._map(delete, list(chunker(keys, self._max_keys_per_delete)))
+                  for e in chunk_errors]
+        if errors:
+            raise Exception("Failed to delete %i objects. E.g. %s: %s" %
+                            (len(errors), errors[0].get('Key'), errors[0].get('Message')))
 
     def store_image_files(self, image: Images) -> None:
-        tmp = BytesIO()
-        image.thumbnail.save(tmp, format='jpeg')
-        tmp_mini = BytesIO()
-        image.thumbnail_mini.save(tmp_mini, format='jpeg')
+        objects = {self._image_key(image, ''): image.file_blob}
+        # thumbnails may be deferred
+        if image.thumbnail_jpeg is not None:
+            objects.update(self._thumbnail_objects(image))
+        self._put_objects(objects)
+
+    def store_image_thumbnails(self, image: Images) -> None:
+        self._put_objects(self._thumbnail_objects(image))
+
+    def _thumbnail_objects(self, image: Images) -> Dict[str, bytes]:
+        return {self._image_key(image, self._suffix_map['thumbnail']): image.thumbnail_jpeg,
+                self._image_key(image, self._suffix_map['thumbnail-mini']): image.thumbnail_mini_jpeg}
 
-        for suffix, body in zip(['', '.thumbnail', '.thumbnail-mini'],
-                                [image.file_blob, tmp.getvalue(), tmp_mini.getvalue()]):
-            self._s3_ressource.Object(self._bucket_name,
-                                      self._image_key(image, suffix)).put(Body=body)
+    def get_image_file(self, image: Images) -> bytes:
+        return self._s3_ressource.Object(self._bucket_name, self._image_key(image, '')).get()['Body'].read()
 
     def delete_image_files(self, image: Images) -> None:
-        for k, v in self._suffix_map.items():
-            key = self._image_key(image, v)
-            logging.info('Removing %s' % key)
-            self._s3_ressource.meta.client.delete_object(Bucket=self._bucket_name, Key=key)
+        self.delete_image_list_files([image])
+
+    def delete_image_list_files(self, images: List[Images]) -> None:
+        self._delete_objects([self._image_key(image, v) for image in images for v in self._suffix_map.values()])
 
     def delete_tiled_tuboid_files(self, tuboid: TiledTuboids) -> None:
-        # name of the series
-        tuboid_dirname, _ = os.path.splitext(tuboid.tuboid_id)
-        target_dir = os.path.join(self._tiled_tuboids_storage_dirname, tuboid_dirname, tuboid.tuboid_id)
-        for k, v in self._tiled_tuboid_filenames.items():
-            to_del = os.path.join(target_dir, v)
-            logging.info('Removing %s' % to_del)
-            self._s3_ressource.meta.client.delete_object(Bucket=self._bucket_name, Key=to_del)
+        self.delete_tiled_tuboid_list_files([tuboid])
+
+    def delete_tiled_tuboid_list_files(self, tuboids: List[TiledTuboids]) -> None:
+        keys = []
+        for tuboid in tuboids:
+            # name of the series
+            tuboid_dirname, _ = os.path.splitext(tuboid.tuboid_id)
+            target_dir = os.path.join(self._tiled_tuboids_storage_dirname, tuboid_dirname, tuboid.tuboid_id)
+            keys += [os.path.join(target_dir, v) for v in self._tiled_tuboid_filenames.values()]
+        self._delete_objects(keys)
 
     def _image_key(self, image, suffix):
         return os.path.join(self._raw_images_dirname,
@@ -328,10 +422,13 @@ class S3Storage(BaseStorage):
                             image.filename + suffix)
 
     def get_url_for_image(self, image: Images, what: str = 'metadata') -> str:
+        return self.get_urls_for_images([image], what)[0]
+
+    def get_urls_for_images(self, images: List[Images], what: str = 'metadata') -> List[str]:
         if what == 'metadata':
-            return ""
+            return [""] * len(images)
         suffix = self._suffix_map[what]
-        return self._presigned_url(self._image_key(image, suffix))
+        return self._presigned_urls([self._image_key(image, suffix) for image in images])
 
     def get_ml_bundle_file_list(self, bundle_name: str, what: str = "all") -> List[Dict[str, Union[float, str]]]:
 
@@ -354,11 +451,12 @@ class S3Storage(BaseStorage):
             if what == 'all' or (in_data and what == 'data') or (in_model and what == 'model'):
                 remote_md5 = obj.e_tag[1:-1]
                 remote_last_modified = datetime.datetime.timestamp(obj.last_modified)
-                url = self._presigned_url(obj.key)
 
-                o = {'key': key, 'path': obj.key, 'md5': remote_md5, 'mtime': remote_last_modified,
-                     'url': url}
+                o = {'key': key, 'path': obj.key, 'md5': remote_md5, 'mtime': remote_last_modified}
                 out.append(o)
+
+        for o, url in zip(out, self._presigned_urls([o['path'] for o in out])):
+            o['url'] = url
         return out
 
     def _already_uploaded_ml_bundle_files(self, bundle_name: str) -> Dict[str, Dict[str, Any]]:
@@ -381,38 +479,47 @@ class S3Storage(BaseStorage):
                                                                      ExpiresIn=self._expiration)
         return out
 
-    def _presigned_url(self, key) -> str:
-        suffix = self._cached_urls[key]
+    def _presigned_urls(self, keys: List[str]) -> List[str]:
+        # only the timestamp and signature of the urls are cached. The urls that are not in the cache
+        # are all signed at once, locally
+        out = [None] * len(keys)
+        to_sign = []
+        for i, key in enumerate(keys):
+            cached = self._cached_urls[key]
+            amz_date, _, signature = cached.partition(':') if cached is not None else (None, None, None)
+            if signature:
+                out[i] = self._signer.url(key, amz_date, signature)
+            else:
+                to_sign.append(i)
 
-        if suffix is not None:
-            out = f"{self._s3_url_prefix(key)}?{suffix}"
-        else:
-            out = self._s3_ressource.meta.client.generate_presigned_url('get_object',
-                                                                        Params={'Bucket': self._bucket_name,
-                                                                                'Key': key},
-                                                                        ExpiresIn=self._expiration)
-            prefix, suffix = out.split("?")
-            assert prefix == self._s3_url_prefix(key), "Wrong URL prefix, cache will fail"
-            self._cached_urls[key] = suffix  # , now + self._expiration - 60) # a minute of margin so we don't serve urls that are obsolete at reception
-            logging.warning(f"setting cache for {key}")
-            assert suffix == self._cached_urls[key], f'Could not read cache for {key}'
+        if len(to_sign) > 0:
+            amz_date, signatures = self._signer.signatures([keys[i] for i in to_sign])
+            for i, signature in zip(to_sign, signatures):
+                self._cached_urls[keys[i]] = '%s:%s' % (amz_date, signature)
+                out[i] = self._signer.url(keys[i], amz_date, signature)
         return out
 
     def store_tiled_tuboid(self, data: Dict[str, str]) -> None:
         tuboid_id = data['tuboid_id']
         series_id = ".".join(tuboid_id.split('.')[0: -1])  # strip out the tuboid specific part
+        objects = {}
         for k, v in self._tiled_tuboid_filenames.items():
             assert k in data, (k, data)
             key = os.path.join(self._tiled_tuboids_storage_dirname, series_id, tuboid_id, v)
             logging.debug("%s => %s" % (data[k], os.path.join(k, v)))
             data[k].seek(0)
-            self._s3_ressource.Object(self._bucket_name,
-                                      key).put(Body=data[k])
+            objects[key] = data[k]
+        self._put_objects(objects)
 
     def get_urls_for_tiled_tuboids(self, data: Dict[str, str]) -> Dict[str, str]:
-        tuboid_id = data['tuboid_id']
-        series_id = ".".join(tuboid_id.split('.')[0: -1])  # strip out the tuboid specific part
-        target_dirname = os.path.join(self._tiled_tuboids_storage_dirname, series_id, tuboid_id)
-        files_urls = {k: self._presigned_url(os.path.join(target_dirname, v)) for k, v in
-                      self._tiled_tuboid_filenames.items()}
-        return files_urls
+        return self.get_urls_for_tiled_tuboid_list([data])[0]
+
+    def get_urls_for_tiled_tuboid_list(self, data: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        keys = []
+        for d in data:
+            tuboid_id = d['tuboid_id']
+            series_id = ".".join(tuboid_id.split('.')[0: -1])  # strip out the tuboid specific part
+            target_dirname = os.path.join(self._tiled_tuboids_storage_dirname, series_id, tuboid_id)
+            keys.append({k: os.path.join(target_dirname, v) for k, v in self._tiled_tuboid_filenames.items()})
+        urls = iter(self._presigned_urls([key for tuboid_keys in keys for key in tuboid_keys.values()]))
+        return [{k: next(urls) for k in tuboid_keys} for tuboid_keys in keys]
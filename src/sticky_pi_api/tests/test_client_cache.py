@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from sticky_pi_api.client import Cache
+
+
+def stats(path):
+    return os.path.basename(path)
+
+
+def other_stats(path):
+    return path
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        self._cache_path = os.path.join(self._temp_dir, 'cache', 'stats.sqlite')
+        self._files = []
+        for i in range(3):
+            path = os.path.join(self._temp_dir, '%i.jpg' % i)
+            with open(path, 'w') as f:
+                f.write('x' * i)
+            self._files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _keys(self):
+        return [(f, os.path.getmtime(f), os.path.getsize(f)) for f in self._files]
+
+    def test_cache(self):
+        cache = Cache(self._cache_path)
+        keys = self._keys()
+        self.assertEqual(cache.get_cached(stats, keys), {})
+        cache.add(stats, {k: stats(k[0]) for k in keys[:2]})
+        self.assertEqual(cache.get_cached(stats, keys), {k: stats(k[0]) for k in keys[:2]})
+        # results are namespaced by function, and by variant
+        self.assertEqual(cache.get_cached(other_stats, keys), {})
+        self.assertEqual(cache.get_cached(stats, keys, variant=True), {})
+
+        # results persist
+        cache = Cache(self._cache_path)
+        self.assertEqual(len(cache.get_cached(stats, keys)), 2)
+
+        # a modified file is not a hit anymore
+        with open(self._files[0], 'a') as f:
+            f.write('more')
+        self.assertEqual(list(cache.get_cached(stats, self._keys())), [self._keys()[1]])
+
+    def test_evict_missing(self):
+        cache = Cache(self._cache_path)
+        keys = self._keys()
+        cache.add(stats, {k: stats(k[0]) for k in keys})
+        os.remove(self._files[0])
+        self.assertEqual(cache.evict_missing(), 1)
+        self.assertEqual(cache.evict_missing(), 0)
+        self.assertEqual(list(cache.get_cached(stats, keys)), keys[1:])
+
+    def test_delete(self):
+        cache = Cache(self._cache_path)
+        cache.add(stats, {k: stats(k[0]) for k in self._keys()})
+        cache.delete()
+        self.assertFalse(os.path.exists(self._cache_path))
+        self.assertEqual(Cache(self._cache_path).get_cached(stats, self._keys()), {})
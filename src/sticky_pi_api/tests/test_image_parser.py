@@ -3,6 +3,10 @@ from sticky_pi_api.image_parser import ImageParser
 import datetime
 import os
 import logging
+import io
+import glob
+import tempfile
+import time
 
 test_dir = os.path.dirname(__file__)
 
@@ -33,3 +37,45 @@ class TestImageParser(unittest.TestCase):
             for k in p.keys():
                 self.assertEqual(p[k], self._test_image_metadata[k])
 
+    def test_parse_upload(self):
+        # uploads are named after their form field, and have a `filename`
+        with open(self._test_image, 'rb') as f:
+            upload = io.BytesIO(f.read())
+        upload.name = 'images'
+        upload.filename = os.path.basename(self._test_image)
+        self.assertEqual(dict(ImageParser(upload)), self._test_image_metadata)
+
+    def test_parse_fast(self):
+        p = ImageParser(self._test_image, fast=True)
+        self.assertEqual(dict(p), self._test_image_metadata)
+        self.assertEqual(p.thumbnail.size, ImageParser._thumbnail_size)
+        self.assertEqual(p.thumbnail_mini.size, ImageParser._thumbnail_mini_size)
+        with open(self._test_image, 'rb') as f:
+            self.assertEqual(p.file_blob, f.read())
+
+    def test_parse_fast_truncated(self):
+        with open(self._test_image, 'rb') as f:
+            blob = f.read()
+        for thumbnails in (True, False):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                path = os.path.join(temp_dir, os.path.basename(self._test_image))
+                with open(path, 'wb') as f:
+                    f.write(blob[:len(blob) // 2])
+                with self.assertRaises(ValueError):
+                    ImageParser(path, fast=True, thumbnails=thumbnails)
+
+
+class TestImageParserBenchmark(unittest.TestCase):
+    _test_images = sorted(glob.glob(os.path.join(test_dir, 'raw_images', '*', '*.jpg')))
+
+    def _time(self, fast):
+        start = time.time()
+        out = [ImageParser(im, fast=fast) for im in self._test_images]
+        return time.time() - start, out
+
+    def test_benchmark(self):
+        default_time, default = self._time(False)
+        fast_time, fast = self._time(True)
+        print('Parsing %i images: %.2fs (fast: %.2fs)' % (len(self._test_images), default_time, fast_time))
+        self.assertEqual([dict(p) for p in fast], [dict(p) for p in default])
+        self.assertLess(fast_time, default_time)
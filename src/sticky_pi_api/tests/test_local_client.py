@@ -1,15 +1,30 @@
 import os
+import io
 import tempfile
 import json
 import unittest
-from sticky_pi_api.client import LocalClient
-from sticky_pi_api.utils import string_to_datetime
+from sticky_pi_api.client import LocalClient, tuboid_dir_info
+from sticky_pi_api.image_parser import ImageParser
+from sticky_pi_api.utils import string_to_datetime, datetime_to_string
 from sqlalchemy.exc import IntegrityError
 from contextlib import redirect_stderr
 from io import StringIO
 import shutil
+import copy
 import glob
 import logging
+import datetime
+import time
+from sqlalchemy import or_, and_, event
+from sqlalchemy.orm import sessionmaker
+from sticky_pi_api.specifications import LocalAPI, _image_key_in, _image_keys
+from sticky_pi_api.configuration import LocalAPIConf
+from sticky_pi_api.database.images_table import Images
+from sticky_pi_api.database.uid_annotations_table import UIDAnnotations
+from sticky_pi_api.database.tiled_tuboids_table import TiledTuboids
+from sticky_pi_api.database.storage_tombstones_table import StorageTombstones
+from sticky_pi_api.database.daily_rollups_table import DailyRollups
+from sticky_pi_api.utils import chunker, tuboid_form_parts, tuboids_from_form
 
 
 logging.getLogger().setLevel(logging.INFO)
@@ -102,9 +117,85 @@ class LocalAndRemoteTests(object):
 
             # should fail to put images that are already there:
             with redirect_stderr(StringIO()) as stdout:
-                with self.assertRaises(self._server_error) as context:
-                    db._put_new_images(self._test_images[0:1])
+                out = db._put_new_images(self._test_images[0:1])
+            self.assertEqual(len(out), 1)
+            self.assertIn('error', out[0])
+
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_series_frames(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        try:
+            db = self._make_client(temp_dir)
+            self._clean_persistent_resources(db)
+            db.put_images(self._test_images)
+            series = [{'device': '%', 'start_datetime': '2020-01-01_00-00-00', 'end_datetime': '2020-12-31_00-00-00'}]
+            rows = db.get_image_series(series)
+            for fmt in ('arrow', 'parquet'):
+                frame = db.get_image_series_frame(series, fmt=fmt)
+                self.assertEqual(len(frame), len(rows))
+                self.assertEqual(set(frame.columns), set(rows[0].keys()))
+                self.assertTrue(str(frame['datetime'].dtype).startswith('datetime64'))
+                self.assertEqual(sorted(frame['md5']), sorted(r['md5'] for r in rows))
+            self.assertEqual(len(db.get_uid_annotations_series_frame(series)), 0)
+        finally:
+            shutil.rmtree(temp_dir)
 
+    def test_diff_images(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        try:
+            db = self._make_client(temp_dir)
+            self._clean_persistent_resources(db)
+            db.put_images(self._test_images[0:2])
+            info = [ImageParser(im) for im in self._test_images[0:3]]
+            info = [{'device': i['device'], 'datetime': i['datetime'], 'md5': i['md5']} for i in info]
+            info[1]['md5'] = '0' * 32
+            self.assertEqual(db.diff_images(info), ['present', 'md5_mismatch', 'absent'])
+            self.assertEqual(db.diff_images([]), [])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_put_images_batch_errors(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        try:
+            db = self._make_client(temp_dir)
+            self._clean_persistent_resources(db)
+            # a corrupted image, with a valid name
+            corrupted = os.path.join(temp_dir, os.path.basename(self._test_images[0]))
+            with open(self._test_images[0], 'rb') as src, open(corrupted, 'wb') as dst:
+                dst.write(src.read(1024))
+
+            # one bad image does not abort the batch
+            with redirect_stderr(StringIO()) as stdout:
+                out = db._put_new_images([self._test_images[1], corrupted, self._test_images[2]])
+            self.assertEqual(len(out), 3)
+            self.assertNotIn('error', out[0])
+            self.assertIn('error', out[1])
+            self.assertNotIn('error', out[2])
+            self.assertEqual(len(db.get_images(out[0:1] + out[2:3])), 2)
+
+            # the same image twice in a batch, from two directories (i.e. same basename)
+            copy_dir = os.path.join(temp_dir, 'copy')
+            os.makedirs(copy_dir)
+            copied = os.path.join(copy_dir, os.path.basename(self._test_images[3]))
+            shutil.copy(self._test_images[3], copied)
+            with redirect_stderr(StringIO()) as stdout:
+                out = db._put_new_images([self._test_images[3], copied, self._test_images[4]])
+            self.assertEqual(len(out), 3)
+            self.assertNotIn('error', out[0])
+            self.assertIn('error', out[1])
+            self.assertEqual(out[1]['filename'], os.path.basename(self._test_images[3]))
+            self.assertNotIn('error', out[2])
+            self.assertEqual(out[2]['md5'], ImageParser(self._test_images[4])['md5'])
+
+            # corrupted files are rejected before the upload, or by the API when they are not validated
+            for validate in (True, False):
+                with redirect_stderr(StringIO()) as stdout:
+                    out = db.put_images([corrupted, self._test_images[5]], validate=validate)
+                # the valid image is only uploaded the first time
+                self.assertEqual(len(out), 2 if validate else 1)
+                self.assertEqual([o['filename'] for o in out if 'error' in o], [os.path.basename(corrupted)])
         finally:
             shutil.rmtree(temp_dir)
     #
@@ -163,6 +254,40 @@ class LocalAndRemoteTests(object):
 
         finally:
             shutil.rmtree(temp_dir)
+    def test_iter_image_series(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        try:
+            db = self._make_client(temp_dir)
+            self._clean_persistent_resources(db)
+            db.put_images(self._test_images)
+            # the same images are matched by two series, and pages overlap both series
+            info = [{'device': "%",
+                     'start_datetime': "2020-01-01_00-00-00",
+                     'end_datetime': "2020-12-31_00-00-00"},
+                    {'device': "0a5bb6f4",
+                     'start_datetime': "2020-06-20_00-00-00",
+                     'end_datetime': "2020-06-22_00-00-00"}]
+            expected = db.get_image_series(info[:1]) + db.get_image_series(info[1:])
+            self.assertEqual(len(expected), len(self._test_images) + 5)
+
+            page = db.get_image_series_page(info, page_size=3)
+            self.assertEqual(len(page['data']), 3)
+            self.assertIsNotNone(page['cursor'])
+
+            for page_size in [1, 2, 5, 1000]:
+                out = list(db.iter_image_series(info, page_size=page_size))
+                self.assertEqual([o['id'] for o in out],
+                                 [o['id'] for o in sorted(expected[:len(self._test_images)],
+                                                          key=lambda o: (o['device'], o['datetime'], o['id']))] +
+                                 [o['id'] for o in sorted(expected[len(self._test_images):],
+                                                          key=lambda o: (o['device'], o['datetime'], o['id']))])
+
+            self.assertEqual(list(db.iter_image_series([{'device': "ffffffff",
+                                                         'start_datetime': "2020-01-01_00-00-00",
+                                                         'end_datetime': "2020-12-31_00-00-00"}])), [])
+        finally:
+            shutil.rmtree(temp_dir)
+
     # #
     def test_put_image_uid_annotations(self):
         temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
@@ -180,15 +305,28 @@ class LocalAndRemoteTests(object):
             #
             # should fail to upload twice the same annotations (save version/image)
             with redirect_stderr(StringIO()) as stdout:
-                with self.assertRaises(self._server_error) as context:
-                    db.put_uid_annotations([test_annotation2])
-
-            # should fail to upload orphan annotations
-            #
+                out = db.put_uid_annotations([test_annotation2])
+            self.assertIn('error', out[0])
+
+            # should fail to upload orphan annotations, or annotations for a different image (md5).
+            # Errors are reported for each annotation, the valid ones are still added
+            test_annotation3 = copy.deepcopy(self._test_annotation)
+            test_annotation3['metadata']['algo_version'] = '9000000001-ad2cd78dfaca12821046dfb8994724d5'
+            test_annotation4 = copy.deepcopy(test_annotation3)
+            test_annotation4['metadata']['md5'] = '0' * 32
             test_annotation2['metadata']['device'] = '01234567'
             with redirect_stderr(StringIO()) as stdout:
-                with self.assertRaises((ValueError, self._server_error)) as context:
-                    db.put_uid_annotations([test_annotation2])
+                out = db.put_uid_annotations([test_annotation2, test_annotation3, test_annotation4, test_annotation3])
+            self.assertEqual(len(out), 4)
+            self.assertIn('error', out[0])
+            self.assertNotIn('error', out[1])
+            self.assertEqual(out[1]['algo_version'], test_annotation3['metadata']['algo_version'])
+            self.assertIn('error', out[2])
+            # twice in the same batch
+            self.assertIn('error', out[3])
+            annots = db.get_uid_annotations([test_annotation3['metadata']])
+            self.assertEqual(len(annots), 3)
+            self.assertIn(out[1]['id'], [a['id'] for a in annots])
             #
             # # should clean both images AND annotations, in cascade
 
@@ -262,6 +400,11 @@ class LocalAndRemoteTests(object):
             # should return just the annotations for the matched query , not one per image (one image has no annot)
             self.assertEqual(len(out), len(to_upload[:-1]))
 
+            out_iter = list(db.iter_uid_annotations_series([{'device': '0a5bb6f4',
+                                                             'start_datetime': '2020-01-01_00-00-00',
+                                                             'end_datetime': '2020-12-31_00-00-00'}], page_size=2))
+            self.assertEqual(sorted(o['id'] for o in out_iter), sorted(o['id'] for o in out))
+
         finally:
             shutil.rmtree(temp_dir)
 
@@ -296,10 +439,85 @@ class LocalAndRemoteTests(object):
 
             # should return just the annotations for the matched query , not one per image (one image has no annot)
             self.assertEqual(len(out), len(to_upload))
+            self.assertEqual([o['algo_name'] is None for o in out], [False] * (len(to_upload) - 1) + [True])
+            self.assertEqual([o['parent_image_id'] for o in out[:-1]], [o['id'] for o in out[:-1]])
+            self.assertNotIn('json', out[0])
+            self.assertIn('id_annot', out[0])
+
+            # only the latest annotation of each image is returned
+            newer = copy.deepcopy(annot_to_up[0])
+            newer['metadata']['algo_version'] = '9' + newer['metadata']['algo_version'][1:]
+            db.put_uid_annotations([newer])
+            series = [{'device': '0a5bb6f4', 'start_datetime': '2020-01-01_00-00-00',
+                       'end_datetime': '2020-12-31_00-00-00'}]
+            out = db.get_images_with_uid_annotations_series(series, what_annotation='json')
+            self.assertEqual(len(out), len(to_upload))
+            self.assertEqual(out[0]['algo_version'], newer['metadata']['algo_version'])
+            self.assertEqual(out[1]['algo_version'], annot_to_up[1]['metadata']['algo_version'])
+            self.assertIn('json', out[0])
+
+            # the columnar version has the same data
+            frame = db.get_images_with_uid_annotations_frame(series, what_annotation='json')
+            self.assertEqual(frame.shape, (len(out), len(out[0])))
+            self.assertEqual(list(frame.columns), list(out[0].keys()))
+            self.assertEqual(frame['datetime'].tolist(), [o['datetime'] for o in out])
+            self.assertEqual(frame['algo_version'].tolist()[:-1], [o['algo_version'] for o in out[:-1]])
+            self.assertTrue(frame['algo_version'].isnull().iloc[-1])
 
         finally:
             shutil.rmtree(temp_dir)
 
+    def test_get_image_series_summary(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        try:
+            db = self._make_client(temp_dir)
+            self._clean_persistent_resources(db)
+            to_upload = [ti for ti in self._test_images if ImageParser(ti)['device'] == '0a5bb6f4']
+            db.put_images(to_upload)
+            annot_to_up = []
+            for ti in to_upload[:-1]:
+                p = ImageParser(ti)
+                annotation_stub = copy.deepcopy(self._test_annotation)
+                annotation_stub['metadata']['device'] = p['device']
+                annotation_stub['metadata']['datetime'] = datetime_to_string(p['datetime'])
+                annotation_stub['metadata']['md5'] = p['md5']
+                annot_to_up.append(annotation_stub)
+            db.put_uid_annotations(annot_to_up)
+            # a newer annotation replaces, rather than adds to, the former one
+            newer = copy.deepcopy(annot_to_up[0])
+            newer['metadata']['algo_version'] = '9' + newer['metadata']['algo_version'][1:]
+            newer['annotations'] *= 2
+            db.put_uid_annotations([newer])
+
+            series = [{'device': '0a5bb6f4', 'start_datetime': '2020-01-01_00-00-00',
+                       'end_datetime': '2020-12-31_00-00-00'}]
+            images = db.get_image_series(series)
+            annotations = {o['parent_image_id']: o for o in db.get_uid_annotations_series(series)
+                           if o['algo_version'] == newer['metadata']['algo_version'] or
+                           o['parent_image_id'] != images[0]['id']}
+
+            for bucket, key in [('hour', lambda dt: dt.replace(minute=0, second=0)),
+                                ('day', lambda dt: dt.replace(hour=0, minute=0, second=0))]:
+                expected = {}
+                for im in images:
+                    e = expected.setdefault(key(im['datetime']), {'n_images': 0, 'n_annotated': 0, 'n_objects': None})
+                    e['n_images'] += 1
+                    if im['id'] in annotations:
+                        e['n_annotated'] += 1
+                        e['n_objects'] = (e['n_objects'] or 0) + annotations[im['id']]['n_objects']
+                out = db.get_image_series_summary(series, what=bucket)
+                self.assertEqual([o['datetime'] for o in out], sorted(expected))
+                for o in out:
+                    self.assertEqual(o['device'], '0a5bb6f4')
+                    self.assertEqual({k: o[k] for k in ['n_images', 'n_annotated', 'n_objects']},
+                                     expected[o['datetime']])
+                self.assertEqual(sum(o['n_images'] for o in out), len(to_upload))
+
+            with self.assertRaises(Exception):
+                db.get_image_series_summary(series, what='minute')
+        finally:
+            shutil.rmtree(temp_dir)
+
 
     def test_ml_bundle(self):
 
@@ -419,6 +637,15 @@ class LocalAndRemoteTests(object):
             info[0]['algo_name'] = 'another_algo'
             out = db.put_itc_labels(info)
             self.assertEqual(len(out), 1)
+
+            # labels for all the tuboids, in one batch
+            tuboid_ids = [t['tuboid_id'] for t in db.get_tiled_tuboid_series(series)]
+            out = db.put_itc_labels([dict(info[0], tuboid_id=t, algo_name='batch') for t in tuboid_ids])
+            self.assertEqual(len(out), len(tuboid_ids))
+            self.assertEqual(len({o['id'] for o in out if o['id'] is not None}), len(tuboid_ids))
+            labels = db._get_itc_labels([{'tuboid_id': t} for t in tuboid_ids])
+            self.assertEqual(sorted(o['id'] for o in labels if o['algo_name'] == 'batch'), sorted(o['id'] for o in out))
+            self.assertEqual(len(labels), len(tuboid_ids) + 2)
             #
             import pandas as pd
             pd.set_option('display.max_rows', 500)
@@ -446,3 +673,440 @@ class TestLocalClient(unittest.TestCase, LocalAndRemoteTests):
         return LocalClient(directory)
 
 
+
+
+class TestQueryCount(unittest.TestCase):
+    # the number of SQL statements issued by the API methods. Series are iterated in a single query
+    _series = [{'device': '0a5bb6f4', 'start_datetime': '2020-01-01_00-00-00', 'end_datetime': '2020-12-31_00-00-00'}]
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        self._client = LocalClient(self._temp_dir)
+        self._images = [i for i in LocalAndRemoteTests()._test_images if ImageParser(i)['device'] == '0a5bb6f4']
+        self._client.put_images(self._images)
+        self._statements = []
+        event.listen(self._client._db_engine, 'before_cursor_execute', self._count_statement)
+
+    def tearDown(self):
+        event.remove(self._client._db_engine, 'before_cursor_execute', self._count_statement)
+        shutil.rmtree(self._temp_dir)
+
+    def _count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self._statements.append(statement)
+
+    def _n_statements(self, method, *args, **kwargs):
+        self._statements = []
+        method(*args, **kwargs)
+        return len(self._statements)
+
+    def _annotations(self):
+        out = []
+        for im in self._images:
+            p = ImageParser(im)
+            annotation = copy.deepcopy(LocalAndRemoteTests._test_annotation)
+            annotation['metadata'].update(device=p['device'], datetime=datetime_to_string(p['datetime']), md5=p['md5'])
+            out.append(annotation)
+        return out
+
+    def test_series(self):
+        self._client.put_uid_annotations(self._annotations())
+        self.assertEqual(self._n_statements(self._client.get_image_series, self._series), 1)
+        self.assertEqual(self._n_statements(self._client.get_image_series, self._series * 2), 2)
+        self.assertEqual(self._n_statements(self._client.get_uid_annotations_series, self._series), 1)
+        self.assertEqual(self._n_statements(self._client.get_tiled_tuboid_series, self._series), 1)
+        empty_series = [dict(self._series[0], device='ffffffff')]
+        self.assertEqual(self._n_statements(self._client.get_image_series, empty_series), 1)
+
+    def test_get_images(self):
+        info = [{'device': '0a5bb6f4', 'datetime': ImageParser(im)['datetime']} for im in self._images]
+        self.assertEqual(self._n_statements(self._client.get_images, info), 1)
+
+    def test_put_uid_annotations(self):
+        annotations = self._annotations()
+        self._n_statements(self._client.put_uid_annotations, annotations)
+        # parents, existing annotations, insert, and new ids.
+        # Then, the daily rollups: two aggregations, a delete and an insert
+        self.assertEqual(len(self._statements), 8)
+        annotation_statements = self._statements[:4]
+        image_queries = [s for s in annotation_statements if s.startswith('SELECT') and 'FROM images' in s]
+        self.assertEqual(len(image_queries), 1)
+        self.assertFalse([s for s in annotation_statements if 'count(' in s])
+
+
+class TestDeferredThumbnails(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        conf = LocalAPIConf(LOCAL_DIR=self._temp_dir)
+        conf.THUMBNAIL_WORKERS = 2
+        self._api = LocalAPI(conf)
+        self._images = LocalAndRemoteTests()._test_images[:3]
+
+    def tearDown(self):
+        self._api._thumbnail_executor.shutdown(wait=True)
+        shutil.rmtree(self._temp_dir)
+
+    def _thumbnails(self, what='thumbnail'):
+        info = [{'device': ImageParser(im)['device'], 'datetime': ImageParser(im)['datetime']} for im in self._images]
+        return self._api.get_images(info, what=what)
+
+    def test_deferred_thumbnails(self):
+        # leaving the block waits for the workers
+        with self._api._thumbnail_executor:
+            out = self._api._put_new_images(self._images)
+            self.assertEqual([o['thumbnail_status'] for o in out], ['pending'] * len(self._images))
+        for what in ['thumbnail', 'thumbnail-mini']:
+            out = self._thumbnails(what)
+            self.assertEqual([o['thumbnail_status'] for o in out], ['ready'] * len(self._images))
+            for o in out:
+                self.assertTrue(os.path.isfile(o['url']))
+
+        # images uploaded while no worker was available are processed on demand
+        session = sessionmaker(bind=self._api._db_engine)()
+        session.query(Images).update({Images.thumbnail_status: 'pending'})
+        session.commit()
+        session.close()
+        self.assertEqual([o['url'] for o in self._thumbnails()], [''] * len(self._images))
+        self.assertEqual(self._api.process_pending_thumbnails(), len(self._images))
+        self.assertEqual([o['thumbnail_status'] for o in self._thumbnails()], ['ready'] * len(self._images))
+
+
+class TestParallelIngestion(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        self._images = LocalAndRemoteTests()._test_images[:4]
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _put(self, name, **conf_vars):
+        os.mkdir(os.path.join(self._temp_dir, name))
+        conf = LocalAPIConf(LOCAL_DIR=os.path.join(self._temp_dir, name))
+        for k, v in conf_vars.items():
+            setattr(conf, k, v)
+        api = LocalAPI(conf)
+        # uploads are file-like objects, and the last one is invalid
+        files = [open(im, 'rb') for im in self._images]
+        invalid = StringIO('not an image')
+        invalid.name = os.path.basename(self._images[0]).replace('.jpg', '.bad.jpg')
+        try:
+            out = api._put_new_images(files + [invalid])
+        finally:
+            for f in files:
+                f.close()
+        return api, out
+
+    def test_parallel_ingestion(self):
+        _, serial = self._put('serial')
+        api, parallel = self._put('parallel', INGESTION_PROCESSES=2, STORAGE_THREADS=2)
+        api._ingestion_pool().shutdown()
+        api._storage_executor.shutdown()
+        self.assertIn('error', parallel[-1])
+        ignored = {'id', 'datetime_created'}
+        self.assertEqual([{k: v for k, v in o.items() if k not in ignored} for o in parallel[:-1]],
+                         [{k: v for k, v in o.items() if k not in ignored} for o in serial[:-1]])
+        for what in ['image', 'thumbnail', 'thumbnail-mini']:
+            for o in api.get_images(parallel[:-1], what=what):
+                self.assertTrue(os.path.isfile(o['url']))
+
+    def test_storage_errors(self):
+        conf = LocalAPIConf(LOCAL_DIR=self._temp_dir)
+        conf.STORAGE_THREADS = 2
+        api = LocalAPI(conf)
+        store_image_files = api._storage.store_image_files
+
+        def failing_store(image):
+            if image.filename == os.path.basename(self._images[1]):
+                raise OSError('disk full')
+            store_image_files(image)
+
+        api._storage.store_image_files = failing_store
+        out = api._put_new_images(self._images)
+        api._storage_executor.shutdown()
+        self.assertEqual(['error' in o for o in out], [False, True, False, False])
+        # the image that could not be stored is not in the database
+        session = sessionmaker(bind=api._db_engine)()
+        self.assertEqual(session.query(Images).count(), len(self._images) - 1)
+        session.close()
+
+
+class TestTiledTuboidBatches(unittest.TestCase):
+    _series = {'device': '08038ade', 'start_datetime': '2020-07-08_20-00-00', 'end_datetime': '2020-07-09_15-00-00',
+               'n_tuboids': 6, 'n_images': 10, 'algo_name': 'test', 'algo_version': '11111111-19191919'}
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        conf = LocalAPIConf(LOCAL_DIR=self._temp_dir)
+        conf.STORAGE_THREADS = 2
+        self._api = LocalAPI(conf)
+        self._tuboids = [tuboid_dir_info(d, self._series) for d in sorted(LocalAndRemoteTests()._tiled_tuboid_dirs)]
+
+    def tearDown(self):
+        self._api._storage_executor.shutdown()
+        shutil.rmtree(self._temp_dir)
+
+    def _tuboid_files(self):
+        return glob.glob(os.path.join(self._temp_dir, 'tiled_tuboids', '*', '*', '*'))
+
+    def test_batch(self):
+        out = self._api._put_tiled_tuboids(self._tuboids[:4])
+        self.assertEqual([o['tuboid_id'] for o in out], [t['tuboid_id'] for t in self._tuboids[:4]])
+        self.assertTrue(all(o['id'] is not None for o in out))
+        # a batch that would exceed the number of tuboids of the series is rejected as a whole
+        with self.assertRaises(IntegrityError):
+            self._api._put_tiled_tuboids(self._tuboids[2:])
+        out = self._api._put_tiled_tuboids(self._tuboids[4:])
+        self.assertEqual(len(out), 2)
+        self.assertEqual(len(self._tuboid_files()), 3 * len(self._tuboids))
+
+    def test_storage_errors(self):
+        store_tiled_tuboid = self._api._storage.store_tiled_tuboid
+
+        def failing_store(data):
+            if data['tuboid_id'] == self._tuboids[1]['tuboid_id']:
+                raise OSError('disk full')
+            store_tiled_tuboid(data)
+
+        self._api._storage.store_tiled_tuboid = failing_store
+        with redirect_stderr(StringIO()):
+            with self.assertRaises(OSError):
+                self._api._put_tiled_tuboids(self._tuboids)
+        # none of the tuboids is added, and the files of the stored ones are deleted
+        session = sessionmaker(bind=self._api._db_engine)()
+        self.assertEqual(session.query(TiledTuboids).count(), 0)
+        session.close()
+        self.assertEqual(self._tuboid_files(), [])
+
+
+class TestBulkDelete(unittest.TestCase):
+    _series = [{'device': '%', 'start_datetime': '2020-01-01_00-00-00', 'end_datetime': '2020-12-31_00-00-00'}]
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        self._client = LocalClient(self._temp_dir)
+        tests = LocalAndRemoteTests()
+        self._client.put_images(tests._test_images)
+        self._client.put_uid_annotations([tests._test_annotation])
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _n_rows(self, table):
+        session = sessionmaker(bind=self._client._db_engine)()
+        try:
+            return session.query(table).count()
+        finally:
+            session.close()
+
+    def _image_files(self):
+        return glob.glob(os.path.join(self._temp_dir, 'raw_images', '*', '*'))
+
+    def test_delete_images(self):
+        images = self._client.get_image_series(self._series)
+        out = self._client.delete_images(images)
+        self.assertEqual(sorted(o['id'] for o in out), sorted(o['id'] for o in images))
+        self.assertEqual(self._n_rows(Images), 0)
+        # annotations are deleted along with their images
+        self.assertEqual(self._n_rows(UIDAnnotations), 0)
+        self.assertEqual(self._n_rows(StorageTombstones), 0)
+        self.assertEqual(self._image_files(), [])
+
+    def test_storage_errors(self):
+        images = self._client.get_image_series(self._series)
+        n_files = len(self._image_files())
+        storage = self._client._storage
+        delete_image_list_files = storage.delete_image_list_files
+
+        def failing_delete(images):
+            raise OSError('storage unavailable')
+
+        storage.delete_image_list_files = failing_delete
+        with redirect_stderr(StringIO()):
+            out = self._client.delete_images(images)
+        # the images are deleted from the database, but their files are recorded as tombstones
+        self.assertEqual(len(out), len(images))
+        self.assertEqual(self._n_rows(Images), 0)
+        self.assertEqual(self._n_rows(StorageTombstones), len(images))
+        self.assertEqual(len(self._image_files()), n_files)
+        with redirect_stderr(StringIO()):
+            self.assertEqual(self._client.process_storage_tombstones(), 0)
+
+        storage.delete_image_list_files = delete_image_list_files
+        self.assertEqual(self._client.process_storage_tombstones(), len(images))
+        self.assertEqual(self._n_rows(StorageTombstones), 0)
+        self.assertEqual(self._image_files(), [])
+
+
+class TestDailyRollups(unittest.TestCase):
+    _series = [{'device': '%', 'start_datetime': '2020-01-01_00-00-00', 'end_datetime': '2020-12-31_00-00-00'}]
+    _summary_keys = ['device', 'datetime', 'n_images', 'n_annotated', 'n_objects']
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        self._api = LocalAPI(LocalAPIConf(LOCAL_DIR=self._temp_dir))
+        tests = LocalAndRemoteTests()
+        self._images = tests._test_images
+        self._annotation = tests._test_annotation
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _annotations(self, images, algo_version):
+        out = []
+        for im in images:
+            annotation = copy.deepcopy(self._annotation)
+            annotation['metadata'].update(device=im['device'], datetime=im['datetime'], md5=im['md5'],
+                                          algo_version=algo_version)
+            out.append(annotation)
+        return out
+
+    def _assert_rollups_match_images(self):
+        rollups = self._api.get_daily_rollups(self._series)
+        summary = self._api.get_image_series_summary(self._series, what='day')
+        self.assertEqual([{k: r[k] for k in self._summary_keys} for r in rollups],
+                         [{k: s[k] for k in self._summary_keys} for s in summary])
+        return rollups
+
+    def test_incremental_updates(self):
+        images = self._api._put_new_images(self._images)
+        self.assertGreater(len(self._assert_rollups_match_images()), 1)
+
+        self._api.put_uid_annotations(self._annotations(images[:5], '1111111111-a'))
+        # newer annotations replace former ones in the number of objects, but all versions are counted
+        self._api.put_uid_annotations(self._annotations(images[:2], '2222222222-b'))
+        rollups = self._assert_rollups_match_images()
+        first = [r for r in rollups if r['device'] == images[0]['device'] and
+                 r['datetime'] == images[0]['datetime'].replace(hour=0, minute=0, second=0)][0]
+        self.assertEqual([a['algo_version'] for a in first['annotations']], ['1111111111-a', '2222222222-b'])
+        self.assertEqual(sum(a['n_annotations'] for r in rollups for a in r['annotations']), 7)
+
+        self._api.delete_images(images[:3] + images[-1:])
+        self.assertEqual(sum(r['n_images'] for r in self._assert_rollups_match_images()), len(images) - 4)
+
+    def test_rebuild(self):
+        images = self._api._put_new_images(self._images)
+        self._api.put_uid_annotations(self._annotations(images[:5], '1111111111-a'))
+        rollups = self._api.get_daily_rollups(self._series)
+        session = sessionmaker(bind=self._api._db_engine)()
+        session.query(DailyRollups).delete()
+        session.commit()
+        session.close()
+        self.assertEqual(self._api.get_daily_rollups(self._series), [])
+        self.assertEqual(self._api.rebuild_daily_rollups(), len(rollups))
+        rebuilt = self._api.get_daily_rollups(self._series)
+        exclude = {'id', 'datetime_created'}
+        self.assertEqual([{k: v for k, v in r.items() if k not in exclude} for r in rebuilt],
+                         [{k: v for k, v in r.items() if k not in exclude} for r in rollups])
+
+
+class TestImageLookupBenchmark(unittest.TestCase):
+    # compares the per-device `IN` image lookup with the former `OR` of one `AND` per image
+    _legacy_chunk_size = 64
+
+    def _fill_images(self, api, n):
+        t0 = datetime.datetime(2020, 1, 1)
+        rows = [dict(device='%08x' % (i % 50), datetime=t0 + datetime.timedelta(minutes=i), datetime_created=t0,
+                     md5='0' * 32, width=1, height=1, no_flash_shutter_speed=0, no_flash_exposure_time=0,
+                     no_flash_bv=0, no_flash_iso=0) for i in range(n)]
+        with api._db_engine.begin() as conn:
+            conn.execute(Images.__table__.insert(), rows)
+        return [{'device': r['device'], 'datetime': r['datetime']} for r in rows]
+
+    def _benchmark(self, n):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.WARNING)
+        try:
+            api = LocalAPI(LocalAPIConf(LOCAL_DIR=temp_dir))
+            keys = self._fill_images(api, n)
+
+            out = api.get_images(keys)
+            self.assertEqual(len(out), n)
+
+            # we time the lookups alone, as building the image dictionaries costs the same either way
+            session = sessionmaker(bind=api._db_engine)()
+            start = time.time()
+            ids = []
+            for keys_chunk in chunker(keys, api._get_image_chunk_size):
+                ids += [i for i, in session.query(Images.id).filter(_image_key_in(_image_keys(keys_chunk)))]
+            batch_time = time.time() - start
+
+            start = time.time()
+            legacy_ids = []
+            for keys_chunk in chunker(keys, self._legacy_chunk_size):
+                conditions = [and_(Images.datetime == k['datetime'], Images.device == k['device']) for k in keys_chunk]
+                legacy_ids += [i for i, in session.query(Images.id).filter(or_(*conditions))]
+            legacy_time = time.time() - start
+            session.close()
+
+            print('Image lookup, %i keys: %.2fs (legacy: %.2fs)' % (n, batch_time, legacy_time))
+            self.assertEqual(sorted(ids), sorted(o['id'] for o in out))
+            self.assertEqual(sorted(ids), sorted(legacy_ids))
+            self.assertLess(batch_time, legacy_time)
+        finally:
+            logging.getLogger().setLevel(level)
+            shutil.rmtree(temp_dir)
+
+    def test_get_images_10k(self):
+        self._benchmark(10000)
+
+    @unittest.skipUnless(os.getenv('STICKY_PI_BENCHMARK'), 'set STICKY_PI_BENCHMARK to run the large benchmark')
+    def test_get_images_100k(self):
+        self._benchmark(100000)
+
+
+class TestTiledTuboidUploadBenchmark(unittest.TestCase):
+    # compares the ingestion of one multi-tuboid form with one form per tuboid, as sent by former clients.
+    # The local storage stands in for S3
+    def _tuboids(self, temp_dir, n):
+        # copies of the test tuboids, renamed to make a series of `n` tuboids
+        sources = sorted(LocalAndRemoteTests()._tiled_tuboid_dirs)
+        series_id = ".".join(os.path.basename(sources[0]).split('.')[0: -1])
+        series_info = {'device': '08038ade', 'start_datetime': '2020-07-08_20-00-00',
+                       'end_datetime': '2020-07-09_15-00-00', 'n_tuboids': n, 'n_images': 10,
+                       'algo_name': 'test', 'algo_version': '11111111-19191919'}
+        out = []
+        for i in range(n):
+            directory = os.path.join(temp_dir, 'tuboids', '%s.%04d' % (series_id, i))
+            shutil.copytree(sources[i % len(sources)], directory)
+            out.append(tuboid_dir_info(directory, series_info))
+        return out
+
+    def _form(self, parts, indexed=True):
+        form = {}
+        for name, _, content, _ in parts:
+            if isinstance(content, str):
+                with open(content, 'rb') as f:
+                    content = f.read()
+            form[name if indexed else name.split('.', 1)[1]] = io.BytesIO(content)
+        return form
+
+    def _api(self, temp_dir, name):
+        os.makedirs(os.path.join(temp_dir, name))
+        return LocalAPI(LocalAPIConf(LOCAL_DIR=os.path.join(temp_dir, name)))
+
+    def test_put_tiled_tuboids(self, n=120):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.WARNING)
+        try:
+            tuboids = self._tuboids(temp_dir, n)
+
+            api = self._api(temp_dir, 'legacy')
+            start = time.time()
+            legacy_out = []
+            for t in tuboids:
+                legacy_out += api._put_tiled_tuboids(tuboids_from_form(self._form(tuboid_form_parts([t]), False)))
+            legacy_time = time.time() - start
+
+            api = self._api(temp_dir, 'batch')
+            start = time.time()
+            out = api._put_tiled_tuboids(tuboids_from_form(self._form(tuboid_form_parts(tuboids))))
+            batch_time = time.time() - start
+
+            print('Tiled tuboid upload, %i tuboids: %.0f tuboids/s (one per request: %.0f tuboids/s)' %
+                  (n, n / batch_time, n / legacy_time))
+            self.assertEqual([o['tuboid_id'] for o in out], [o['tuboid_id'] for o in legacy_out])
+            self.assertLess(batch_time, legacy_time)
+        finally:
+            logging.getLogger().setLevel(level)
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,59 @@
+import re
+import datetime
+import unittest
+from unittest import mock
+import boto3
+from botocore.config import Config
+from sticky_pi_api.configuration import RemoteAPIConf
+from sticky_pi_api.s3_signer import S3URLSigner
+from sticky_pi_api.storage import S3Storage
+
+
+class TestS3URLSigner(unittest.TestCase):
+    _credentials = {'S3_ACCESS_KEY': 'AKIDEXAMPLE', 'S3_PRIVATE_KEY': 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+                    'S3_HOST': 's3.example.com:9000', 'S3_BUCKET_NAME': 'sticky-pi'}
+    _keys = ['raw_images/0a5bb6f4/0a5bb6f4.2020-06-20_21-33-24.jpg.thumbnail-mini',
+             'ml/universal-insect-detector/output/model final+1~.pth',
+             'tiled_tuboids/é=?&/tuboid.jpg']
+
+    def _signer(self):
+        return S3URLSigner(self._credentials['S3_ACCESS_KEY'], self._credentials['S3_PRIVATE_KEY'],
+                           'https://' + self._credentials['S3_HOST'], self._credentials['S3_BUCKET_NAME'],
+                           expiration=3600 * 24 * 7)
+
+    def test_same_as_botocore(self):
+        client = boto3.client('s3', aws_access_key_id=self._credentials['S3_ACCESS_KEY'],
+                              aws_secret_access_key=self._credentials['S3_PRIVATE_KEY'],
+                              endpoint_url='https://' + self._credentials['S3_HOST'], region_name='us-east-1',
+                              config=Config(signature_version='s3v4', s3={'addressing_style': 'path'}))
+        signer = self._signer()
+        for key in self._keys:
+            expected = client.generate_presigned_url('get_object',
+                                                     Params={'Bucket': self._credentials['S3_BUCKET_NAME'], 'Key': key},
+                                                     ExpiresIn=3600 * 24 * 7)
+            # we sign at the same time as botocore
+            now = datetime.datetime.strptime(re.search(r'X-Amz-Date=(\w+)', expected).group(1), '%Y%m%dT%H%M%SZ')
+            self.assertEqual(signer.presigned_urls([key], now), [expected])
+
+    def test_batch(self):
+        signer = self._signer()
+        now = datetime.datetime(2021, 1, 2, 3, 4, 5)
+        urls = signer.presigned_urls(self._keys, now)
+        self.assertEqual(urls, [signer.presigned_urls([k], now)[0] for k in self._keys])
+        self.assertEqual(len(set(urls)), len(self._keys))
+
+    def test_storage_cache(self):
+        conf = RemoteAPIConf(SECRET_API_KEY='abcd', MYSQL_HOST='h', MYSQL_USER='u', MYSQL_PASSWORD='p',
+                             MYSQL_DATABASE='d', **self._credentials)
+        storage = S3Storage(conf)
+        with mock.patch.object(S3URLSigner, 'signatures', wraps=storage._signer.signatures) as signatures:
+            urls = storage._presigned_urls(self._keys)
+            self.assertEqual(signatures.call_count, 1)
+            # cached urls are not signed again, only the new keys are
+            self.assertEqual(storage._presigned_urls(self._keys), urls)
+            self.assertEqual(signatures.call_count, 1)
+            storage._presigned_urls(self._keys + ['another/key'])
+            self.assertEqual(signatures.call_count, 2)
+            self.assertEqual(signatures.call_args[0][0], ['another/key'])
+        for url in urls:
+            self.assertIn('X-Amz-Signature=', url)
@@ -0,0 +1,55 @@
+import datetime
+import unittest
+from types import SimpleNamespace
+from botocore.stub import Stubber
+from sticky_pi_api.configuration import RemoteAPIConf
+from sticky_pi_api.database.images_table import Images
+from sticky_pi_api.storage import S3Storage
+
+
+class TestS3Storage(unittest.TestCase):
+    _conf = dict(SECRET_API_KEY='abcd', MYSQL_HOST='h', MYSQL_USER='u', MYSQL_PASSWORD='p', MYSQL_DATABASE='d',
+                 S3_ACCESS_KEY='AKIDEXAMPLE', S3_PRIVATE_KEY='wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+                 S3_HOST='s3.example.com:9000', S3_BUCKET_NAME='sticky-pi')
+
+    def _storage(self, **conf_vars):
+        return S3Storage(RemoteAPIConf(**dict(self._conf, **conf_vars)))
+
+    def _images(self, n):
+        # storage only needs the device and filename of images
+        t0 = datetime.datetime(2020, 1, 1)
+        out = []
+        for i in range(n):
+            im = SimpleNamespace(device='0a5bb6f4', datetime=t0 + datetime.timedelta(minutes=i))
+            im.filename = Images.filename.fget(im)
+            out.append(im)
+        return out
+
+    def test_batch_delete(self):
+        storage = self._storage()
+        images = self._images(500)
+        keys = [storage._image_key(im, s) for im in images for s in ['', '.thumbnail', '.thumbnail-mini']]
+        with Stubber(storage._s3_client) as stubber:
+            # 1500 keys are deleted in two requests
+            for chunk in [keys[:1000], keys[1000:]]:
+                stubber.add_response('delete_objects', {},
+                                     {'Bucket': 'sticky-pi', 'Delete': {'Objects': [{'Key': k} for k in chunk],
+                                                                        'Quiet': True}})
+            storage.delete_image_list_files(images)
+            stubber.assert_no_pending_responses()
+
+    def test_concurrent_delete(self):
+        storage = self._storage(S3_THREADS=4)
+        with Stubber(storage._s3_client) as stubber:
+            for _ in range(4):
+                stubber.add_response('delete_objects', {})
+            storage.delete_image_list_files(self._images(1200))
+            stubber.assert_no_pending_responses()
+
+    def test_delete_errors(self):
+        storage = self._storage()
+        with Stubber(storage._s3_client) as stubber:
+            stubber.add_response('delete_objects', {'Errors': [{'Key': 'a/key', 'Message': 'Access Denied'}]})
+            with self.assertRaises(Exception) as context:
+                storage.delete_image_files(self._images(1)[0])
+            self.assertIn('Access Denied', str(context.exception))
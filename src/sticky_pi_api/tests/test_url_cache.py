@@ -0,0 +1,62 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from sticky_pi_api.configuration import BaseAPIConf
+from sticky_pi_api.url_cache import LRUURLCache, FileURLCache, make_url_cache
+
+
+class TestURLCache(unittest.TestCase):
+    def _test_cache(self, cache):
+        self.assertIsNone(cache['a'])
+        cache['a'] = 'X-Amz-Signature=1'
+        self.assertEqual(cache['a'], 'X-Amz-Signature=1')
+        cache['a'] = 'X-Amz-Signature=2'
+        self.assertEqual(cache['a'], 'X-Amz-Signature=2')
+
+    def test_lru(self):
+        cache = LRUURLCache(expiration=3600, max_size=2)
+        self._test_cache(cache)
+        cache['b'] = 'b'
+        # `a` is used, so `b` is the least recently used entry
+        self.assertEqual(cache['a'], 'X-Amz-Signature=2')
+        cache['c'] = 'c'
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache['b'])
+        self.assertEqual(cache['c'], 'c')
+
+    def test_expiration(self):
+        cache = LRUURLCache(expiration=1)
+        cache['a'] = 'a'
+        time.sleep(1)
+        self.assertIsNone(cache['a'])
+
+    def test_file(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky-pi-')
+        try:
+            path = os.path.join(temp_dir, 'cache', 'urls.db')
+            cache = FileURLCache(expiration=3600, path=path)
+            self._test_cache(cache)
+            # the file is shared with other caches
+            self.assertEqual(FileURLCache(expiration=3600, path=path)['a'], 'X-Amz-Signature=2')
+            expired = FileURLCache(expiration=0, path=path)
+            expired['b'] = 'b'
+            self.assertIsNone(expired['b'])
+            expired.purge()
+            self.assertEqual(cache['a'], 'X-Amz-Signature=2')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_make_url_cache(self):
+        conf = BaseAPIConf(SECRET_API_KEY='abcd')
+        self.assertIsInstance(make_url_cache(conf, 3600), LRUURLCache)
+        conf.URL_CACHE = 'lru'
+        conf.URL_CACHE_SIZE = '10'
+        self.assertEqual(make_url_cache(conf, 3600)._max_size, 10)
+        conf.URL_CACHE = 'file'
+        with self.assertRaises(ValueError):
+            make_url_cache(conf, 3600)
+        conf.URL_CACHE = 'memcached'
+        with self.assertRaises(ValueError):
+            make_url_cache(conf, 3600)
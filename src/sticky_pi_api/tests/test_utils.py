@@ -0,0 +1,93 @@
+import io
+import os
+import json
+import tempfile
+import time
+import datetime
+import unittest
+from decimal import Decimal
+from sticky_pi_api.utils import to_python, to_json_compatible, json_io_converter, json_out_parser, \
+    tuboid_form_parts, tuboids_from_form
+
+
+class TestJSONConversion(unittest.TestCase):
+    _inputs = [
+        [{'device': '0a5bb6f4', 'datetime': '2020-06-20_21-33-24', 'md5': 'x'}],
+        [{'device': '%', 'start_datetime': datetime.datetime(2020, 1, 1, 3, 4, 5, 678),
+          'end_datetime': '2020-12-31_00-00-00', 'lat': Decimal('1.5'), 'n': 3, 'ok': True, 'v': None}],
+        {'series_info': {'start_datetime': datetime.datetime(2020, 1, 1), 'algo_version': '1-abc'}, 1: (1, 2)},
+        ['2020-06-20_21-33-24', datetime.datetime(2020, 1, 1)],
+        datetime.datetime(2020, 1, 1),
+        'metadata',
+        None,
+    ]
+
+    def test_equivalent_to_json(self):
+        for i in self._inputs:
+            expected = json.loads(json.dumps(i, default=json_io_converter), object_hook=json_out_parser)
+            self.assertEqual(to_python(i), expected)
+            expected = json.loads(json.dumps(i, default=json_io_converter))
+            self.assertEqual(to_json_compatible(i), expected)
+
+    def test_does_not_alias_inputs(self):
+        info = [{'device': '0a5bb6f4', 'datetime': '2020-06-20_21-33-24'}]
+        out = to_python(info)
+        out[0]['device'] = 'changed'
+        self.assertEqual(info[0]['device'], '0a5bb6f4')
+
+    def test_benchmark(self):
+        # a local client used to make its inputs json-compatible, and then the API parsed them back
+        info = [{'device': '%08x' % i, 'datetime': datetime.datetime(2020, 6, 20, 21, 33, 24), 'md5': '0' * 32}
+                for i in range(20000)]
+        start = time.time()
+        expected = json.loads(json.dumps(info, default=json_io_converter))
+        expected = json.loads(json.dumps(expected, default=json_io_converter), object_hook=json_out_parser)
+        json_time = time.time() - start
+        start = time.time()
+        out = to_python(info)
+        fast_time = time.time() - start
+        print('Converting %i rows: %.2fs (json: %.2fs)' % (len(info), fast_time, json_time))
+        self.assertEqual(out, expected)
+        self.assertLess(fast_time, json_time)
+
+
+class TestTuboidForm(unittest.TestCase):
+    _series_info = {'device': '08038ade', 'start_datetime': '2020-07-08_20-00-00', 'n_tuboids': 6}
+
+    def _form(self, parts):
+        # what the server receives: a file-like object per part
+        form = {}
+        for name, _, content, _ in parts:
+            if isinstance(content, str):
+                with open(content, 'rb') as f:
+                    content = f.read()
+            form[name] = io.BytesIO(content)
+        return form
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tuboids = []
+            for i in range(3):
+                tuboid = {'tuboid_id': 'tuboid.%04d' % i, 'series_info': self._series_info}
+                for field in ('metadata', 'tuboid', 'context'):
+                    tuboid[field] = os.path.join(temp_dir, '%s.%i' % (field, i))
+                    with open(tuboid[field], 'w') as f:
+                        f.write('%s of %i' % (field, i))
+                tuboids.append(tuboid)
+
+            out = tuboids_from_form(self._form(tuboid_form_parts(tuboids)))
+            self.assertEqual([o['tuboid_id'] for o in out], [t['tuboid_id'] for t in tuboids])
+            for o, t in zip(out, tuboids):
+                self.assertEqual(o['series_info'], self._series_info)
+                for field in ('metadata', 'tuboid', 'context'):
+                    with open(t[field], 'rb') as f:
+                        self.assertEqual(o[field].read(), f.read())
+
+    def test_legacy_form(self):
+        # a single tuboid, with non-indexed parts
+        form = {'metadata': io.BytesIO(b'm'), 'tuboid': io.BytesIO(b't'), 'context': io.BytesIO(b'c'),
+                'tuboid_id': io.BytesIO(b'"tuboid.0000"'), 'series_info': io.BytesIO(b'{"device": "08038ade"}')}
+        out = tuboids_from_form(form)
+        self.assertEqual(len(out), 1)
+        self.assertEqual(out[0]['tuboid_id'], 'tuboid.0000')
+        self.assertEqual(out[0]['series_info'], {'device': '08038ade'})
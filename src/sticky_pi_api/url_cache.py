@@ -0,0 +1,179 @@
+"""
+Caches for presigned URLs. Signing a URL is CPU-heavy, so ``S3Storage`` keeps the (query string) part
+of the URL that depends on the signature, for a little less than the validity of the URL.
+Three backends are available:
+
+* ``UWSGIURLCache``: the uwsgi ``cache2`` of the server, shared by all the workers. Only available under uwsgi.
+* ``LRUURLCache``: an in-process, size limited, least recently used cache.
+* ``FileURLCache``: a local sqlite file, that can be shared by all the processes of a host.
+
+``make_url_cache`` picks the backend from the API configuration.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from sticky_pi_api.configuration import BaseAPIConf
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+class BaseURLCache(ABC):
+    # a margin to make cache expire before the link
+    _expiration_margin = 0.95
+
+    def __init__(self, expiration: int):
+        """
+        A key-value cache of strings, where entries expire.
+
+        :param expiration: the validity of the cached urls, in seconds.
+            Entries expire a little earlier, so that the cache never serves expired urls
+        """
+        self._expiration = int(expiration * self._expiration_margin)
+
+    @abstractmethod
+    def __getitem__(self, item: str) -> str:
+        """
+        :return: the cached value, or ``None`` if ``item`` is not cached or has expired
+        """
+        pass
+
+    @abstractmethod
+    def __setitem__(self, item: str, value: str) -> None:
+        pass
+
+
+class UWSGIURLCache(BaseURLCache):
+    _cache_block_size = 128  # bytes. matche uwsgi config
+
+    def __init__(self, expiration: int, name: str = 's3_url_cache'):
+        if uwsgi is None:
+            raise ImportError("The uwsgi cache is only available when running under uwsgi")
+        super().__init__(expiration)
+        self._name = name
+
+    def __getitem__(self, item):
+        out = uwsgi.cache_get(item, self._name)
+        if out is not None:
+            return out.decode('ascii')
+
+    def __setitem__(self, item, value):
+        assert len(value) < self._cache_block_size, f"object too large to cache: {value}"
+        uwsgi.cache_update(item, value.encode('ascii'), self._expiration, self._name)
+
+
+class LRUURLCache(BaseURLCache):
+    def __init__(self, expiration: int, max_size: int = 100000):
+        """
+        An in-process cache, shared between threads. When full, the least recently used entries are dropped.
+
+        :param expiration: the validity of the cached urls, in seconds
+        :param max_size: the maximal number of entries
+        """
+        super().__init__(expiration)
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, item):
+        with self._lock:
+            entry = self._entries.get(item)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[item]
+                return None
+            self._entries.move_to_end(item)
+            return value
+
+    def __setitem__(self, item, value):
+        with self._lock:
+            self._entries[item] = value, time.time() + self._expiration
+            self._entries.move_to_end(item)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileURLCache(BaseURLCache):
+    _timeout = 10  # seconds to wait for another process to release the file
+
+    def __init__(self, expiration: int, path: str):
+        """
+        A cache in a local sqlite file, shared by all the processes (e.g. workers) that use the same file.
+
+        :param expiration: the validity of the cached urls, in seconds
+        :param path: the path to the cache file. It is created if needed
+        """
+        super().__init__(expiration)
+        self._path = path
+        self._connections = {}
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS urls (item TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections cannot be shared with forked processes (e.g. uwsgi workers), so we open one per process
+        pid = os.getpid()
+        if pid not in self._connections:
+            self._connections = {pid: sqlite3.connect(self._path, timeout=self._timeout, check_same_thread=False)}
+        return self._connections[pid]
+
+    def __getitem__(self, item):
+        with self._lock:
+            row = self._connection().execute('SELECT value, expires FROM urls WHERE item = ?', (item,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def __setitem__(self, item, value):
+        with self._lock, self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (item, value, time.time() + self._expiration))
+
+    def purge(self) -> None:
+        """
+        Removes the expired entries from the file
+        """
+        with self._lock, self._connection() as conn:
+            conn.execute('DELETE FROM urls WHERE expires < ?', (time.time(),))
+
+
+def make_url_cache(api_conf: BaseAPIConf, expiration: int) -> BaseURLCache:
+    """
+    Makes the URL cache defined by the configuration variables ``URL_CACHE`` (one of
+    {``'uwsgi'``, ``'lru'``, ``'file'``}), ``URL_CACHE_SIZE`` (for ``'lru'``) and ``URL_CACHE_PATH`` (for ``'file'``).
+    By default, the uwsgi cache is used when running under uwsgi, and an in-process LRU cache otherwise.
+
+    :param api_conf: the configuration of the API
+    :param expiration: the validity of the cached urls, in seconds
+    :return: a URL cache
+    """
+    backend = api_conf.get('URL_CACHE')
+    if not backend:
+        backend = 'uwsgi' if uwsgi is not None else 'lru'
+    logging.info('Using %s URL cache' % backend)
+
+    if backend == 'uwsgi':
+        return UWSGIURLCache(expiration)
+    if backend == 'lru':
+        size = api_conf.get('URL_CACHE_SIZE')
+        return LRUURLCache(expiration, int(size)) if size else LRUURLCache(expiration)
+    if backend == 'file':
+        path = api_conf.get('URL_CACHE_PATH')
+        if not path:
+            raise ValueError("No value provided for `URL_CACHE_PATH', required by the file URL cache")
+        return FileURLCache(expiration, path)
+    raise ValueError("Unknown URL cache `%s'. Should be one of 'uwsgi', 'lru' or 'file'" % backend)
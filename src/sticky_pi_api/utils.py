@@ -40,6 +40,62 @@ class URLOrFileOpen(object):
             shutil.rmtree(self._tmp_dir_path)
 
 
+def upload_name(file) -> str:
+    """
+    The name of a file, which can be a path or a file-like object.
+    Uploads (i.e. ``werkzeug.FileStorage``) have a ``filename``, as their ``name`` is the one of the form field.
+
+    :param file: a path or a file-like object
+    :return: the basename of the file
+    """
+    if isinstance(file, str):
+        return os.path.basename(file)
+    name = getattr(file, 'filename', None) or getattr(file, 'name', str(file))
+    return os.path.basename(name)
+
+
+# the files of a tiled tuboid, in an upload form: field -> (filename, content type)
+_tuboid_form_files = {'metadata': ('metadata.txt', 'application/text'),
+                      'tuboid': ('tuboid.jpg', 'application/octet-stream'),
+                      'context': ('context.jpg', 'application/octet-stream')}
+_tuboid_form_json = ('tuboid_id', 'series_info')
+
+
+def tuboid_form_parts(tuboids):
+    """
+    Describes the parts of a multipart form that uploads several tiled tuboids in a single request.
+    The parts of each tuboid are named after its index in the form, e.g. ``'0.tuboid'``, ``'0.series_info'``.
+
+    :param tuboids: a list of tuboids, as described by ``sticky_pi_api.client.tuboid_dir_info``
+    :return: a list of ``(name, filename, content, content_type)`` tuples. The content of files is their path,
+        and the content of the other parts is JSON, encoded as bytes
+    """
+    out = []
+    for i, tuboid in enumerate(tuboids):
+        for field, (filename, content_type) in _tuboid_form_files.items():
+            out.append(('%i.%s' % (i, field), filename, tuboid[field], content_type))
+        for field in _tuboid_form_json:
+            out.append(('%i.%s' % (i, field), field, json.dumps(tuboid[field]).encode(), 'application/json'))
+    return out
+
+
+def tuboids_from_form(files):
+    """
+    Reads the tiled tuboids of an upload form, as made by ``tuboid_form_parts``.
+    Forms whose parts are not indexed (i.e. from former clients) contain a single tuboid.
+
+    :param files: a dictionary of the file-like parts of the form, by name
+    :return: a list of tuboids, in the order of the form, as expected by ``BaseAPI._put_tiled_tuboids``
+    """
+    tuboids = {}
+    for name, f in files.items():
+        index, _, field = name.rpartition('.')
+        if field in _tuboid_form_json:
+            f = json.load(f)
+        tuboids.setdefault(int(index) if index else 0, {})[field] = f
+    return [tuboids[i] for i in sorted(tuboids)]
+
+
 def chunker(seq, size: int):
     """
     Breaks an interable into a list of smaller chunks of size ``size`` (or less for the last chunk)
@@ -64,29 +120,94 @@ def json_io_converter(o):
         raise Exception('Un-parsable json object: %s' % o)
 
 
+def _parse_datestring(string):
+    # `string_to_datetime`, for strings that already match `DATESTRING_REGEX`. Much faster than `strptime`
+    return datetime.datetime(int(string[0:4]), int(string[5:7]), int(string[8:10]),
+                             int(string[11:13]), int(string[14:16]), int(string[17:19]))
+
+
+def _is_datestring(v):
+    # the length check avoids most regex searches
+    return len(v) == 19 and v[10] == '_' and DATESTRING_REGEX.search(v) is not None
+
+
 def json_out_parser(o):
     for k, v in o.items():
-        if isinstance(v, str) and DATESTRING_REGEX.search(v):
-            o[k] = string_to_datetime(o[k])
+        if isinstance(v, str) and _is_datestring(v):
+            o[k] = _parse_datestring(v)
     return o
 
 
+def _json_key(k):
+    # json object keys are strings
+    if isinstance(k, str):
+        return k
+    if isinstance(k, bool):
+        return 'true' if k else 'false'
+    if k is None:
+        return 'null'
+    return str(k)
+
+
+def _json_datetime(dt):
+    # the precision of datetime strings is the second
+    if dt is pd.NaT:
+        return None
+    return datetime.datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+
+def to_json_compatible(o):
+    """
+    Converts an object to json-compatible values, in one pass. The equivalent of
+    ``json.loads(json.dumps(o, default=json_io_converter))``, but file-like objects are kept as they are.
+    """
+    if isinstance(o, (str, int, float)) or o is None:
+        return o
+    if isinstance(o, dict):
+        return {_json_key(k): to_json_compatible(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [to_json_compatible(v) for v in o]
+    if isinstance(o, datetime.datetime):
+        return datetime_to_string(o)
+    return json_io_converter(o)
+
+
+def to_python(o, _in_object=False):
+    """
+    Converts json-compatible values to python objects, in one pass. The equivalent of
+    ``json.loads(json.dumps(o, default=json_io_converter), object_hook=json_out_parser)``:
+    datetime strings that are values of dictionaries are parsed, and other datetimes are formatted as strings.
+    Datetimes that are already values of dictionaries are kept (to the second).
+    """
+    if isinstance(o, str):
+        if _in_object and _is_datestring(o):
+            return _parse_datestring(o)
+        return o
+    if isinstance(o, (int, float)) or o is None:
+        return o
+    if isinstance(o, dict):
+        out = {}
+        for k, v in o.items():
+            # the most common values are handled inline
+            if type(v) is str:
+                out[_json_key(k)] = _parse_datestring(v) if _is_datestring(v) else v
+            elif type(v) is int or type(v) is float or v is None:
+                out[_json_key(k)] = v
+            else:
+                out[_json_key(k)] = to_python(v, True)
+        return out
+    if isinstance(o, (list, tuple)):
+        return [to_python(v) for v in o]
+    if isinstance(o, datetime.datetime):
+        return _json_datetime(o) if _in_object else datetime_to_string(o)
+    return json_io_converter(o)
+
 
 def json_inputs_to_python(func):
     @functools.wraps(func)
     def _json_inputs_to_python(self, *args, **kwargs):
-        formated_a = []
-        for a in args:
-            json_a = json.dumps(a, default=json_io_converter)
-            a = json.loads(json_a, object_hook=json_out_parser)
-            formated_a.append(a)
-
-        formated_k = {}
-        for k, v in kwargs.items():
-            json_v = json.dumps(v, default=json_io_converter)
-            v = json.loads(json_v, object_hook=json_out_parser)
-            formated_k[k] = v
-
+        formated_a = [to_python(a) for a in args]
+        formated_k = {k: to_python(v) for k, v in kwargs.items()}
         out = func(self, *formated_a, **formated_k)
         # it it the responsibility of the serializer to then encode to json, on the remote api
         return out
@@ -96,18 +217,11 @@ def json_inputs_to_python(func):
 def python_inputs_to_json(func):
     @functools.wraps(func)
     def _python_inputs_to_json(self, *args, **kwargs):
-        formated_a = []
-        for a in args:
-            json_a = json.dumps(a, default=json_io_converter)
-            a = json.loads(json_a)
-            formated_a.append(a)
-
-        formated_k = {}
-        for k, v in kwargs.items():
-            json_v = json.dumps(v, default=json_io_converter)
-            v = json.loads(json_v)
-            formated_k[k] = v
-
+        # local clients call the API in-process, which takes python objects anyway
+        if getattr(self, '_python_native_inputs', False):
+            return func(self, *args, **kwargs)
+        formated_a = [to_json_compatible(a) for a in args]
+        formated_k = {k: to_json_compatible(v) for k, v in kwargs.items()}
         out = func(self, *formated_a, **formated_k)
         # it it the responsibility of the serializer to then decode to json, on the remote client
         return out